@@ -7,6 +7,192 @@ port: 29418
 passphrase: tester
 ssh_private_key: /home/YOURLOGIN/.ssh/id_rsa_alice
 
+; Seconds the dispatcher waits before it reconnects in endless mode.
+; reconnect_delay: 5
+
+; Handlers run Gerrit commands through the dispatcher's GerritCommandPool,
+; which shares the stream's connection and opens up to max_transports more.
+; At most max_commands commands run at once, channels_per_transport of them
+; on one connection. All options are optional.
+; max_commands: 4
+; channels_per_transport: 4
+; max_transports: 2
+; command_timeout: 60
+
+; Specify how the gerritevent.Dispatcher protects itself from failing handlers.
+; All options are optional.
+
+[dispatcher]
+
+; Seconds a handler callback may take before it is considered failed.
+; handler_timeout: 30
+
+; Consecutive failures after which a handler isn't called for reset_timeout
+; seconds.
+; failure_threshold: 5
+; reset_timeout: 60
+
+; Events that a handler failed to handle are appended to this file. Run
+; examples/replay.py to hand them to the handlers once more.
+; dead_letter_file: /var/lib/gerritevent/dead-letters.json
+
+; When events pile up, they are handed to the handlers by priority (lower
+; number first) per event type, per project (@project) or both
+; (type@project). Events of one change always keep their order. A waiting
+; event gains one level every priority_aging seconds (0 disables aging).
+; priorities: change-merged:0 ref-updated:0 comment-added:10
+; default_priority: 0
+; priority_aging: 1.0
+
+; Events are handled by min_workers to max_workers threads; events of one
+; change are never handled in parallel. Every scale_interval seconds the
+; pool grows if events waited longer than scale_up_wait seconds for
+; scale_up_after intervals and shrinks by one worker after scale_down_after
+; intervals below scale_down_wait seconds. The workers queue the calls of
+; each handler for its own threads, so a slow handler doesn't hold up the
+; others: handler_limits sets the threads per handler class (default: the
+; handler's max_concurrency) and handler_backlog how many calls may wait for
+; them before the workers wait too.
+; min_workers: 1
+; max_workers: 8
+; scale_interval: 5
+; scale_up_wait: 1.0
+; scale_down_wait: 0.1
+; scale_up_after: 2
+; scale_down_after: 6
+; handler_limits: RedmineHandler:4 IRCHandler:1
+; handler_backlog: 1000
+
+; Handlers with bulk_ref_updates get the ref-updated events of a project
+; collapsed into one ref_updated_bulk() call, ref_update_window seconds after
+; the first one or once ref_update_max_size events came together. The other
+; handlers still get each event.
+; ref_update_window: 2.0
+; ref_update_max_size: 500
+
+; Specify how much the gerritevent.state.ApprovalIndex and
+; gerritevent.state.ChangeView handlers keep in memory. All options are
+; optional.
+
+[approvals]
+; max_changes: 10000
+
+[changes]
+; max_changes: 10000
+
+; The ChangeView is written to this file every snapshot_interval seconds and
+; restored from it on start.
+; snapshot_file: /var/lib/gerritevent/changes.json
+; snapshot_interval: 60
+
+; Specify where the gerritevent.export.ColumnarExportHandler writes the
+; events for analytics. Only needed if you use that handler.
+
+; [export]
+; directory: /var/lib/gerritevent/export
+; max_events: 10000
+; flush_interval: 300
+; format: auto
+
+; Specify where the gerritevent.publisher.PublisherHandler republishes the
+; events. backend is one of local (the gerritevent.publisher.LocalBroker),
+; kafka, nats or redis. Only needed if you use that handler.
+
+; [publisher]
+; backend: local
+; address: unix:/var/run/gerritevent/broker.sock
+; topic: gerrit-events
+; compress: yes
+; batch_size: 100
+; batch_interval: 1.0
+; retry_interval: 5.0
+; max_pending: 10000
+
+; Enrich each event with the change data of "gerrit query <flags>" before it
+; is dispatched; handlers find it as event["enrichment"]. Results are cached
+; per change and patch set for ttl seconds, at most max_size of them.
+
+; [enrichment]
+; flags: --current-patch-set --files --all-reviewers --commit-message
+; ttl: 300
+; max_size: 1000
+
+; Let the dispatcher re-broadcast the raw Gerrit stream to local subscribers,
+; either on a Unix socket or host:port (address) or as Server-Sent Events on
+; http://<sse_address>/events?type=...&project=... A subscriber that falls
+; more than max_buffer events behind is disconnected.
+
+; [fanout]
+; address: unix:/var/run/gerritevent/fanout.sock
+; sse_address: 127.0.0.1:8099
+; max_buffer: 1000
+
+; Receive events pushed by the Gerrit webhooks plugin on host:port, in
+; addition to the SSH stream (or instead of it, if there is no [gerrit]
+; section). If a secret is set, requests must carry the HMAC-SHA256 of the
+; body in the X-Gerrit-Signature header ("sha256=<hex digest>"). At most
+; max_pending events are queued; further requests are answered with 503,
+; batches of more than max_pending events with 413.
+
+; [webhook]
+; address: 0.0.0.0:8098
+; secret: changeme
+; max_pending: 1000
+
+; Let several dispatchers that read the same Gerrit stream share the work.
+; The events are split into partitions by project or change and each
+; partition is handled by one live node, coordinated through the SQLite
+; lease_file. When a node dies, the others take over its partitions after
+; lease_ttl seconds. node defaults to host name and process ID.
+; Events are handled at least once: after a crash, some of them are handled
+; again by the new owner.
+
+; [cluster]
+; lease_file: /var/lib/gerritevent/leases.db
+; node: gerritevent-1
+; partitions: 64
+; partition_by: project
+; lease_ttl: 10
+; buffer_size: 10000
+
+; Profile a running dispatcher: on the signal, the stacks of the threads
+; (those whose name starts with one of threads, default all) are sampled
+; every interval seconds for seconds and written as flame graph input
+; (collapsed stacks) to a new file in directory. A client of address gets
+; the profile directly after sending the seconds (or an empty line), or the
+; CPU seconds per handler as JSON after sending "cpu". account_cpu records
+; the CPU time of each handler callback (timing handler.<class>.cpu).
+
+; [profiler]
+; signal: SIGUSR2
+; seconds: 10
+; interval: 0.01
+; directory: /var/tmp
+; address: unix:/var/run/gerritevent/profiler.sock
+; threads: Thread-
+; account_cpu: yes
+
+; Trace a sample_rate share of the events from reading to the last handler
+; call: decoding, filtering, queue wait, enrichment, each handler callback
+; and the HTTP calls of the handlers. exporter is json (one span per line
+; appended to file) or opentelemetry (needs the opentelemetry-api package
+; and an OpenTelemetry SDK configured by the process).
+
+; [tracing]
+; sample_rate: 0.01
+; exporter: json
+; file: /var/log/gerritevent/traces.json
+
+; Remember the side effects handlers performed (e.g. comments added by the
+; gerritevent.RedmineHandler) for ttl seconds in this SQLite file, so that
+; events delivered once more don't repeat them. The max_cached most recent
+; keys are also kept in memory.
+
+; [idempotency]
+; file: /var/lib/gerritevent/idempotency.db
+; ttl: 604800
+; max_cached: 10000
+
 ; Specify how the gerritevent.RedmineHandler can push updates to your Redmine
 ; instance.
 
@@ -26,6 +212,31 @@ api_key: 8b5d80c55ddddb00f3445cb9b845b6d
 
 issue_url: http://yourhost/redmine/issues/%d.json
 
+; Rate-Limit
+;
+; Optionally throttle the updates sent to Redmine: at most rate_limit updates
+; per second with bursts of up to rate_burst updates, and at most
+; target_rate_limit updates per second to the same issue. Updates are queued,
+; never dropped. Queued updates for the event types in rate_priorities are
+; sent first (lower number first).
+
+; rate_limit: 5
+; rate_burst: 10
+; target_rate_limit: 0.5
+; target_rate_burst: 2
+; rate_priorities: change-merged:0 comment-added:10
+
+; Issue-Validation
+;
+; Optionally only comment on issues that exist. They are looked up in batches
+; at issues_url (defaults to the issues.json next to issue_url) and cached for
+; issue_ttl seconds, issues that don't exist for missing_issue_ttl seconds.
+
+; validate_issues: yes
+; issues_url: http://yourhost/redmine/issues.json
+; issue_ttl: 3600
+; missing_issue_ttl: 300
+
 ; Comment-Added-Template
 ;
 ; Whenever as review was done, a note will be added to all the issues that are
@@ -56,4 +267,42 @@ issue_url: http://yourhost/redmine/issues/%d.json
 ;  $patchset_created_on 
 
 comment_added_template: $comment_author_name commented on review $change_url: $comment.
- The original change was authored by $change_owner_name.
\ No newline at end of file
+ The original change was authored by $change_owner_name.
+
+; Optionally restrict the Redmine projects (names or IDs) whose issues the
+; changes of a Gerrit project may comment on. Implies validate_issues.
+
+; [redmine_projects]
+; tools: Tools, 7
+
+; Rules for the gerritevent.rules.RuleHandler, read from file (or from
+; "rule <name>" sections in this file if there is no file). The file is
+; read again when it changed, checked every reload_interval seconds.
+
+; [rules]
+; file: /etc/gerritevent/rules.conf
+; reload_interval: 30
+
+; A rule runs its action for the events that meet all its conditions (all
+; optional): types, projects, branches (patterns), approvals, and subject
+; and comment (regular expressions). The action is a template, appended to
+; file (or printed), or an http request. Templates and URLs can use the
+; event's values like $type, $project, $branch, $change_number,
+; $patchSet_revision, $refUpdate_newRev, $author_name, $approval_Code_Review
+; and $event (the whole event as JSON).
+
+; [rule notify-ci]
+; types: change-merged
+; projects: tools infra
+; branches: master release/*
+; action: http
+; method: POST
+; url: http://ci.example.com/job/$project/build
+; body: {"change": "$change_number", "revision": "$patchSet_revision"}
+;
+; [rule approved-log]
+; types: comment-added
+; approvals: Code-Review>=2 Verified=1
+; comment: (?i)ship it
+; template: $change_url approved by $author_name
+; file: /var/log/gerritevent/approved.log
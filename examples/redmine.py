@@ -4,6 +4,7 @@ License: LGPL
 Author: Konrad Kleine <kleine@gonicus.de>
 """
 import gerritevent
+import signal
 import sys
 if sys.version_info < (3, 0):
     from ConfigParser import ConfigParser
@@ -14,13 +15,23 @@ else:
 def main():
     """
     Reads a config an starts dispatching gerrit events.
-    TODO (kwk): Add signal interrupt handling
+    SIGTERM and SIGINT stop the dispatcher after the events that were already
+    read from Gerrit have been handled.
     """
     config = ConfigParser()
     config.read("config.conf")
     handler = gerritevent.RedmineHandler(config)
     dispatcher = gerritevent.Dispatcher(config, handlers=[handler])
+
+    def shutdown(signum, frame):
+        dispatcher.stop(timeout=30)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
     dispatcher.start()
+    # Join with a timeout, otherwise the signals never reach the main thread.
+    while dispatcher.is_alive():
+        dispatcher.join(1)
 
 if __name__ == "__main__":
     main()
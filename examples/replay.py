@@ -0,0 +1,28 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+import gerritevent
+from gerritevent.resilience import DeadLetterStore
+import sys
+if sys.version_info < (3, 0):
+    from ConfigParser import ConfigParser
+else:
+    from configparser import ConfigParser
+
+
+def main():
+    """
+    Hands the events from the dead-letter file once more to the handlers.
+    Events that fail again stay in the dead-letter file.
+    """
+    config = ConfigParser()
+    config.read("config.conf")
+    handler = gerritevent.RedmineHandler(config)
+    store = DeadLetterStore(config.get("dispatcher", "dead_letter_file"))
+    replayed = store.replay([handler])
+    print("Replayed %d events, %d left" % (replayed, len(store.entries())))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+import time
+START = time.time()
+import sys
+import StringIO
+if sys.version_info < (3, 0):
+    from ConfigParser import ConfigParser
+else:
+    from configparser import ConfigParser
+
+
+def main():
+    """
+    Measures how long it takes from the start of the process to the first
+    event handed to a handler, without network: the import of the package,
+    the construction of the dispatcher and the dispatch itself. Run it
+    before and after changes to the start-up path, e.g.
+    PYTHONPATH=src python examples/startup.py
+    """
+    import gerritevent
+    imported = time.time()
+    config = ConfigParser()
+    config.readfp(StringIO.StringIO("[dispatcher]\n"))
+    first_event = []
+
+    class FirstEventHandler(gerritevent.Handler):
+        def comment_added(self, event):
+            first_event.append(time.time())
+
+    dispatcher = gerritevent.Dispatcher(config, [FirstEventHandler(config)])
+    constructed = time.time()
+    dispatcher.submit({"type": "comment-added"})
+    dispatcher.start()
+    dispatcher.stop()
+    print("import:              %.1f ms" % ((imported - START) * 1000))
+    print("construction:        %.1f ms" % ((constructed - imported) * 1000))
+    print("time to first event: %.1f ms" % ((first_event[0] - START) * 1000))
+    print("modules loaded:      %d" % len(sys.modules))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+import math
+import threading
+import time
+from gerritevent import options
+from gerritevent.cache import LRUCache
+from gerritevent.handler import Handler
+from gerritevent.metrics import Metrics
+
+
+def _same_account(account, other):
+    """
+    Returns True if the account dictionaries have the same username, or the
+    same email if either has no username. Accounts that can't be compared
+    count as different.
+    """
+    for key in ("username", "email"):
+        if account.get(key) and other.get(key):
+            return account[key] == other[key]
+    return False
+
+
+class QuantileSketch(object):
+    """
+    Estimates quantiles of non-negative values in bounded memory.
+    Values are counted in logarithmic buckets, so every estimate is within
+    the relative "accuracy" of the true value. If more than "max_bins"
+    buckets are needed, the lowest ones are merged, which only costs
+    accuracy for the smallest values.
+    """
+    def __init__(self, accuracy=0.01, max_bins=1024):
+        """
+        Constructs an empty QuantileSketch.
+        """
+        object.__init__(self)
+        self.accuracy = accuracy
+        self.max_bins = max_bins
+        self.__gamma = (1.0 + accuracy) / (1.0 - accuracy)
+        self.__log_gamma = math.log(self.__gamma)
+        self.bins = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value, count=1):
+        """
+        Adds "value" "count" times.
+        """
+        self.count += count
+        if value <= 0:
+            self.zeros += count
+            return
+        index = int(math.ceil(math.log(value) / self.__log_gamma))
+        self.bins[index] = self.bins.get(index, 0) + count
+        if len(self.bins) > self.max_bins:
+            lowest = sorted(self.bins)[:2]
+            self.bins[lowest[1]] += self.bins.pop(lowest[0])
+
+    def merge(self, other):
+        """
+        Adds all values of the QuantileSketch "other" (same accuracy).
+        """
+        self.count += other.count
+        self.zeros += other.zeros
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        while len(self.bins) > self.max_bins:
+            lowest = sorted(self.bins)[:2]
+            self.bins[lowest[1]] += self.bins.pop(lowest[0])
+
+    def quantile(self, q):
+        """
+        Returns the estimated "q" quantile (0 <= q <= 1) or None if there
+        are no values.
+        """
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if rank < seen:
+                return 2.0 * self.__gamma ** index / (self.__gamma + 1.0)
+        return 2.0 * self.__gamma ** max(self.bins) / (self.__gamma + 1.0)
+
+
+class RollingQuantileSketch(object):
+    """
+    Estimates quantiles of the values added within the last "window"
+    seconds. The window is split into "slots" QuantileSketch objects that
+    are reset in turn, so the memory stays bounded.
+    """
+    def __init__(self, window, slots=7, accuracy=0.01, max_bins=1024):
+        """
+        Constructs an empty RollingQuantileSketch.
+        """
+        object.__init__(self)
+        self.__slot_width = float(window) / slots
+        self.__accuracy = accuracy
+        self.__max_bins = max_bins
+        self.__slots = [(None, None)] * slots
+
+    def add(self, value, now=None):
+        """
+        Adds "value" at time "now" (seconds since the epoch). Values older
+        than the window are dropped, so they can't reset a live slot.
+        """
+        if now is None:
+            now = time.time()
+        slot = int(now // self.__slot_width)
+        position = slot % len(self.__slots)
+        current, sketch = self.__slots[position]
+        if current is not None and current > slot:
+            return
+        if current != slot:
+            sketch = QuantileSketch(self.__accuracy, self.__max_bins)
+            self.__slots[position] = (slot, sketch)
+        sketch.add(value)
+
+    def sketch(self, now=None):
+        """
+        Returns a QuantileSketch with all values of the window.
+        """
+        if now is None:
+            now = time.time()
+        oldest = int(now // self.__slot_width) - len(self.__slots)
+        merged = QuantileSketch(self.__accuracy, self.__max_bins)
+        for slot, sketch in self.__slots:
+            if slot is not None and slot > oldest:
+                merged.merge(sketch)
+        return merged
+
+
+class ReviewLatencyHandler(Handler):
+    """
+    Computes review statistics per project from the stream:
+    "time_to_first_review" (seconds from the first patch set to the first
+    vote by somebody other than the owner), "time_to_merge" (seconds from
+    the first patch set to the merge) and "patchsets" (patch sets per merged
+    change). For each of them the handler keeps a RollingQuantileSketch
+    per project and registers the 50th, 90th and 99th percentile and the
+    count with "metrics", named like "review.<project>.time_to_merge.p90".
+    Configure it in the optional "review_latency" config section:
+    "max_changes" (10000) open changes and "max_projects" (1000) projects
+    are tracked, the least recently active ones are forgotten first; the
+    statistics cover the last "window" seconds (a week), split into
+    "slots" (7) parts, with a relative "accuracy" of 0.01.
+    Changes whose "patchset-created" event wasn't seen (e.g. created before
+    the start) are timed from the "createdOn" of the patch set their event
+    carries.
+    """
+
+    STATISTICS = ('time_to_first_review', 'time_to_merge', 'patchsets')
+
+    QUANTILES = (('p50', 0.5), ('p90', 0.9), ('p99', 0.99))
+
+    def __init__(self, config, metrics=None):
+        """
+        Constructs a ReviewLatencyHandler and registers it with "metrics".
+        """
+        Handler.__init__(self, config)
+        section = "review_latency"
+        self.__changes = LRUCache(
+            options.getint(config, section, "max_changes", 10000))
+        self.__window = options.getfloat(config, section, "window", 604800.0)
+        self.__slots = options.getint(config, section, "slots", 7)
+        self.__accuracy = options.getfloat(config, section, "accuracy", 0.01)
+        self.__sketches = LRUCache(
+            options.getint(config, section, "max_projects", 1000))
+        self.__lock = threading.Lock()
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        metrics.register("review", self.values)
+
+    def patchset_created(self, event):
+        """
+        Starts tracking a change with its first known patch set.
+        """
+        change = self.__change(event)
+        patchset = event["patchSet"]
+        change["patchsets"] = max(change["patchsets"],
+                                  int(patchset["number"]))
+        created_on = patchset.get("createdOn", self.__now(event))
+        if change["created_on"] is None or created_on < change["created_on"]:
+            change["created_on"] = created_on
+
+    def comment_added(self, event):
+        """
+        Records the first vote by somebody other than the owner.
+        """
+        if not event.get("approvals"):
+            return
+        change = self.__change(event)
+        if _same_account(event["author"], event["change"].get("owner", {})):
+            return
+        if change["reviewed"] or change["created_on"] is None:
+            return
+        change["reviewed"] = True
+        now = self.__now(event)
+        self.__add(change["project"], "time_to_first_review",
+                   now - change["created_on"], now)
+
+    def change_merged(self, event):
+        """
+        Records the time to merge and the number of patch sets.
+        """
+        change = self.__changes.pop(int(event["change"]["number"]))
+        if change is None:
+            change = self.__new_change(event)
+        now = self.__now(event)
+        patchsets = max(change["patchsets"],
+                        int(event["patchSet"]["number"]))
+        self.__add(change["project"], "patchsets", patchsets, now)
+        if change["created_on"] is not None:
+            self.__add(change["project"], "time_to_merge",
+                       now - change["created_on"], now)
+
+    def change_abandoned(self, event):
+        """
+        Stops tracking the change.
+        """
+        self.__changes.pop(int(event["change"]["number"]))
+
+    def values(self):
+        """
+        Returns the current quantiles as a dictionary with keys like
+        "<project>.time_to_merge.p90".
+        """
+        now = time.time()
+        values = {}
+        with self.__lock:
+            sketches = [((project, statistic), rolling.sketch(now))
+                        for project, statistics in self.__sketches.items()
+                        for statistic, rolling in statistics.items()]
+        for (project, statistic), sketch in sketches:
+            prefix = project + "." + statistic + "."
+            values[prefix + "count"] = sketch.count
+            for name, q in ReviewLatencyHandler.QUANTILES:
+                values[prefix + name] = sketch.quantile(q)
+        return values
+
+    def __change(self, event):
+        """
+        Returns the tracked state of the event's change.
+        """
+        number = int(event["change"]["number"])
+        change = self.__changes.get(number)
+        if change is None:
+            change = self.__new_change(event)
+            self.__changes.put(number, change)
+        return change
+
+    def __new_change(self, event):
+        """
+        Returns the state of a change first seen with "event", created when
+        the event's patch set was.
+        """
+        return {"project": event["change"]["project"],
+                "created_on": (event.get("patchSet") or {}).get("createdOn"),
+                "patchsets": 0, "reviewed": False}
+
+    def __add(self, project, statistic, value, now):
+        """
+        Adds "value" to the sketch of "statistic" for "project".
+        """
+        with self.__lock:
+            statistics = self.__sketches.get(project)
+            if statistics is None:
+                statistics = {}
+                self.__sketches.put(project, statistics)
+            rolling = statistics.get(statistic)
+            if rolling is None:
+                rolling = RollingQuantileSketch(self.__window, self.__slots,
+                                                self.__accuracy)
+                statistics[statistic] = rolling
+            rolling.add(value, now)
+
+    def __now(self, event):
+        """
+        Returns the time of the event, as reported by Gerrit if possible.
+        """
+        return event.get("eventCreatedOn", time.time())
@@ -0,0 +1,204 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+import threading
+import time
+
+
+class _Node(object):
+    """An entry of the LRUCache's doubly linked list."""
+
+    __slots__ = ('key', 'value', 'prev', 'next')
+
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+        self.prev = None
+        self.next = None
+
+
+class LRUCache(object):
+    """
+    A thread-safe dictionary-like cache that holds at most "max_size"
+    entries. When full, the least recently used entry is evicted. get() and
+    put() are O(1).
+    """
+    def __init__(self, max_size):
+        """
+        Constructs an empty LRUCache.
+        """
+        object.__init__(self)
+        if max_size < 1:
+            raise ValueError('max_size must be at least 1')
+        self.max_size = max_size
+        self.lock = threading.RLock()
+        self.__nodes = {}
+        # Sentinel of the circular list: root.next is the least and
+        # root.prev the most recently used node.
+        self.__root = _Node(None, None)
+        self.__root.prev = self.__root.next = self.__root
+
+    def __len__(self):
+        """Returns the number of entries."""
+        with self.lock:
+            return len(self.__nodes)
+
+    def __contains__(self, key):
+        """Returns True if there is an entry for "key" (doesn't touch it)."""
+        with self.lock:
+            return key in self.__nodes
+
+    def get(self, key, default=None):
+        """
+        Returns the value for "key" and marks it as recently used, or
+        "default" if there is no entry.
+        """
+        with self.lock:
+            node = self.__nodes.get(key)
+            if node is None:
+                return default
+            self.__unlink(node)
+            self.__append(node)
+            return node.value
+
+    def peek(self, key, default=None):
+        """
+        Returns the value for "key" without marking it as recently used.
+        """
+        with self.lock:
+            node = self.__nodes.get(key)
+            if node is None:
+                return default
+            return node.value
+
+    def put(self, key, value):
+        """
+        Stores "value" for "key" and evicts the least recently used entry
+        if the cache is full.
+        """
+        with self.lock:
+            node = self.__nodes.get(key)
+            if node is not None:
+                node.value = value
+                self.__unlink(node)
+                self.__append(node)
+                return
+            if len(self.__nodes) >= self.max_size:
+                oldest = self.__root.next
+                self.__unlink(oldest)
+                del self.__nodes[oldest.key]
+            node = _Node(key, value)
+            self.__nodes[key] = node
+            self.__append(node)
+
+    def pop(self, key, default=None):
+        """
+        Removes the entry for "key" and returns its value, or "default" if
+        there is no entry.
+        """
+        with self.lock:
+            node = self.__nodes.pop(key, None)
+            if node is None:
+                return default
+            self.__unlink(node)
+            return node.value
+
+    def clear(self):
+        """Removes all entries."""
+        with self.lock:
+            self.__nodes.clear()
+            self.__root.prev = self.__root.next = self.__root
+
+    def items(self):
+        """
+        Returns a list of (key, value) tuples from the least to the most
+        recently used entry.
+        """
+        with self.lock:
+            items = []
+            node = self.__root.next
+            while node is not self.__root:
+                items.append((node.key, node.value))
+                node = node.next
+            return items
+
+    def __unlink(self, node):
+        """Removes "node" from the linked list."""
+        node.prev.next = node.next
+        node.next.prev = node.prev
+
+    def __append(self, node):
+        """Inserts "node" as the most recently used one."""
+        last = self.__root.prev
+        last.next = node
+        node.prev = last
+        node.next = self.__root
+        self.__root.prev = node
+
+
+class TTLCache(LRUCache):
+    """
+    An LRUCache whose entries also expire "ttl" seconds after they were
+    put (or after the "ttl" given to put()).
+    """
+    def __init__(self, max_size, ttl):
+        """
+        Constructs an empty TTLCache.
+        """
+        LRUCache.__init__(self, max_size)
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        """
+        Returns the value for "key" and marks it as recently used, or
+        "default" if there is no entry or it expired.
+        """
+        with self.lock:
+            entry = LRUCache.get(self, key)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires <= time.time():
+                LRUCache.pop(self, key)
+                return default
+            return value
+
+    def peek(self, key, default=None):
+        """
+        Returns the value for "key" without marking it as recently used.
+        """
+        with self.lock:
+            entry = LRUCache.peek(self, key)
+            if entry is None or entry[0] <= time.time():
+                return default
+            return entry[1]
+
+    def put(self, key, value, ttl=None):
+        """
+        Stores "value" for "key" for "ttl" seconds (the cache's "ttl" if
+        None).
+        """
+        if ttl is None:
+            ttl = self.ttl
+        LRUCache.put(self, key, (time.time() + ttl, value))
+
+    def pop(self, key, default=None):
+        """
+        Removes the entry for "key" and returns its value, or "default" if
+        there is no entry or it expired.
+        """
+        entry = LRUCache.pop(self, key)
+        if entry is None or entry[0] <= time.time():
+            return default
+        return entry[1]
+
+    def items(self):
+        """
+        Returns a list of (key, value) tuples of the entries that didn't
+        expire, from the least to the most recently used one.
+        """
+        now = time.time()
+        return [(key, value) for key, (expires, value)
+                in LRUCache.items(self) if expires > now]
@@ -0,0 +1,435 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+import collections
+import hashlib
+import os
+import socket
+import sqlite3
+import threading
+import time
+import zlib
+from gerritevent import options
+from gerritevent.idempotency import fingerprint
+from gerritevent.metrics import Metrics
+
+
+class LeaseStore(object):
+    """
+    Base class for the stores through which the members of a cluster find
+    each other and lease partitions. All methods must be atomic across the
+    processes sharing the store.
+    """
+    def heartbeat(self, node, ttl):
+        """
+        Announces that "node" is alive for the next "ttl" seconds.
+        """
+        raise NotImplementedError()
+
+    def leave(self, node):
+        """
+        Announces that "node" left the cluster.
+        """
+        raise NotImplementedError()
+
+    def nodes(self):
+        """
+        Returns the sorted list of live nodes.
+        """
+        raise NotImplementedError()
+
+    def acquire(self, partition, node, ttl):
+        """
+        Leases "partition" to "node" for "ttl" seconds unless another node
+        holds it. Returns a tuple of True and the watermark the previous
+        owner left or of False and None.
+        """
+        raise NotImplementedError()
+
+    def renew(self, watermarks, node, ttl):
+        """
+        Extends the leases of "node" on the partitions that are the keys of
+        the dictionary "watermarks" and stores the watermarks that aren't
+        None. Returns the set of partitions "node" still holds.
+        """
+        raise NotImplementedError()
+
+    def release(self, partition, node, watermark):
+        """
+        Gives up the lease of "node" on "partition", leaving "watermark" for
+        the next owner.
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        """
+        Releases the connection to the store.
+        """
+        pass
+
+
+class SQLiteLeaseStore(LeaseStore):
+    """
+    Keeps the leases in the SQLite database "path". Good for nodes on one
+    host or on a file system with working locks, and for tests.
+    """
+    def __init__(self, path):
+        """
+        Opens (and if needed creates) the store at "path".
+        """
+        LeaseStore.__init__(self)
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, timeout=30,
+                                    check_same_thread=False,
+                                    isolation_level=None)
+        self.__db.execute("CREATE TABLE IF NOT EXISTS nodes "
+                          "(node TEXT PRIMARY KEY, expires REAL)")
+        self.__db.execute("CREATE TABLE IF NOT EXISTS leases "
+                          "(partition INTEGER PRIMARY KEY, owner TEXT, "
+                          "expires REAL, watermark TEXT)")
+
+    def heartbeat(self, node, ttl):
+        with self.__lock:
+            self.__db.execute("INSERT OR REPLACE INTO nodes VALUES (?, ?)",
+                              (node, time.time() + ttl))
+
+    def leave(self, node):
+        with self.__lock:
+            self.__db.execute("DELETE FROM nodes WHERE node = ?", (node,))
+
+    def nodes(self):
+        with self.__lock:
+            rows = self.__db.execute(
+                "SELECT node FROM nodes WHERE expires > ? ORDER BY node",
+                (time.time(),)).fetchall()
+        return [row[0] for row in rows]
+
+    def acquire(self, partition, node, ttl):
+        now = time.time()
+        with self.__lock:
+            self.__db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.__db.execute(
+                    "SELECT owner, expires, watermark FROM leases "
+                    "WHERE partition = ?", (partition,)).fetchone()
+                watermark = None
+                if row is not None:
+                    owner, expires, watermark = row
+                    if owner not in (None, node) and expires > now:
+                        return False, None
+                self.__db.execute(
+                    "INSERT OR REPLACE INTO leases VALUES (?, ?, ?, ?)",
+                    (partition, node, now + ttl, watermark))
+                return True, watermark
+            finally:
+                self.__db.execute("COMMIT")
+
+    def renew(self, watermarks, node, ttl):
+        expires = time.time() + ttl
+        held = set()
+        with self.__lock:
+            self.__db.execute("BEGIN IMMEDIATE")
+            try:
+                for partition, watermark in watermarks.items():
+                    cursor = self.__db.execute(
+                        "UPDATE leases SET expires = ?, "
+                        "watermark = COALESCE(?, watermark) "
+                        "WHERE partition = ? AND owner = ?",
+                        (expires, watermark, partition, node))
+                    if cursor.rowcount:
+                        held.add(partition)
+            finally:
+                self.__db.execute("COMMIT")
+        return held
+
+    def release(self, partition, node, watermark):
+        with self.__lock:
+            self.__db.execute(
+                "UPDATE leases SET owner = NULL, expires = 0, "
+                "watermark = COALESCE(?, watermark) "
+                "WHERE partition = ? AND owner = ?",
+                (watermark, partition, node))
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
+
+
+class ClusterMember(object):
+    """
+    Lets several dispatchers that read the same Gerrit stream share the
+    work: the events are hash-partitioned into "partitions" by project or
+    by change number ("partition_by") and every partition is leased to one
+    live node of the "store" at a time, chosen by rendezvous hashing, so
+    that each node handles its share and only a few partitions move when
+    a node joins or leaves. Nodes renew their leases every third of "ttl"
+    seconds; the partitions of a node that stops doing so are taken over
+    by the others.
+    The owner of a partition leaves a watermark, the fingerprint of the
+    last event it handled, in the store. Every node keeps the last events
+    of all partitions ("buffer_size" in total), so a new owner hands the
+    events after the watermark to "sink" before it accepts new ones. On a
+    planned hand-over the old owner first finishes its in-flight events.
+    Delivery is at-least-once: after a crash, the events the dead node
+    handled since its last renewal are handled again, and so are the
+    events a new owner can't place before the watermark because it's not
+    in its buffer (yet). Handlers with side effects that must not repeat
+    need an IdempotencyStore. Events are never dropped unless they are
+    known to be handled.
+    """
+    def __init__(self, store, sink, node=None, partitions=64,
+                 partition_by="project", ttl=10.0, buffer_size=10000,
+                 metrics=None):
+        """
+        Constructs a ClusterMember. Call start() to join the cluster.
+        """
+        object.__init__(self)
+        if partition_by not in ("project", "change"):
+            raise ValueError("partition_by must be project or change")
+        self.store = store
+        self.__sink = sink
+        if node is None:
+            node = "%s-%d" % (socket.gethostname(), os.getpid())
+        self.node = node
+        self.partitions = partitions
+        self.__partition_by = partition_by
+        self.ttl = ttl
+        self.__buffer_length = max(1, buffer_size // partitions)
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.__lock = threading.Lock()
+        self.__owned = set()
+        self.__draining = set()
+        self.__inflight = {}
+        self.__accepted = {}
+        self.__buffers = {}
+        self.__skip = {}
+        # Maps the partitions being taken over to the events accepted
+        # meanwhile, which are handed to the sink after the replayed ones.
+        self.__taking = {}
+        self.__stopping = threading.Event()
+        self.__thread = None
+
+    @classmethod
+    def from_config(cls, config, sink, metrics=None, store=None):
+        """
+        Returns a ClusterMember configured by the "cluster" config section:
+        "lease_file" (the SQLiteLeaseStore, unless a "store" is given),
+        "node" (host name and process ID), "partitions" (64),
+        "partition_by" ("project" or "change"), "lease_ttl" (10 seconds)
+        and "buffer_size" (10000 events).
+        """
+        section = "cluster"
+        if store is None:
+            store = SQLiteLeaseStore(config.get(section, "lease_file"))
+        return cls(store, sink,
+                   options.get(config, section, "node"),
+                   options.getint(config, section, "partitions", 64),
+                   options.get(config, section, "partition_by", "project"),
+                   options.getfloat(config, section, "lease_ttl", 10.0),
+                   options.getint(config, section, "buffer_size", 10000),
+                   metrics)
+
+    def start(self):
+        """
+        Joins the cluster, takes over the first partitions and keeps the
+        leases up to date in a background thread.
+        """
+        self.rebalance()
+        self.__thread = threading.Thread(target=self.__run,
+                                         name="ClusterMember-" + self.node)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        """
+        Releases all partitions and leaves the cluster. Call it after the
+        accepted events were handled.
+        """
+        self.__stopping.set()
+        if self.__thread is not None:
+            self.__thread.join()
+        with self.__lock:
+            held = self.__owned | self.__draining
+            self.__owned = set()
+            self.__draining = set()
+            watermarks = {}
+            for partition in held:
+                # Unhandled events are left to the next owner.
+                watermarks[partition] = None
+                if not self.__inflight.get(partition):
+                    watermarks[partition] = self.__accepted.get(partition)
+        for partition, watermark in watermarks.items():
+            self.store.release(partition, self.node, watermark)
+        self.store.leave(self.node)
+        self.store.close()
+
+    def owned(self):
+        """
+        Returns the set of partitions whose events this node accepts.
+        """
+        with self.__lock:
+            return set(self.__owned)
+
+    def partition(self, event):
+        """
+        Returns the partition of "event".
+        """
+        change = event.get("change") or {}
+        key = None
+        if self.__partition_by == "change":
+            key = change.get("number")
+        if key is None:
+            key = change.get("project") or \
+                (event.get("refUpdate") or {}).get("project")
+        return (zlib.crc32(str(key)) & 0xffffffff) % self.partitions
+
+    def accept(self, event):
+        """
+        Remembers "event" and returns True if this node has to handle it.
+        Call done() once it was handled.
+        """
+        partition = self.partition(event)
+        mark = fingerprint(event)
+        with self.__lock:
+            buffer = self.__buffers.get(partition)
+            if buffer is None:
+                buffer = collections.deque(maxlen=self.__buffer_length)
+                self.__buffers[partition] = buffer
+            buffer.append((mark, event))
+            taking = self.__taking.get(partition)
+            if taking is not None:
+                taking.append((mark, event))
+                return False
+            if partition not in self.__owned:
+                return False
+            if self.__skip.get(partition) == mark:
+                # The previous owner handled it; the events before it were
+                # accepted and are left to the idempotency store.
+                del self.__skip[partition]
+                self.metrics.increment("cluster.skipped")
+                return False
+            self.__inflight[partition] = \
+                self.__inflight.get(partition, 0) + 1
+            self.__accepted[partition] = mark
+            return True
+
+    def done(self, event):
+        """
+        Records that the accepted "event" was handled.
+        """
+        partition = self.partition(event)
+        with self.__lock:
+            self.__inflight[partition] -= 1
+
+    def rebalance(self):
+        """
+        Renews the leases, gives up the partitions that belong to other
+        nodes now and takes over the partitions that belong to this one.
+        """
+        self.store.heartbeat(self.node, self.ttl)
+        live = self.store.nodes()
+        if self.node not in live:
+            live.append(self.node)
+        targets = set(partition for partition in range(self.partitions)
+                      if self.__owner(partition, live) == self.node)
+        with self.__lock:
+            held = self.__owned | self.__draining
+            watermarks = {}
+            for partition in held:
+                watermarks[partition] = None
+                if not self.__inflight.get(partition):
+                    watermarks[partition] = self.__accepted.get(partition)
+        still_held = self.store.renew(watermarks, self.node, self.ttl)
+        releasable = []
+        with self.__lock:
+            for partition in held - still_held:
+                self.metrics.increment("cluster.leases_lost")
+                self.__owned.discard(partition)
+                self.__draining.discard(partition)
+            for partition in self.__owned - targets:
+                self.__owned.discard(partition)
+                self.__draining.add(partition)
+            for partition in list(self.__draining):
+                if not self.__inflight.get(partition):
+                    self.__draining.discard(partition)
+                    releasable.append(partition)
+        for partition in releasable:
+            self.store.release(partition, self.node,
+                               self.__accepted.get(partition))
+        for partition in targets - held:
+            acquired, watermark = self.store.acquire(partition, self.node,
+                                                     self.ttl)
+            if acquired:
+                self.__take(partition, watermark)
+        self.metrics.gauge("cluster.partitions", len(self.owned()))
+
+    def __take(self, partition, watermark):
+        """
+        Starts accepting the events of "partition" after handing the
+        buffered events after "watermark" to the sink. The sink is called
+        without holding the lock; events that arrive meanwhile are handed
+        to it after the replayed ones.
+        """
+        with self.__lock:
+            replay = []
+            if watermark is not None:
+                buffer = list(self.__buffers.get(partition, ()))
+                marks = [mark for mark, _event in buffer]
+                if watermark in marks:
+                    replay = buffer[marks.index(watermark) + 1:]
+                else:
+                    # Either this node is behind the previous owner and the
+                    # watermark is still to come, or it left the buffer
+                    # (e.g. after a restart). Nothing proves that any other
+                    # event was handled, so only the watermark is skipped.
+                    self.__skip[partition] = watermark
+            self.metrics.increment("cluster.replayed", len(replay))
+            if not replay:
+                self.__owned.add(partition)
+                return
+            self.__taking[partition] = []
+            self.__count(partition, replay)
+        while replay:
+            for _mark, event in replay:
+                self.__sink(event)
+            with self.__lock:
+                replay = self.__taking.pop(partition)
+                if replay:
+                    self.__taking[partition] = []
+                    self.__count(partition, replay)
+                else:
+                    self.__owned.add(partition)
+
+    def __count(self, partition, events):
+        """
+        Counts the (mark, event) tuples "events" as accepted and in flight.
+        Called with the lock held.
+        """
+        for mark, _event in events:
+            self.__inflight[partition] = \
+                self.__inflight.get(partition, 0) + 1
+            self.__accepted[partition] = mark
+
+    def __owner(self, partition, nodes):
+        """
+        Returns the node of "nodes" that "partition" belongs to.
+        """
+        return max(nodes, key=lambda node: hashlib.md5(
+            "%s:%d" % (node, partition)).hexdigest())
+
+    def __run(self):
+        """
+        Rebalances until stopped.
+        """
+        while not self.__stopping.is_set():
+            self.__stopping.wait(self.ttl / 3)
+            if self.__stopping.is_set():
+                break
+            try:
+                self.rebalance()
+            except Exception, ex:
+                print((str(self)) + " Failed to rebalance: " + str(ex))
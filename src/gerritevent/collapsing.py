@@ -0,0 +1,155 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+import threading
+import time
+from gerritevent import options
+from gerritevent.gerrit_events import GerritRefUpdatedBulkEvent
+from gerritevent.metrics import Metrics
+
+# The type of the events a RefUpdateCollapser hands out.
+BULK_TYPE = GerritRefUpdatedBulkEvent.type
+
+
+def bulk_event(project, events):
+    """
+    Returns the "ref-updated-bulk" event dictionary of the "ref-updated"
+    "events" of "project", as GerritRefUpdatedBulkEvent decodes it.
+    """
+    return {"type": BULK_TYPE, "project": project,
+            "refUpdates": [event["refUpdate"] for event in events]}
+
+
+class RefUpdateCollapser(object):
+    """
+    Collapses the "ref-updated" events of each project into one
+    "ref-updated-bulk" event, since a mirror sync or tag push emits hundreds
+    of them within seconds. A project's bulk is handed to the callable
+    "sink", together with the list of events it was made of, "window"
+    seconds after its first event, or at once when it holds "max_size"
+    events, whichever comes first. A quiet project's single event becomes
+    a bulk of one.
+    The events are counted in "metrics" as "ref_updates.collapsed" and the
+    bulks as "ref_updates.bulks".
+    """
+    def __init__(self, sink, window=2.0, max_size=500, metrics=None):
+        """
+        Constructs a RefUpdateCollapser. Call start() to hand out the bulks
+        whose window passed.
+        """
+        object.__init__(self)
+        self.__sink = sink
+        self.window = window
+        self.max_size = max(1, max_size)
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.__condition = threading.Condition()
+        # Maps the projects to their (deadline, events).
+        self.__pending = {}
+        self.__stopping = False
+        self.__thread = None
+
+    @classmethod
+    def from_config(cls, config, sink, metrics=None):
+        """
+        Returns a RefUpdateCollapser configured by "ref_update_window" (2.0
+        seconds) and "ref_update_max_size" (500 events) of the "dispatcher"
+        config section.
+        """
+        section = "dispatcher"
+        return cls(sink,
+                   options.getfloat(config, section, "ref_update_window", 2.0),
+                   options.getint(config, section, "ref_update_max_size", 500),
+                   metrics)
+
+    def start(self):
+        """
+        Starts the thread that hands out the bulks whose window passed.
+        """
+        self.__thread = threading.Thread(target=self.__run,
+                                         name="RefUpdateCollapser")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def add(self, event):
+        """
+        Adds the "ref-updated" event dictionary to its project's bulk.
+        """
+        project = event.get("refUpdate", {}).get("project")
+        full = None
+        with self.__condition:
+            deadline, events = self.__pending.get(project, (None, None))
+            if events is None:
+                deadline, events = time.time() + self.window, []
+                self.__pending[project] = (deadline, events)
+                self.__condition.notify()
+            events.append(event)
+            if len(events) >= self.max_size:
+                del self.__pending[project]
+                full = events
+        self.metrics.increment("ref_updates.collapsed")
+        if full is not None:
+            self.__hand_out(project, full)
+
+    def pending(self):
+        """
+        Returns the number of events waiting in bulks.
+        """
+        with self.__condition:
+            return sum(len(events) for _, events in self.__pending.values())
+
+    def stop(self):
+        """
+        Stops the thread and returns the (bulk, events) tuples that are
+        still pending, so that the caller can hand them out itself.
+        """
+        with self.__condition:
+            self.__stopping = True
+            pending, self.__pending = self.__pending, {}
+            self.__condition.notify()
+        if self.__thread is not None:
+            self.__thread.join()
+        bulks = []
+        for project, (deadline, events) in sorted(pending.items(),
+                                                  key=lambda item: item[1][0]):
+            self.metrics.increment("ref_updates.bulks")
+            bulks.append((bulk_event(project, events), events))
+        return bulks
+
+    def __hand_out(self, project, events):
+        """
+        Hands the bulk of "events" to the sink.
+        """
+        self.metrics.increment("ref_updates.bulks")
+        try:
+            self.__sink(bulk_event(project, events), events)
+        except Exception, ex:
+            print("Failed to hand out ref updates of %s: %s"
+                  % (project, str(ex)))
+
+    def __run(self):
+        """
+        Hands out each bulk once its window passed, until stopped.
+        """
+        while True:
+            due = []
+            with self.__condition:
+                if self.__stopping:
+                    return
+                now = time.time()
+                for project, entry in list(self.__pending.items()):
+                    if entry[0] <= now:
+                        due.append((entry[0], project, entry[1]))
+                        del self.__pending[project]
+                if not due:
+                    deadlines = [deadline for deadline, _
+                                 in self.__pending.values()]
+                    if deadlines:
+                        self.__condition.wait(min(deadlines) - now)
+                    else:
+                        self.__condition.wait()
+            for _, project, events in sorted(due):
+                self.__hand_out(project, events)
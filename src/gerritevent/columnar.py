@@ -0,0 +1,215 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+import array
+import json
+import sys
+if sys.version_info < (3, 0):
+    from itertools import izip as zip
+
+# Seconds per day, for grouping by the "day" key.
+_DAY = 86400
+
+
+class StringDictionary(object):
+    """
+    Encodes strings as small integer codes. Each distinct string is stored
+    only once, in "values", at the index of its code.
+    """
+    def __init__(self):
+        """
+        Constructs an empty StringDictionary.
+        """
+        object.__init__(self)
+        self.values = []
+        self.__codes = {}
+
+    def __len__(self):
+        """Returns the number of distinct strings."""
+        return len(self.values)
+
+    def encode(self, value):
+        """
+        Returns the code of "value", adding it if it is new.
+        """
+        code = self.__codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.__codes[value] = code
+            self.values.append(value)
+        return code
+
+    def lookup(self, value):
+        """
+        Returns the code of "value" or None if it wasn't encoded yet.
+        """
+        return self.__codes.get(value)
+
+    def decode(self, code):
+        """
+        Returns the string for "code".
+        """
+        return self.values[code]
+
+
+class EventColumns(object):
+    """
+    Holds a batch of events column by column instead of as one object per
+    event. Strings (type, project, branch, account) are dictionary encoded,
+    numbers (change number, patch set number, timestamp) are kept in
+    arrays; missing numbers are stored as -1. The timestamp is Gerrit's
+    "eventCreatedOn" or, for older Gerrit versions, the patch set's
+    "createdOn". The account is the one that caused the event (author,
+    uploader, submitter, ...).
+
+    >>> columns = EventColumns.from_lines(open('events.json'))
+    >>> columns.count_by(['project', 'day'], event_type='comment-added')
+    {(u'tools', 15628): 17, ...}
+    """
+
+    STRING_COLUMNS = ('type', 'project', 'branch', 'account')
+
+    NUMBER_COLUMNS = ('change_number', 'patchset', 'created_on')
+
+    # The keys of the account that caused the event, by preference.
+    ACCOUNT_KEYS = ('author', 'uploader', 'submitter', 'abandoner',
+                    'restorer')
+
+    def __init__(self):
+        """
+        Constructs empty EventColumns.
+        """
+        object.__init__(self)
+        self.dictionaries = {}
+        self.codes = {}
+        for name in EventColumns.STRING_COLUMNS:
+            self.dictionaries[name] = StringDictionary()
+            self.codes[name] = array.array('l')
+        self.numbers = {}
+        for name in EventColumns.NUMBER_COLUMNS:
+            self.numbers[name] = array.array('l')
+
+    @classmethod
+    def from_lines(cls, lines, skip_errors=True):
+        """
+        Returns EventColumns built from the JSON ``lines``. Lines that are
+        no valid JSON are skipped unless "skip_errors" is False.
+        """
+        columns = cls()
+        columns.extend_lines(lines, skip_errors)
+        return columns
+
+    def __len__(self):
+        """Returns the number of events."""
+        return len(self.codes['type'])
+
+    def extend_lines(self, lines, skip_errors=True):
+        """
+        Parses the JSON ``lines`` and appends them.
+        """
+        loads = json.loads
+        append = self.append
+        for line in lines:
+            try:
+                dct = loads(line)
+            except ValueError:
+                if not skip_errors:
+                    raise
+                continue
+            append(dct)
+
+    def append(self, dct):
+        """
+        Appends the event dictionary ``dct``.
+        """
+        change = dct.get('change') or dct.get('refUpdate') or {}
+        patchset = dct.get('patchSet') or {}
+        account = None
+        for key in EventColumns.ACCOUNT_KEYS:
+            if key in dct:
+                account = dct[key].get('email') or dct[key].get('name')
+                break
+        created_on = dct.get('eventCreatedOn', patchset.get('createdOn', -1))
+        codes = self.codes
+        dictionaries = self.dictionaries
+        codes['type'].append(dictionaries['type'].encode(dct.get('type')))
+        codes['project'].append(
+            dictionaries['project'].encode(change.get('project')))
+        codes['branch'].append(
+            dictionaries['branch'].encode(change.get('branch')))
+        codes['account'].append(dictionaries['account'].encode(account))
+        numbers = self.numbers
+        numbers['change_number'].append(int(change.get('number', -1)))
+        numbers['patchset'].append(int(patchset.get('number', -1)))
+        numbers['created_on'].append(int(created_on))
+
+    def column(self, name):
+        """
+        Returns the values of column "name" as a list, decoding strings.
+        """
+        if name in self.numbers:
+            return self.numbers[name].tolist()
+        values = self.dictionaries[name].values
+        return [values[code] for code in self.codes[name]]
+
+    def count_by(self, keys, event_type=None):
+        """
+        Returns a dictionary mapping each distinct combination of the
+        "keys" columns to the number of events with it. Besides the column
+        names, "day" groups by the day of "created_on" (days since the
+        epoch). If "event_type" is given only events of that type count.
+        """
+        arrays = []
+        for key in keys:
+            if key == 'day':
+                arrays.append([t // _DAY for t in self.numbers['created_on']])
+            elif key in self.codes:
+                arrays.append(self.codes[key])
+            else:
+                arrays.append(self.numbers[key])
+        type_codes = self.codes['type']
+        wanted = None
+        if event_type is not None:
+            wanted = self.dictionaries['type'].lookup(event_type)
+            if wanted is None:
+                return {}
+        counts = {}
+        for index, row in enumerate(zip(*arrays)):
+            if wanted is not None and type_codes[index] != wanted:
+                continue
+            counts[row] = counts.get(row, 0) + 1
+        return self.__decode_keys(keys, counts)
+
+    def to_numpy(self):
+        """
+        Returns a dictionary of numpy arrays, one per column, plus the
+        dictionaries as "<column>_values" arrays. Requires numpy.
+        """
+        import numpy
+        result = {}
+        for name in EventColumns.STRING_COLUMNS:
+            result[name] = numpy.frombuffer(self.codes[name], dtype='l')
+            result[name + '_values'] = numpy.array(
+                self.dictionaries[name].values, dtype=object)
+        for name in EventColumns.NUMBER_COLUMNS:
+            result[name] = numpy.frombuffer(self.numbers[name], dtype='l')
+        return result
+
+    def __decode_keys(self, keys, counts):
+        """
+        Replaces the string codes in the keys of "counts" by the strings.
+        """
+        decoders = []
+        for key in keys:
+            if key in self.dictionaries:
+                decoders.append(self.dictionaries[key].values)
+            else:
+                decoders.append(None)
+        result = {}
+        for row, count in counts.items():
+            decoded = tuple([value if values is None else values[value]
+                             for value, values in zip(row, decoders)])
+            result[decoded] = count
+        return result
@@ -3,7 +3,62 @@ Copyright (c) 2012 GONICUS GmbH
 License: LGPL
 Author: Konrad Kleine <kleine@gonicus.de>
 """
+import json
 import threading
+import time
+from gerritevent import options
+from gerritevent import tracing
+from gerritevent.gerrit_events import GerritEvent
+from gerritevent.gerrit_events import GerritRefUpdatedBulkEvent
+from gerritevent.metrics import Metrics
+from gerritevent.resilience import CircuitBreaker
+from gerritevent.resilience import DeadLetterStore
+from gerritevent.resilience import HandlerGuard
+from gerritevent.scheduling import PriorityEventQueue
+from gerritevent.sshpool import GerritCommandPool
+from gerritevent.tracing import Tracer
+from gerritevent.workers import HandlerExecutor
+from gerritevent.workers import WorkerPool
+
+# Maps the Gerrit event types to the names of the Handler callbacks.
+_CALLBACKS = {
+    'patchset-created': 'patchset_created',
+    'change-abandoned': 'change_abandoned',
+    'change-restored': 'change_restored',
+    'change-merged': 'change_merged',
+    'comment-added': 'comment_added',
+    'ref-updated': 'ref_updated',
+    'ref-updated-bulk': 'ref_updated_bulk'
+}
+
+
+class _Completion(object):
+    """
+    Calls "done" once every call that was added() is done(), counting the
+    caller that creates it as the first one.
+    """
+    def __init__(self, done):
+        object.__init__(self)
+        self.__done = done
+        self.__lock = threading.Lock()
+        self.__pending = 1
+
+    def add(self):
+        """
+        Counts one more call.
+        """
+        with self.__lock:
+            self.__pending += 1
+
+    def done(self):
+        """
+        Records that one call is done.
+        """
+        with self.__lock:
+            self.__pending -= 1
+            finished = self.__pending == 0
+        if finished:
+            self.__done()
 
 
 class Dispatcher(threading.Thread):
@@ -12,20 +67,134 @@ class Dispatcher(threading.Thread):
     All handler should implement at least a subset of the gerritevent.Handler
     methods. If "endless" is True the dispatcher continuously re-connects to
     the Gerrit server and parses requests when an error occured.
+    The events are queued by priority and handed to the handlers by a
+    WorkerPool; each handler is called through a HandlerGuard from its own
+    HandlerExecutor, so a slow or failing handler holds up neither the
+    stream nor the other handlers. Call stop() to shut down without losing
+    the events that were already read.
+    The optional parts are configured by their sections (see
+    examples/config.conf.tpl) and exposed as attributes: "fanout",
+    "webhook", "cluster" (or pass a "lease_store"), "commands" (or pass a
+    GerritCommandPool), "enricher", "collapser", "profiler" and "tracer".
+    Without a "gerrit" section only submitted events are dispatched.
     This class was inspired by http://code.google.com/p/gerritbot/
     """
-    def __init__(self, config, handlers, endless=False):
+    def __init__(self, config, handlers, endless=False, metrics=None,
+                 lease_store=None, commands=None):
         """
         Constructs a dispatcher.
         """
         threading.Thread.__init__(self)
-        self.__host = config.get("gerrit", "host")
-        self.__port = config.getint("gerrit", "port")
-        self.__user = config.get("gerrit", "user")
-        self.__ssh_private_key = config.get("gerrit", "ssh_private_key")
-        self.__passphrase = config.get("gerrit", "passphrase")
+        self.__created = time.time()
+        self.__first_event = True
+        self.__host = None
+        self.__paramiko = None
+        self.__reconnect_delay = 5.0
+        if config.has_section("gerrit"):
+            try:
+                import paramiko
+                self.__paramiko = paramiko
+            except ImportError:
+                # Reported by _connect_to_gerrit().
+                pass
+            self.__host = config.get("gerrit", "host")
+            self.__port = config.getint("gerrit", "port")
+            self.__user = config.get("gerrit", "user")
+            self.__ssh_private_key = config.get("gerrit", "ssh_private_key")
+            self.__passphrase = config.get("gerrit", "passphrase")
+            self.__reconnect_delay = options.getfloat(
+                config, "gerrit", "reconnect_delay", 5.0)
         self.__handlers = handlers
         self.__endless = endless
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        if commands is None and self.__host is not None:
+            commands = GerritCommandPool.from_config(config, self.metrics)
+        if commands is not None and commands.connect is None:
+            commands.connect = lambda: self._connect_to_gerrit()
+        self.commands = commands
+        dead_letter_file = options.get(config, "dispatcher",
+                                       "dead_letter_file")
+        self.dead_letters = None
+        if dead_letter_file is not None:
+            self.dead_letters = DeadLetterStore(dead_letter_file)
+        self.profiler = None
+        cpu_clock = None
+        if config.has_section("profiler"):
+            from gerritevent import profiling
+            self.profiler = profiling.ProfilerService.from_config(
+                config, self.metrics)
+            if options.getboolean(config, "profiler", "account_cpu"):
+                cpu_clock = profiling.thread_cpu_time
+        limits = {}
+        for item in options.getlist(config, "dispatcher", "handler_limits"):
+            name, limit = item.rsplit(":", 1)
+            limits[name] = int(limit)
+        self.__guards = []
+        # Maps id() of the guards to their executors.
+        self.__executors = {}
+        for handler in handlers:
+            limit = getattr(handler, "max_concurrency", 1)
+            if not isinstance(limit, int):
+                limit = 1
+            breaker = CircuitBreaker(
+                options.getint(config, "dispatcher", "failure_threshold", 5),
+                options.getfloat(config, "dispatcher", "reset_timeout", 60.0))
+            limit = limits.get(type(handler).__name__, limit)
+            guard = HandlerGuard(
+                handler, self.metrics,
+                timeout=options.getfloat(config, "dispatcher",
+                                         "handler_timeout"),
+                breaker=breaker,
+                dead_letters=self.dead_letters,
+                limit=limit,
+                cpu_clock=cpu_clock)
+            self.__guards.append(guard)
+            self.__executors[id(guard)] = HandlerExecutor(
+                guard, limit,
+                options.getint(config, "dispatcher", "handler_backlog", 1000),
+                self.metrics)
+        self.__queue = PriorityEventQueue.from_config(config, self.metrics)
+        self.tracer = Tracer.from_config(config)
+        # Holds the _Completion of the event a worker dispatches.
+        self.__local = threading.local()
+        # The servers are only imported if they are configured, which keeps
+        # the start of short-lived jobs fast.
+        self.fanout = None
+        if config.has_section("fanout"):
+            from gerritevent.fanout import FanoutServer
+            self.fanout = FanoutServer.from_config(config, self.metrics)
+        self.webhook = None
+        if config.has_section("webhook"):
+            from gerritevent.webhook import WebhookReceiver
+            self.webhook = WebhookReceiver.from_config(config, self.submit,
+                                                       self.metrics)
+        self.enricher = None
+        if self.commands is not None and config.has_section("enrichment"):
+            from gerritevent.enrichment import Enricher
+            self.enricher = Enricher.from_config(config, self.commands.query,
+                                                 self.metrics)
+        self.collapser = None
+        if any(guard.bulk for guard in self.__guards):
+            from gerritevent.collapsing import RefUpdateCollapser
+            self.collapser = RefUpdateCollapser.from_config(
+                config, self.__put_bulk, self.metrics)
+        self.cluster = None
+        if lease_store is not None or config.has_section("cluster"):
+            from gerritevent.cluster import ClusterMember
+            self.cluster = ClusterMember.from_config(
+                config, self.__put, self.metrics, lease_store)
+        self.__stopping = threading.Event()
+        self.__deadline = None
+        self.__drained = False
+        self.__client = None
+        self.__client_lock = threading.Lock()
+        self.workers = WorkerPool.from_config(
+            config, self.__queue, self.__handle,
+            lambda: any(executor.saturated()
+                        for executor in self.__executors.values()),
+            self.metrics, self.getName() + "-worker")
 
     def run(self):
         """
@@ -34,25 +203,71 @@ class Dispatcher(threading.Thread):
         the Gerrit server and parses requests when an error occurred.
         Configure the "endless" parameter with the constructor.
         """
-        import time
-        while True:
+        for executor in self.__executors.values():
+            executor.start()
+        self.workers.start()
+        if self.collapser is not None:
+            self.collapser.start()
+        if self.fanout is not None:
+            self.fanout.start()
+        if self.cluster is not None:
+            self.cluster.start()
+        if self.webhook is not None:
+            self.webhook.start()
+        if self.profiler is not None:
+            self.profiler.start()
+        if self.__host is None:
+            self.__stopping.wait()
+        while not self.__stopping.is_set():
             try:
                 client = self._connect_to_gerrit()
-                self._read_stream(client)
-                self._disconnect_from_gerrit(client)
+                if self.__attach(client):
+                    self._read_stream(client)
             except Exception, ex:
-                print((str(self)) + " Unexpected: " + str(ex))
+                if not self.__stopping.is_set():
+                    print((str(self)) + " Unexpected: " + str(ex))
+            self.__disconnect()
             # End the loop if not in endless mode
-            if not self.__endless:
+            if not self.__endless or self.__stopping.is_set():
                 break
             print((str(self)) + " sleeping and wrapping around")
-            time.sleep(5)
+            self.__stopping.wait(self.__reconnect_delay)
+        self.__drain()
+
+    def stop(self, timeout=None):
+        """
+        Stops reading from Gerrit and shuts the dispatcher down.
+        Events that were already read are still handed to the handlers for
+        at most "timeout" seconds (or until done if "timeout" is None). Then
+        all handlers are closed and the SSH connection is shut down.
+        Returns True if all queued and in-flight events were handled in time.
+        """
+        if timeout is not None:
+            self.__deadline = time.time() + timeout
+        self.__stopping.set()
+        # Closing the connection wakes up the blocking read of the stream.
+        self.__disconnect()
+        if self.is_alive():
+            self.join(self.__remaining())
+        return self.__drained
+
+    def submit(self, event):
+        """
+        Queues the "event" dictionary for the handlers as if it had been read
+        from the stream. Used by the WebhookReceiver.
+        """
+        line = None
+        if self.fanout is not None:
+            line = json.dumps(event)
+        self.__enqueue(line, event, self.__start_trace("submit"))
 
     def _connect_to_gerrit(self):
         """
         SSH connects to the Gerrit server, using the credentials from the ctor.
         """
-        import paramiko
+        paramiko = self.__paramiko
+        if paramiko is None:
+            raise ImportError("paramiko is needed to connect to Gerrit")
         client = paramiko.SSHClient()
         client.load_system_host_keys()
         client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
@@ -71,30 +286,81 @@ class Dispatcher(threading.Thread):
         Informs all registered handlers by invoking the correct event callback.
         The handler in turn can do stuff like writing into a ticket system,
         IRC, Jabber, Twitter, etc. You name it!
+        Events of unknown types are ignored. Handlers with "bulk_ref_updates"
+        get the "ref-updated" events collapsed by the RefUpdateCollapser.
+        Called by a worker, the calls are queued to the handlers' executors;
+        otherwise they are made right away.
         """
-        for handler in self.__handlers:
-            _mapping = {
-                      'patchset-created': handler.patchset_created,
-                      'change-abandoned': handler.change_abandoned,
-                      'change-restored': handler.change_restored,
-                      'change-merged': handler.change_merged,
-                      'comment-added': handler.comment_added,
-                      'ref-updated': handler.ref_updated
-            }[event["type"]](event)
+        event_type = event.get("type")
+        callback = _CALLBACKS.get(event_type)
+        if callback is None:
+            self.metrics.increment("events_ignored")
+            return
+        guards = self.__guards
+        if event_type == GerritRefUpdatedBulkEvent.type:
+            guards = [guard for guard in guards if guard.bulk]
+        elif event_type == "ref-updated" and self.collapser is not None:
+            self.collapser.add(event)
+            guards = [guard for guard in guards if not guard.bulk]
+        completion = getattr(self.__local, "completion", None)
+        typed = None
+        for guard in guards:
+            if not guard.typed:
+                self.__call(guard, completion, callback, event)
+                continue
+            if typed is None:
+                typed = self.__decode(event)
+            if typed is not False:
+                self.__call(guard, completion, callback, typed, event)
+
+    def __call(self, guard, completion, callback, event, raw=None):
+        """
+        Queues the call to the guard's executor, counted by "completion", or
+        makes it right away if there is no completion.
+        """
+        if completion is None:
+            guard.call(callback, event, raw=raw)
+            return
+        completion.add()
+        self.__executors[id(guard)].submit(callback, event, raw,
+                                           completion.done)
+
+    def __decode(self, event):
+        """
+        Returns the GerritEvent object for the "event" dictionary or False
+        if it can't be decoded. Handlers with "typed_events" share it.
+        """
+        start = time.time()
+        try:
+            return GerritEvent.decode_dict(event)
+        except Exception, ex:
+            self.metrics.increment("events_undecodable")
+            print((str(self)) + " Failed to decode event: " + str(ex))
+            return False
+        finally:
+            self.metrics.timing("decode", time.time() - start)
 
     def _read_stream(self, client):
         """
-        Read lines from event stream and dispatch them as events to handlers.
+        Read lines from event stream and queue them as events for handlers.
         """
-        import json
         _stdin, stdout, _stderr = client.exec_command("gerrit stream-events")
         for line in stdout:
             print(line)
+            trace = self.__start_trace("stream")
+            if trace is not None:
+                span = trace.begin("decode", bytes=len(line))
             try:
                 event = json.loads(line)
-                self._dispatch_event(event)
             except ValueError:
-                pass
+                if trace is not None:
+                    trace.finish(outcome="malformed")
+                continue
+            if trace is not None:
+                trace.end(span)
+            self.__enqueue(line, event, trace)
+            if self.__stopping.is_set():
+                break
 
     def _disconnect_from_gerrit(self, client):
         """
@@ -102,3 +368,196 @@ class Dispatcher(threading.Thread):
         """
         print((str(self)) + " Disconnecting from " + str(self.__host))
         client.close()
+
+    def __start_trace(self, source):
+        """
+        Returns a new Trace for an event read from "source" or None if
+        tracing is off or the event isn't sampled.
+        """
+        if self.tracer is None:
+            return None
+        trace = self.tracer.start()
+        if trace is not None:
+            trace.end(trace.begin("read", source=source))
+        return trace
+
+    def __enqueue(self, line, event, trace=None):
+        """
+        Queues "event" for the workers and re-broadcasts its raw "line".
+        """
+        self.metrics.increment("events_read")
+        if self.fanout is not None:
+            self.fanout.broadcast(line, event)
+        if trace is not None:
+            span = trace.begin("filter")
+        if self.cluster is not None and not self.cluster.accept(event):
+            self.metrics.increment("events_not_owned")
+            if trace is not None:
+                trace.finish(type=event.get("type"), outcome="not_owned")
+            return
+        if trace is not None:
+            trace.end(span)
+        self.__put(event, trace)
+
+    def __put(self, event, trace=None):
+        """
+        Queues "event" for the workers together with its trace and the time
+        it was queued.
+        """
+        self.__queue.put((event, trace, time.time(), None), event)
+
+    def __put_bulk(self, bulk, events):
+        """
+        Queues the "bulk" the RefUpdateCollapser made of "events" for the
+        workers.
+        """
+        self.__queue.put((bulk, None, time.time(), events), bulk)
+
+    def __attach(self, client):
+        """
+        Remembers "client" as the current connection, so that stop() can
+        close it. Returns False if the dispatcher is already stopping.
+        """
+        with self.__client_lock:
+            self.__client = client
+        if self.commands is not None:
+            self.commands.share(client)
+        return not self.__stopping.is_set()
+
+    def __disconnect(self):
+        """
+        Disconnects the current connection (if any) exactly once.
+        """
+        with self.__client_lock:
+            client, self.__client = self.__client, None
+        if client is not None:
+            if self.commands is not None:
+                self.commands.unshare(client)
+            self._disconnect_from_gerrit(client)
+
+    def __remaining(self):
+        """
+        Returns the seconds left until the stop deadline or None if there is
+        no deadline.
+        """
+        if self.__deadline is None:
+            return None
+        return max(0.0, self.__deadline - time.time())
+
+    def __handle(self, item):
+        """
+        Enriches and dispatches a queued (event, trace, queued at, collapsed
+        events) item. Called by the workers. A failing handler is reported
+        but doesn't end the worker. The event is finished once the handlers'
+        executors made all its calls.
+        """
+        event, trace, queued, collapsed = item
+        if trace is not None:
+            trace.add("queue_wait", queued, time.time())
+            tracing.activate(trace)
+        completion = _Completion(
+            lambda: self.__finish(event, trace, collapsed))
+        self.__local.completion = completion
+        try:
+            if self.enricher is not None:
+                with tracing.span("enrich"):
+                    self.enricher.enrich(event)
+            self._dispatch_event(event)
+            self.metrics.increment("events_dispatched")
+            if self.__first_event:
+                self.__first_event = False
+                self.metrics.gauge("time_to_first_event",
+                                   time.time() - self.__created)
+        except Exception, ex:
+            self.metrics.increment("events_failed")
+            print((str(self)) + " Failed to dispatch event: " + str(ex))
+        self.__local.completion = None
+        if trace is not None:
+            tracing.activate(None)
+        completion.done()
+
+    def __finish(self, event, trace, collapsed=None):
+        """
+        Finishes the trace of "event" and tells the cluster it was handled.
+        A bulk tells it for the "collapsed" events it was made of, which
+        stay in flight until then.
+        """
+        if trace is not None:
+            trace.finish(type=event.get("type"))
+        if self.cluster is None:
+            return
+        if event.get("type") == GerritRefUpdatedBulkEvent.type:
+            for member in collapsed or []:
+                self.cluster.done(member)
+        elif event.get("type") != "ref-updated" or self.collapser is None:
+            self.cluster.done(event)
+
+    def __flush_ref_updates(self, drained):
+        """
+        Hands the ref update bulks that are still collapsing, and those that
+        were queued after the workers stopped, to the handlers. They are
+        dropped if the workers weren't "drained" in time; their events then
+        stay in flight, so that the cluster leaves them to the next owner.
+        """
+        bulks = self.collapser.stop()
+        if not drained:
+            left = sum(len(events) for _bulk, events in bulks)
+            self.metrics.increment("events_dropped", left)
+            return
+        queued = []
+        while self.__queue.qsize() > 0:
+            item = self.__queue.get()
+            if isinstance(item, tuple):
+                queued.append(item)
+        for bulk, events in bulks:
+            queued.append((bulk, None, time.time(), events))
+        for item in queued:
+            self.__handle(item)
+
+    def __drain(self):
+        """
+        Waits until the workers and the handlers' executors handled all
+        queued events (or the stop deadline passed), closes the handlers and
+        flushes the metrics.
+        """
+        if self.webhook is not None:
+            # Hands the accepted events to the queue before the workers stop.
+            self.webhook.stop()
+        self.workers.stop()
+        drained = self.workers.join(self.__remaining())
+        if not drained:
+            left = self.workers.backlog()
+            self.metrics.increment("events_dropped", left)
+            print((str(self)) + " Stop deadline passed, dropping %d events"
+                  % left)
+        if self.collapser is not None:
+            self.__flush_ref_updates(drained)
+        for executor in self.__executors.values():
+            executor.stop()
+        left = set()
+        for executor in self.__executors.values():
+            if not executor.join(self.__remaining()):
+                drained = False
+                left |= executor.queued()
+        if left:
+            self.metrics.increment("events_dropped", len(left))
+            print((str(self)) + " Stop deadline passed, dropping the "
+                  "handler calls of %d events" % len(left))
+        self.__drained = drained
+        if self.cluster is not None:
+            self.cluster.stop()
+        for handler in self.__handlers:
+            close = getattr(handler, "close", None)
+            if close is None:
+                continue
+            try:
+                close()
+            except Exception, ex:
+                print((str(self)) + " Failed to close handler: " + str(ex))
+        if self.fanout is not None:
+            self.fanout.stop()
+        if self.profiler is not None:
+            self.profiler.stop()
+        if self.commands is not None:
+            self.commands.close()
+        print((str(self)) + " Metrics: " + str(self.metrics.snapshot()))
@@ -0,0 +1,116 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+import threading
+import time
+from gerritevent import options
+from gerritevent.cache import TTLCache
+from gerritevent.metrics import Metrics
+
+
+class _Lookup(object):
+    """
+    A query in progress that other callers for the same key wait for.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class Enricher(object):
+    """
+    Adds the data that stream events lack (files, topic, reviewers, the
+    full commit message, ...) to the events before they are dispatched,
+    so that handlers don't each have to ask Gerrit for it.
+    For every (change, patch set) the callable "query" (usually
+    GerritCommandPool.query) is called once with "change:<number>" and the
+    "flags" (e.g. "--current-patch-set", "--files"); the change dictionary
+    it returns is attached to the event as "enrichment" (and as the
+    attribute of that name to the GerritEvent handed to handlers with
+    "typed_events"). The key isn't part of the event's fingerprint, so
+    enriched redeliveries are still recognized. Results are cached
+    for "ttl" seconds, at most "max_size" of them. Concurrent lookups of the
+    same key wait for the first one instead of querying again.
+    """
+    def __init__(self, query, flags=("--current-patch-set",), ttl=300.0,
+                 max_size=1000, metrics=None):
+        """
+        Constructs an Enricher.
+        """
+        object.__init__(self)
+        self.__query = query
+        self.__flags = tuple(flags)
+        self.__cache = TTLCache(max_size, ttl)
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.__lock = threading.Lock()
+        self.__lookups = {}
+
+    @classmethod
+    def from_config(cls, config, query, metrics=None):
+        """
+        Returns an Enricher configured by "flags" (e.g. "--current-patch-set
+        --files --all-reviewers --commit-message"), "ttl" (300 seconds) and
+        "max_size" (1000) of the "enrichment" config section.
+        """
+        section = "enrichment"
+        return cls(query,
+                   options.getlist(config, section, "flags",
+                                   ["--current-patch-set"]),
+                   options.getfloat(config, section, "ttl", 300.0),
+                   options.getint(config, section, "max_size", 1000),
+                   metrics)
+
+    def enrich(self, event):
+        """
+        Attaches the change data as "enrichment" to the "event" dictionary
+        if it belongs to a change and the data could be fetched.
+        """
+        change = event.get("change")
+        if not change or "number" not in change:
+            return
+        patchset = (event.get("patchSet") or {}).get("number")
+        data = self.lookup(change["number"], patchset)
+        if data is not None:
+            event["enrichment"] = data
+
+    def lookup(self, number, patchset=None):
+        """
+        Returns the change dictionary for the change "number" at "patchset"
+        or None if Gerrit doesn't return it.
+        """
+        key = (str(number), str(patchset))
+        data = self.__cache.get(key)
+        if data is not None:
+            self.metrics.increment("enrichment.hits")
+            return data
+        with self.__lock:
+            lookup = self.__lookups.get(key)
+            first = lookup is None
+            if first:
+                lookup = _Lookup()
+                self.__lookups[key] = lookup
+        if not first:
+            self.metrics.increment("enrichment.coalesced")
+            lookup.done.wait()
+            return lookup.result
+        self.metrics.increment("enrichment.misses")
+        start = time.time()
+        try:
+            rows = self.__query("change:%s" % number, *self.__flags)
+            if rows:
+                lookup.result = rows[0]
+                self.__cache.put(key, rows[0])
+        except Exception, ex:
+            self.metrics.increment("enrichment.failures")
+            print((str(self)) + " Failed to query change " + str(number) +
+                  ": " + str(ex))
+        finally:
+            self.metrics.timing("enrichment", time.time() - start)
+            with self.__lock:
+                del self.__lookups[key]
+            lookup.done.set()
+        return lookup.result
@@ -0,0 +1,237 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+import gzip
+import json
+import os
+import sys
+import threading
+import time
+from gerritevent import options
+from gerritevent.columnar import EventColumns
+from gerritevent.handler import Handler
+if sys.version_info < (3, 0):
+    import Queue as queue
+else:
+    import queue
+
+# Put into the write queue to tell the writer to finish.
+_STOP = object()
+
+
+class ColumnarExportHandler(Handler):
+    """
+    Buffers all events as gerritevent.columnar.EventColumns and writes them
+    to compressed columnar files for analytics. Project, branch, account and
+    type are dictionary encoded in every format.
+    Configure it in the "export" config section:
+    "directory" (required) is where the files go. A file is written when
+    "max_events" (10000) are buffered or "flush_interval" (300) seconds
+    passed. "format" is "parquet" (needs pyarrow), "npz" (needs numpy),
+    "json" (gzipped JSON columns, no dependencies) or "auto" (the default)
+    for the first one available.
+    The files are written by a background thread, so the dispatcher never
+    waits for the disk.
+    """
+
+    FORMATS = ('parquet', 'npz', 'json')
+
+    def __init__(self, config):
+        """
+        Constructs a ColumnarExportHandler and starts its writer thread.
+        """
+        Handler.__init__(self, config)
+        self.__directory = config.get("export", "directory")
+        self.__max_events = options.getint(config, "export", "max_events",
+                                           10000)
+        self.__flush_interval = options.getfloat(config, "export",
+                                                 "flush_interval", 300.0)
+        self.format = options.get(config, "export", "format", "auto")
+        if self.format == "auto":
+            self.format = self.__available_format()
+        elif self.format not in ColumnarExportHandler.FORMATS:
+            raise ValueError('format must be one of %s or auto'
+                             % ", ".join(ColumnarExportHandler.FORMATS))
+        self.__lock = threading.Lock()
+        self.__columns = EventColumns()
+        self.__started = time.time()
+        self.__sequence = 0
+        self.__queue = queue.Queue()
+        self.__writer = threading.Thread(target=self.__write_loop,
+                                         name="ColumnarExport-writer")
+        self.__writer.daemon = True
+        self.__writer.start()
+
+    def patchset_created(self, event):
+        """Buffers the event."""
+        self.__add(event)
+
+    def change_abandoned(self, event):
+        """Buffers the event."""
+        self.__add(event)
+
+    def change_restored(self, event):
+        """Buffers the event."""
+        self.__add(event)
+
+    def change_merged(self, event):
+        """Buffers the event."""
+        self.__add(event)
+
+    def comment_added(self, event):
+        """Buffers the event."""
+        self.__add(event)
+
+    def ref_updated(self, event):
+        """Buffers the event."""
+        self.__add(event)
+
+    def flush(self):
+        """
+        Hands the buffered events to the writer thread.
+        """
+        with self.__lock:
+            columns = self.__swap()
+        if columns is not None:
+            self.__queue.put(columns)
+
+    def close(self):
+        """
+        Writes the buffered events and waits for the writer to finish.
+        """
+        self.flush()
+        self.__queue.put(_STOP)
+        self.__writer.join()
+
+    def __add(self, event):
+        """
+        Appends "event" to the buffer and flushes it if it is full.
+        """
+        with self.__lock:
+            self.__columns.append(event)
+            if len(self.__columns) < self.__max_events:
+                return
+            columns = self.__swap()
+        self.__queue.put(columns)
+
+    def __swap(self):
+        """
+        Returns the buffer (or None if it is empty) and starts a new one.
+        The caller must hold the lock.
+        """
+        self.__started = time.time()
+        if len(self.__columns) == 0:
+            return None
+        columns, self.__columns = self.__columns, EventColumns()
+        return columns
+
+    def __write_loop(self):
+        """
+        Writes the buffers handed over by the dispatcher and flushes the
+        buffer every "flush_interval" seconds.
+        """
+        while True:
+            with self.__lock:
+                wait = self.__started + self.__flush_interval - time.time()
+            try:
+                columns = self.__queue.get(timeout=max(0.01, wait))
+            except queue.Empty:
+                with self.__lock:
+                    if time.time() - self.__started < self.__flush_interval:
+                        continue
+                    columns = self.__swap()
+                if columns is None:
+                    continue
+            if columns is _STOP:
+                break
+            try:
+                self.__write(columns)
+            except Exception, ex:
+                print("Failed to export %d events: %s" % (len(columns), ex))
+
+    def __write(self, columns):
+        """
+        Writes "columns" to a new file in the configured format.
+        """
+        self.__sequence += 1
+        path = os.path.join(self.__directory, "events-%d-%04d.%s" % (
+            int(time.time()), self.__sequence,
+            {'parquet': 'parquet', 'npz': 'npz', 'json': 'json.gz'}[
+                self.format]))
+        tmp_path = path + ".tmp"
+        if self.format == 'parquet':
+            self.__write_parquet(columns, tmp_path)
+        elif self.format == 'npz':
+            self.__write_npz(columns, tmp_path)
+        else:
+            self.__write_json(columns, tmp_path)
+        os.rename(tmp_path, path)
+
+    def __write_parquet(self, columns, path):
+        """
+        Writes a Parquet file with dictionary columns for the strings.
+        """
+        import pyarrow
+        import pyarrow.parquet
+        data = {}
+        for name in EventColumns.STRING_COLUMNS:
+            data[name] = pyarrow.DictionaryArray.from_arrays(
+                pyarrow.array(columns.codes[name].tolist(),
+                              type=pyarrow.int32()),
+                pyarrow.array(columns.dictionaries[name].values,
+                              type=pyarrow.string()))
+        for name in EventColumns.NUMBER_COLUMNS:
+            data[name] = pyarrow.array(columns.numbers[name].tolist(),
+                                       type=pyarrow.int64())
+        pyarrow.parquet.write_table(pyarrow.Table.from_pydict(data), path,
+                                    compression='snappy')
+
+    def __write_npz(self, columns, path):
+        """
+        Writes a compressed numpy .npz file. The dictionaries are stored as
+        "<column>_values" string arrays (None becomes an empty string).
+        """
+        import numpy
+        arrays = columns.to_numpy()
+        for name in EventColumns.STRING_COLUMNS:
+            arrays[name + '_values'] = numpy.array(
+                [value or u'' for value in columns.dictionaries[name].values],
+                dtype=numpy.unicode_)
+        output = open(path, "wb")
+        try:
+            numpy.savez_compressed(output, **arrays)
+        finally:
+            output.close()
+
+    def __write_json(self, columns, path):
+        """
+        Writes the columns and dictionaries as gzipped JSON.
+        """
+        data = {"dictionaries": {}, "columns": {}}
+        for name in EventColumns.STRING_COLUMNS:
+            data["dictionaries"][name] = columns.dictionaries[name].values
+            data["columns"][name] = columns.codes[name].tolist()
+        for name in EventColumns.NUMBER_COLUMNS:
+            data["columns"][name] = columns.numbers[name].tolist()
+        output = gzip.open(path, "wb")
+        try:
+            output.write(json.dumps(data).encode("utf-8"))
+        finally:
+            output.close()
+
+    def __available_format(self):
+        """
+        Returns the best format whose library is installed.
+        """
+        try:
+            import pyarrow.parquet
+            return 'parquet'
+        except ImportError:
+            pass
+        try:
+            import numpy
+            return 'npz'
+        except ImportError:
+            return 'json'
@@ -0,0 +1,317 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+import collections
+import json
+import os
+import select
+import socket
+import sys
+import threading
+from gerritevent import options
+from gerritevent.metrics import Metrics
+from gerritevent.publisher import parse_address
+from gerritevent.scheduling import event_project
+if sys.version_info < (3, 0):
+    import BaseHTTPServer as httpserver
+    import SocketServer as socketserver
+    from urlparse import parse_qs, urlparse
+else:
+    import http.server as httpserver
+    import socketserver
+    from urllib.parse import parse_qs, urlparse
+
+
+class _Subscriber(object):
+    """
+    One consumer of the FanoutServer with its filter and bounded buffer.
+    The lines are queued as they were read from Gerrit; all subscribers
+    share the same string objects.
+    """
+
+    # Seconds between the checks whether an idle subscriber went away.
+    CHECK_INTERVAL = 0.5
+
+    def __init__(self, connection, types, projects, max_buffer, sse=False):
+        self.connection = connection
+        self.types = types
+        self.projects = projects
+        self.max_buffer = max_buffer
+        self.sse = sse
+        self.buffer = collections.deque()
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def matches(self, event):
+        """
+        Returns True if the subscriber wants "event".
+        """
+        if self.types and event.get("type") not in self.types:
+            return False
+        if self.projects and event_project(event) not in self.projects:
+            return False
+        return True
+
+    def offer(self, line):
+        """
+        Queues "line". Returns False if the buffer is full.
+        """
+        with self.condition:
+            if len(self.buffer) >= self.max_buffer:
+                return False
+            self.buffer.append(line)
+            self.condition.notify()
+        return True
+
+    def close(self):
+        """
+        Stops the subscriber; a blocked send is interrupted.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def disconnected(self):
+        """
+        Returns True if the subscriber closed its end of the connection.
+        Anything it sent meanwhile is discarded.
+        """
+        try:
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            return bool(readable) and not self.connection.recv(4096)
+        except (select.error, socket.error, ValueError):
+            return True
+
+    def run(self):
+        """
+        Sends the queued lines until closed or the connection breaks. While
+        idle, checks every CHECK_INTERVAL seconds whether the subscriber
+        went away.
+        """
+        while True:
+            with self.condition:
+                while not self.buffer and not self.closed:
+                    self.condition.wait(_Subscriber.CHECK_INTERVAL)
+                    if not self.buffer and self.disconnected():
+                        return
+                if self.closed:
+                    return
+                lines = list(self.buffer)
+                self.buffer.clear()
+            try:
+                for line in lines:
+                    if self.sse:
+                        self.connection.sendall(b"data: " + line.rstrip(b"\n")
+                                                + b"\n\n")
+                    else:
+                        self.connection.sendall(line)
+            except socket.error:
+                return
+
+
+class _SubscriberRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Serves one socket subscriber. The subscriber first sends one line, an
+    empty one for all events or a JSON filter like
+    {"types": ["change-merged"], "projects": ["tools"]}.
+    """
+
+    def handle(self):
+        line = self.rfile.readline().strip()
+        wanted = {}
+        if line:
+            try:
+                wanted = json.loads(line)
+            except ValueError:
+                return
+        self.server.fanout.serve(self.connection,
+                                 wanted.get("types"),
+                                 wanted.get("projects"))
+
+
+class _SSERequestHandler(httpserver.BaseHTTPRequestHandler):
+    """
+    Serves one Server-Sent Events subscriber. The filter is given as query
+    parameters, e.g. GET /events?type=change-merged&project=tools.
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/events":
+            self.send_error(404)
+            return
+        query = parse_qs(url.query)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.flush()
+        self.server.fanout.serve(self.connection, query.get("type"),
+                                 query.get("project"), sse=True)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingTCPServer(socketserver.ThreadingMixIn,
+                          socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _ThreadingUnixServer(socketserver.ThreadingMixIn,
+                           socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                           httpserver.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FanoutServer(object):
+    """
+    Re-broadcasts the raw lines of the dispatcher's Gerrit stream to any
+    number of local subscribers, so that they all share one SSH session.
+    Subscribers connect to "address" (a Unix socket "unix:/path" or
+    "host:port") and optionally to "sse_address" ("host:port") for
+    Server-Sent Events over HTTP. Each subscriber can filter by event types
+    and projects. A subscriber whose buffer of "max_buffer" lines runs full
+    is disconnected, so a slow consumer never holds up the stream or the
+    other subscribers.
+    """
+    def __init__(self, address=None, sse_address=None, max_buffer=1000,
+                 metrics=None):
+        """
+        Constructs a FanoutServer. Call start() to start serving.
+        """
+        object.__init__(self)
+        self.address = address
+        self.sse_address = sse_address
+        self.__max_buffer = max_buffer
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.__lock = threading.Lock()
+        self.__subscribers = []
+        self.__servers = []
+
+    @classmethod
+    def from_config(cls, config, metrics=None):
+        """
+        Returns a FanoutServer configured by "address", "sse_address" and
+        "max_buffer" of the "fanout" config section or None if neither
+        address is configured.
+        """
+        address = options.get(config, "fanout", "address")
+        sse_address = options.get(config, "fanout", "sse_address")
+        if address is None and sse_address is None:
+            return None
+        return cls(address, sse_address,
+                   options.getint(config, "fanout", "max_buffer", 1000),
+                   metrics)
+
+    def start(self):
+        """
+        Binds the sockets and starts serving in background threads.
+        """
+        if self.address is not None:
+            family, bind_address = parse_address(self.address)
+            if family == socket.AF_UNIX:
+                if os.path.exists(bind_address):
+                    os.unlink(bind_address)
+                server = _ThreadingUnixServer(bind_address,
+                                              _SubscriberRequestHandler)
+            else:
+                server = _ThreadingTCPServer(bind_address,
+                                             _SubscriberRequestHandler)
+                self.address = "%s:%d" % server.server_address
+            self.__serve(server)
+        if self.sse_address is not None:
+            _family, bind_address = parse_address(self.sse_address)
+            server = _ThreadingHTTPServer(bind_address, _SSERequestHandler)
+            self.sse_address = "%s:%d" % server.server_address
+            self.__serve(server)
+
+    def stop(self):
+        """
+        Disconnects all subscribers and stops serving.
+        """
+        for server in self.__servers:
+            server.shutdown()
+            server.server_close()
+        self.__servers = []
+        with self.__lock:
+            subscribers, self.__subscribers = self.__subscribers, []
+        for subscriber in subscribers:
+            subscriber.close()
+        if self.address is not None:
+            family, bind_address = parse_address(self.address)
+            if family == socket.AF_UNIX and os.path.exists(bind_address):
+                os.unlink(bind_address)
+
+    def subscriber_count(self):
+        """
+        Returns the number of connected subscribers.
+        """
+        with self.__lock:
+            return len(self.__subscribers)
+
+    def broadcast(self, line, event):
+        """
+        Queues the raw "line" for every subscriber whose filter matches the
+        parsed "event". Never blocks on a subscriber.
+        """
+        if not line.endswith(b"\n"):
+            line += b"\n"
+        with self.__lock:
+            subscribers = list(self.__subscribers)
+        for subscriber in subscribers:
+            if not subscriber.matches(event):
+                continue
+            if not subscriber.offer(line):
+                self.metrics.increment("fanout.evicted")
+                self.__remove(subscriber)
+                subscriber.close()
+
+    def serve(self, connection, types=None, projects=None, sse=False):
+        """
+        Registers a subscriber on "connection" and sends it the broadcast
+        lines until it goes away. Called by the request handlers.
+        """
+        subscriber = _Subscriber(connection, set(types or []),
+                                 set(projects or []), self.__max_buffer, sse)
+        with self.__lock:
+            self.__subscribers.append(subscriber)
+            self.metrics.gauge("fanout.subscribers", len(self.__subscribers))
+        try:
+            subscriber.run()
+        finally:
+            self.__remove(subscriber)
+
+    def __remove(self, subscriber):
+        """
+        Unregisters "subscriber".
+        """
+        with self.__lock:
+            if subscriber in self.__subscribers:
+                self.__subscribers.remove(subscriber)
+            self.metrics.gauge("fanout.subscribers", len(self.__subscribers))
+
+    def __serve(self, server):
+        """
+        Runs "server" in a background thread.
+        """
+        server.fanout = self
+        self.__servers.append(server)
+        thread = threading.Thread(target=server.serve_forever,
+                                  name="FanoutServer")
+        thread.daemon = True
+        thread.start()
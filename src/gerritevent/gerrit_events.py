@@ -9,6 +9,7 @@ from gerritevent.gerrit_objects import GerritChange
 from gerritevent.gerrit_objects import GerritPatchSet
 from gerritevent.gerrit_objects import GerritAccount
 from gerritevent.gerrit_objects import GerritRefUpdate
+from gerritevent.gerrit_objects import DecodeError as GerritObjectDecodeError
 
 
 class Error(Exception):
@@ -27,6 +28,12 @@ class GerritEvent(object):
     Each GerritEvent sublass consists of one ore more gerrit objects.
     """
 
+    # The Gerrit event type, e.g. "patchset-created", set by each subclass.
+    type = None
+
+    # The change data gerritevent.enrichment.Enricher attached or None.
+    enrichment = None
+
     def __init__(self):
         """Creates a Gerrit Event object."""
         object.__init__(self)
@@ -38,6 +45,23 @@ class GerritEvent(object):
         >>> event_string = '{"type":"patchset-created", ...}'
         >>> event = GerritEvent.decode(event_string)
         
+        Args:
+            json_event: A JSON string as emitted by stream-events
+            
+        Returns:
+            Depending on the specific event type an object sublassed from
+            GerritEvent is returned.
+            
+        Raises:
+            gerrit_objects.DecodeError: If a GerritObject fails to decode.
+            gerrit_events.DecodeError: If a GerritEvent fails to decode.
+        """
+        return GerritEvent.decode_dict(json.loads(s=json_event))
+
+    @classmethod
+    def decode_dict(cls, dct):
+        """Decodes and returns an event from the already parsed ``dct``.
+        
         Args:
             dct: A dictionary from JSON
             
@@ -49,25 +73,71 @@ class GerritEvent(object):
             gerrit_objects.DecodeError: If a GerritObject fails to decode.
             gerrit_events.DecodeError: If a GerritEvent fails to decode.
         """
-        dct = json.loads(s=json_event)
-        if dct['type'] == 'patchset-created':
-            return GerritPatchSetCreatedEvent.decode(dct)
-        elif dct['type'] == 'change-abandoned':
-            return GerritChangeAbandonedEvent.decode(dct)
-        elif dct['type'] == 'change-restored':
-            return GerritChangeRestoredEvent.decode(dct)
-        elif dct['type'] == 'change-merged':
-            return GerritChangeMergedEvent.decode(dct)
-        elif dct['type'] == 'comment-added':
-            return GerritCommentAddedEvent.decode(dct)
-        elif dct['type'] == 'ref-updated':
-            return GerritRefUpdatedEvent.decode(dct)
-        else:
+        event_class = EVENT_CLASSES.get(dct.get('type'))
+        if event_class is None:
             raise DecodeError('Failed to decode event.')
+        event = event_class.decode(dct)
+        if 'enrichment' in dct:
+            event.enrichment = dct['enrichment']
+        return event
+
+    @classmethod
+    def decode_many(cls, lines, skip_errors=False):
+        """Decodes and returns a list of events from the JSON ``lines``.
+        
+        The lines are parsed first and then decoded grouped by event type,
+        so the decoder of each type is looked up only once per batch. The
+        events are returned in the order of ``lines``. For analytics over
+        large archives see gerritevent.columnar.EventColumns, which doesn't
+        build an object per event at all.
+        
+        >>> events = GerritEvent.decode_many(open('events.json'))
+        
+        Args:
+            lines: An iterable of JSON strings as emitted by stream-events
+            skip_errors: If True, lines that fail to parse or decode are left
+                out instead of raising an error.
+            
+        Returns:
+            A list of objects subclassed from GerritEvent.
+            
+        Raises:
+            ValueError: If a line isn't valid JSON.
+            gerrit_objects.DecodeError: If a GerritObject fails to decode.
+            gerrit_events.DecodeError: If a GerritEvent fails to decode.
+        """
+        loads = json.loads
+        dcts = []
+        for line in lines:
+            try:
+                dcts.append(loads(line))
+            except ValueError:
+                if not skip_errors:
+                    raise
+        groups = {}
+        for index, dct in enumerate(dcts):
+            groups.setdefault(dct.get('type'), []).append(index)
+        events = [None] * len(dcts)
+        for event_type, indexes in groups.items():
+            event_class = EVENT_CLASSES.get(event_type)
+            if event_class is None:
+                if skip_errors:
+                    continue
+                raise DecodeError('Failed to decode event.')
+            decode = event_class.decode
+            for index in indexes:
+                try:
+                    events[index] = decode(dcts[index])
+                except (DecodeError, GerritObjectDecodeError, ValueError):
+                    if not skip_errors:
+                        raise
+        return [event for event in events if event is not None]
 
 
 class GerritPatchSetCreatedEvent(GerritEvent):
     """Represents a patchset-created event in Gerrit."""
+
+    type = 'patchset-created'
     
     def __init__(self, change, patch_set, uploader):
         """Creates a GerritPatchSetCreatedEvent object from given parameters.
@@ -135,6 +205,8 @@ class GerritPatchSetCreatedEvent(GerritEvent):
 class GerritChangeAbandonedEvent(GerritEvent):
     """Represents a change-abandoned event in Gerrit."""
 
+    type = 'change-abandoned'
+
     def __init__(self, change, abandoner, reason):
         """Creates a GerritChangeAbandonedEvent object from given parameters.
         
@@ -201,6 +273,8 @@ class GerritChangeAbandonedEvent(GerritEvent):
 class GerritChangeRestoredEvent(GerritEvent):
     """Represents a change-restored event in Gerrit."""
 
+    type = 'change-restored'
+
     def __init__(self, change, restorer, reason):
         """Creates a GerritChangeRestoredEvent object from given parameters.
         
@@ -267,6 +341,8 @@ class GerritChangeRestoredEvent(GerritEvent):
 class GerritChangeMergedEvent(GerritEvent):
     """Represents a change-merged event in Gerrit."""
 
+    type = 'change-merged'
+
     def __init__(self, change, patch_set, submitter):
         """Creates a GerritChangeMergedEvent object from given parameters.
         
@@ -303,7 +379,7 @@ class GerritChangeMergedEvent(GerritEvent):
         """
         if name == 'change' and type(value) != GerritChange:
             raise ValueError('%s must be a GerritChange' % name)
-        elif name == 'patch_ser' and type(value) != GerritPatchSet:
+        elif name == 'patch_set' and type(value) != GerritPatchSet:
             raise ValueError('%s must be a GerritPatchSet' % name)
         elif name == 'submitter' and type(value) != GerritAccount:
             raise ValueError('%s must be a GerritAccount' % name)
@@ -334,6 +410,8 @@ class GerritChangeMergedEvent(GerritEvent):
 class GerritRefUpdatedEvent(GerritEvent):
     """Represents a ref-updated event in Gerrit."""
 
+    type = 'ref-updated'
+
     def __init__(self, ref_update):
         """Creates a GerritRefUpdatedEvent object from given parameters.
         
@@ -388,6 +466,80 @@ class GerritRefUpdatedEvent(GerritEvent):
             raise DecodeError(ex)
 
 
+class GerritRefUpdatedBulkEvent(GerritEvent):
+    """Represents a burst of ref-updated events of one project.
+    
+    This is no Gerrit event. The dispatcher collapses the ref-updated events
+    of a project into one of these for handlers with "bulk_ref_updates".
+    """
+
+    type = 'ref-updated-bulk'
+
+    def __init__(self, project, ref_updates):
+        """Creates a GerritRefUpdatedBulkEvent object from given parameters.
+        
+        Args:
+            project: The name of the project whose refs were updated.
+            ref_updates: A list of GerritRefUpdate objects in the order of
+                the ref-updated events.
+        
+        Returns:
+            An instanciated GerritRefUpdatedBulkEvent object
+
+        Raises:
+            ValueError: If any of the paramters have a wrong type
+        """
+        GerritEvent.__init__(self)
+        self.project = project
+        self.ref_updates = ref_updates
+    
+    def __setattr__(self, name, value):
+        """Sets the object's attribute ``name`` to ``value``.
+        
+        Args:
+            name: A string representing the name of the attribute that's about
+                to be changed
+            value: The new value for the attribute
+        
+        Returns:
+            -
+        
+        Raises:
+            ValueError: If the attribute's value and type fails. 
+        """
+        if name == 'project' and type(value) not in (str, unicode):
+            raise ValueError('%s must be a string' % name)
+        elif name == 'ref_updates':
+            if type(value) != list:
+                raise ValueError('%s must be a list' % name)
+            for ref_update in value:
+                if type(ref_update) != GerritRefUpdate:
+                    raise ValueError('each ref update must be a GerritRefUpdate')
+        object.__setattr__(self, name, value)
+    
+    @classmethod
+    def decode(cls, dct):
+        """Returns a GerritRefUpdatedBulkEvent object decoded from ``dct``.
+        
+        Args:
+            dct: Dictionary with all values required to initalise a
+                GerritRefUpdatedBulkEvent object.
+        
+        Returns:
+            A fully initialised GerritRefUpdatedBulkEvent object.
+            
+        Raises:
+            DecodeError: If ``dct`` does't contain all required keys
+        """
+        try:
+            ref_updates = [GerritRefUpdate.decode(ref_update)
+                           for ref_update in dct['refUpdates']]
+            return GerritRefUpdatedBulkEvent(project=dct['project'],
+                                             ref_updates=ref_updates)
+        except KeyError, ex:
+            raise DecodeError(ex)
+
+
 class GerritCommentAddedEvent(GerritEvent):
     """Represents a comment-added event in Gerrit.
     
@@ -395,6 +547,8 @@ class GerritCommentAddedEvent(GerritEvent):
     publishes her comments.
     """
 
+    type = 'comment-added'
+
     def __init__(self, approvals, comment, change, author, patch_set):
         """Creates a GerritCommentAddedEvent object from given parameters.
         
@@ -475,3 +629,14 @@ class GerritCommentAddedEvent(GerritEvent):
         except KeyError, ex:
             raise DecodeError(ex)
 
+
+# Maps each Gerrit event type to its GerritEvent subclass.
+EVENT_CLASSES = dict((event_class.type, event_class) for event_class in [
+    GerritPatchSetCreatedEvent,
+    GerritChangeAbandonedEvent,
+    GerritChangeRestoredEvent,
+    GerritChangeMergedEvent,
+    GerritCommentAddedEvent,
+    GerritRefUpdatedEvent,
+    GerritRefUpdatedBulkEvent
+])
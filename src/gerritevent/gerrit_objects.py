@@ -161,7 +161,7 @@ class GerritPatchSet(GerritObject):
         self.number = number
         self.revision = revision
         self.ref = ref
-        self.uploder = uploader
+        self.uploader = uploader
         self.created_on = created_on
         
     def __setattr__(self, name, value):
@@ -189,8 +189,8 @@ class GerritPatchSet(GerritObject):
             raise ValueError('%s must be a string' % name)
         elif name == 'uploader' and type(value) != GerritAccount:
             raise ValueError('%s must be a GerritAccount' % name)
-        elif name == 'created_on' and type(value) != int:
-            raise ValueError('%s must be a string' % name)
+        elif name == 'created_on' and type(value) not in (int, long):
+            raise ValueError('%s must be an int' % name)
         object.__setattr__(self, name, value)
     
     @classmethod
@@ -277,7 +277,10 @@ class GerritRefUpdate(GerritObject):
 
 class GerritApproval(GerritObject):
     """Represents an approval in Gerrit.
-    TODO(kleine): Add documentation for CODEREVIEW and VERIFIED strings.
+
+    ``_type`` is the label of the approval. Older Gerrit versions use the
+    short types CODEREVIEW and VERIFIED, newer ones and custom labels use
+    the label name (e.g. "Code-Review").
     """
 
     CODEREVIEW = 'CRVW'
@@ -286,6 +289,8 @@ class GerritApproval(GerritObject):
     
     types = [CODEREVIEW, VERIFIED]
 
+    label_names = {CODEREVIEW: 'Code-Review', VERIFIED: 'Verified'}
+
     def __init__(self, value, _type, description):
         """Initializes a GerritApproval object from the given parameters."""
         GerritObject.__init__(self)
@@ -312,8 +317,8 @@ class GerritApproval(GerritObject):
                 value = int(value)
             except ValueError:
                 raise ValueError('%s must be an int' % name)
-        elif name == '_type' and value not in GerritApproval.types:
-            raise ValueError('%s must be in GerritApproval.types' % name)
+        elif name == '_type' and type(value) not in (str, unicode):
+            raise ValueError('%s must be a string' % name)
         elif name == 'description' and type(value) not in (str, unicode):
             raise ValueError('%s must be a string' % name)
         object.__setattr__(self, name, value)
@@ -342,3 +347,24 @@ class GerritApproval(GerritObject):
                 raise DecodeError(ex)
             approvals.append(approval)
         return approvals
+
+    @classmethod
+    def label_name(cls, _type):
+        """Returns the label name for ``_type``, e.g. "Verified" for VERIFIED.
+
+        Custom labels are returned unchanged.
+        """
+        return cls.label_names.get(_type, _type)
+
+    @classmethod
+    def by_type(cls, approvals):
+        """Returns a dictionary mapping each type to its GerritApproval.
+
+        Args:
+            approvals: A list of GerritApproval objects as returned by
+                decode().
+
+        Returns:
+            A dictionary with the ``_type`` of each approval as key.
+        """
+        return dict((approval._type, approval) for approval in approvals)
@@ -3,6 +3,23 @@ Copyright (c) 2012 GONICUS GmbH
 License: LGPL
 Author: Konrad Kleine <kleine@gonicus.de>
 """
+import json
+import re
+import sys
+import threading
+from string import Template
+from gerritevent import options
+from gerritevent import tracing
+from gerritevent.gerrit_objects import GerritApproval
+from gerritevent.ratelimit import RateLimiter
+if sys.version_info < (3, 0):
+    from urllib import urlencode
+else:
+    from urllib.parse import urlencode
+
+# An issue ID is characterized by a "#" follow by a number ranging from 1 to
+# 99999999999999999999. Should be enough, eh?!
+_ISSUE_ID = re.compile(r"#(\d{1,20})", re.MULTILINE)
 
 
 class Handler(object):
@@ -11,14 +28,35 @@ class Handler(object):
     Please have a look at this URL, to see the attributes available for each
     event:
     http://gerrit.googlecode.com/svn/documentation/2.1.2/cmd-stream-events.html
+    By default the callbacks get the event as the dictionary parsed from
+    Gerrit's JSON. Subclasses that set "typed_events" to True get the
+    matching gerritevent.gerrit_events.GerritEvent object instead. The
+    dispatcher decodes each event only once for all of these handlers.
+    The dispatcher calls each handler from threads of its own, at most
+    "max_concurrency" callbacks at the same time (unless the
+    "handler_limits" of the "dispatcher" config section say otherwise).
+    Handlers whose callbacks are thread-safe may raise it.
+    Subclasses that set "bulk_ref_updates" to True get the "ref-updated"
+    events of each project collapsed into one ref_updated_bulk() call
+    instead of one ref_updated() call each (see the "ref_update_window" and
+    "ref_update_max_size" of the "dispatcher" config section).
     """
+
+    typed_events = False
+
+    max_concurrency = 1
+
+    bulk_ref_updates = False
+
     def __init__(self, config):
         """
         Constructs a Handler object.
         """
         object.__init__(self)
-        self.__comment_added_template = config.get("redmine",
-                                                   "comment_added_template")
+        template = options.get(config, "redmine", "comment_added_template")
+        self.__comment_added_template = None
+        if template is not None:
+            self.__comment_added_template = Template(template)
 
     def patchset_created(self, event):
         """
@@ -56,20 +94,34 @@ class Handler(object):
         """
         pass
 
+    def ref_updated_bulk(self, event):
+        """
+        Gets called with the collapsed "ref-updated" events of one project if
+        "bulk_ref_updates" is True. The event has the "project" and the list
+        of "refUpdates" in the order they were updated.
+        """
+        pass
+
+    def close(self):
+        """
+        Gets called once when the dispatcher shuts down, after the last event
+        was handled. Handlers that buffer or checkpoint anything should flush
+        it here.
+        """
+        pass
+
     def _prepare_comment_added_template(self, event):
         """
         Returns formatted "comment-added" template with substituted values.
         """
-        from string import Template
-        tpl = Template(self.__comment_added_template)
-        return tpl.substitute(
+        return self.__comment_added_template.substitute(
             comment_author_name=event["author"]["name"],
             comment_author_email=event["author"]["email"],
             comment=event["comment"],
             change_url=event["change"]["url"],
             change_subject=event["change"]["subject"],
-            approvals_verified_value=event["approvals"][0]["value"],  # FIX idx
-            approvals_review_value=event["approvals"][1]["value"],  # FIX idx
+            approvals_verified_value=self.__approval(event, "Verified"),
+            approvals_review_value=self.__approval(event, "Code-Review"),
             change_owner_name=event["change"]["owner"]["name"],
             change_owner_email=event["change"]["owner"]["email"],
             change_number=event["change"]["number"],
@@ -84,6 +136,17 @@ class Handler(object):
             patchset_created_on=event["patchSet"]["createdOn"]
         )
 
+    def __approval(self, event, label):
+        """
+        Returns the value of the approval for "label" in the event or an
+        empty string if the event has none. Short types like "VRIF" match
+        their label name.
+        """
+        for approval in event.get("approvals") or []:
+            if GerritApproval.label_name(approval["type"]) == label:
+                return approval["value"]
+        return ""
+
 
 class RedmineHandler(Handler):
     """
@@ -93,48 +156,149 @@ class RedmineHandler(Handler):
     or the subject of the change to be reviewed.
     See: http://www.redmine.org/
     See: http://www.redmine.org/projects/redmine/wiki/Rest_api
+    The PUTs to Redmine can be throttled with the "rate_limit" options of the
+    "redmine" config section (see RateLimiter.from_config).
+    If the "idempotency" config section has a "file" (or an "idempotency"
+    store is given), comments that were already added for an event aren't
+    added again when the event is delivered once more
+    (see IdempotencyStore.from_config).
+    With "validate_issues" in the "redmine" config section, only issues
+    that exist get comments: they are looked up in batches at "issues_url"
+    (the issues.json next to "issue_url") and cached for "issue_ttl"
+    (3600) seconds, missing ones for "missing_issue_ttl" (300) seconds.
+    The optional "redmine_projects" config section (which implies
+    "validate_issues") maps Gerrit projects to the Redmine projects (names
+    or IDs) whose issues their changes may comment on, e.g.
+    "tools: Tools, 7".
     """
-    def __init__(self, config):
+
+    # Redmine returns at most that many issues per request.
+    BATCH_SIZE = 100
+
+    # Each thread has its own connection to Redmine.
+    max_concurrency = 4
+
+    def __init__(self, config, metrics=None, idempotency=None):
         """
         Constructs a RedmineHandler object
         """
         Handler.__init__(self, config)
+        # Loaded here rather than at package import, so that only users of
+        # the RedmineHandler need httplib2.
+        import httplib2
+        self.__httplib2 = httplib2
+        self.__local = threading.local()
         self.__issue_url = config.get("redmine", "issue_url")
         self.__api_key = config.get("redmine", "api_key")
+        self.__limiter = RateLimiter.from_config(config, "redmine", metrics)
+        if idempotency is None and config.has_section("idempotency"):
+            from gerritevent.idempotency import IdempotencyStore
+            idempotency = IdempotencyStore.from_config(config, metrics)
+        self.__idempotency = idempotency
+        self.__issues = None
+        if options.getboolean(config, "redmine", "validate_issues") or \
+                config.has_section("redmine_projects"):
+            from gerritevent.issues import IssueDirectory
+            self.__issues_url = options.get(
+                config, "redmine", "issues_url",
+                self.__issue_url.rsplit("/issues/", 1)[0] + "/issues.json")
+            self.__issues = IssueDirectory(
+                self.__fetch_issues,
+                options.getfloat(config, "redmine", "issue_ttl", 3600.0),
+                options.getfloat(config, "redmine", "missing_issue_ttl",
+                                 300.0),
+                metrics=metrics)
+        self.__projects = {}
+        if config.has_section("redmine_projects"):
+            for project in config.options("redmine_projects"):
+                names = config.get("redmine_projects", project).split(",")
+                self.__projects[project] = set(name.strip()
+                                               for name in names)
 
     def __get_issue_ids(self, string):
         """
-        Returns as list of issue ID that occured in the string.
-        An issue ID is characterized by a "#" follow by a number ranging
-        from 1 to 99999999999999999999. Should be enough, eh?!
+        Returns as list of issue ID that occured in the string, without
+        leading zeros, so that they match the IDs Redmine returns.
+        """
+        return [str(int(issue_id)) for issue_id in _ISSUE_ID.findall(string)]
+
+    def __valid_issue_ids(self, issue_ids, project):
+        """
+        Returns the IDs of "issue_ids" that exist and belong to a Redmine
+        project the Gerrit "project" may comment on.
+        """
+        allowed = self.__projects.get(project.lower())
+        valid = []
+        for issue_id, redmine_project in \
+                self.__issues.lookup(issue_ids).items():
+            if redmine_project is None:
+                continue
+            if allowed is not None and \
+                    str(redmine_project.get("id")) not in allowed and \
+                    redmine_project.get("name") not in allowed:
+                continue
+            valid.append(issue_id)
+        return valid
+
+    def __fetch_issues(self, issue_ids):
+        """
+        Returns a dictionary that maps the existing issues of "issue_ids" to
+        their Redmine project.
         """
-        import re
-        matches = re.findall(r"#(\d{1,20})", string, re.MULTILINE)
-        return matches
+        projects = {}
+        for start in range(0, len(issue_ids), RedmineHandler.BATCH_SIZE):
+            batch = issue_ids[start:start + RedmineHandler.BATCH_SIZE]
+            query = urlencode({"issue_id": ",".join(batch),
+                               "status_id": "*",
+                               "limit": RedmineHandler.BATCH_SIZE})
+            with tracing.span("http.GET", url=self.__issues_url,
+                              issues=len(batch)):
+                response, content = self.__http().request(
+                    uri=self.__issues_url + "?" + query,
+                    method='GET',
+                    headers={'X-Redmine-API-Key': self.__api_key})
+            if response.status >= 300:
+                raise IOError("Redmine answered %d to the issue lookup"
+                              % response.status)
+            for issue in json.loads(content).get("issues", []):
+                projects[str(issue["id"])] = issue.get("project", {})
+        return projects
 
     def __add_comment(self, issue_id, comment):
         """
         Adds the comment to the Redmine issue with ID issueID.
+        Returns True if Redmine accepted it.
         """
-        import httplib2
-        http = httplib2.Http()
-        response, content = http.request(
-             uri=self.__issue_url % int(issue_id),
-             method='PUT',
-             body=comment,
-             headers={
-                'X-Redmine-API-Key': self.__api_key,
-                'Content-type': 'application/json'
-             }
-        )
+        uri = self.__issue_url % int(issue_id)
+        with tracing.span("http.PUT", url=uri):
+            response, content = self.__http().request(
+                 uri=uri,
+                 method='PUT',
+                 body=comment,
+                 headers={
+                    'X-Redmine-API-Key': self.__api_key,
+                    'Content-type': 'application/json'
+                 }
+            )
         print(response)
         print(content)
+        return response.status < 300
+
+    def __http(self):
+        """
+        Returns the httplib2.Http object of the calling thread, so that
+        connections to Redmine are reused.
+        """
+        http = getattr(self.__local, "http", None)
+        if http is None:
+            http = self.__httplib2.Http()
+            self.__local.http = http
+        return http
 
     def comment_added(self, event):
         """
         Translates gerrit comment event into Redmine issue comment.
         """
-        import json
         change_subject = str(event["change"]["subject"])
         comment = json.dumps({
             "issue": {
@@ -145,5 +309,28 @@ class RedmineHandler(Handler):
         subject_issue_ids = self.__get_issue_ids(change_subject)
         comment_issue_ids = self.__get_issue_ids(comment)
         issue_ids = list(set(subject_issue_ids + comment_issue_ids))
+        if issue_ids and self.__issues is not None:
+            issue_ids = self.__valid_issue_ids(issue_ids,
+                                               event["change"]["project"])
         for issue_id in issue_ids:
-            self.__add_comment(issue_id, comment)
+            key = None
+            if self.__idempotency is not None:
+                key = self.__idempotency.key("RedmineHandler", issue_id, event)
+                if not self.__idempotency.claim(key):
+                    continue
+            try:
+                if self.__limiter is not None:
+                    self.__limiter.acquire(target=issue_id,
+                                           event_type=event.get("type"))
+                if self.__add_comment(issue_id, comment) and key is not None:
+                    self.__idempotency.record(key)
+            finally:
+                if key is not None:
+                    self.__idempotency.release(key)
+
+    def close(self):
+        """
+        Closes the idempotency store.
+        """
+        if self.__idempotency is not None:
+            self.__idempotency.close()
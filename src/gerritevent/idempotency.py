@@ -0,0 +1,173 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from gerritevent import options
+from gerritevent.cache import LRUCache
+from gerritevent.metrics import Metrics
+
+
+# The keys gerritevent adds to the event dictionaries. They depend on when
+# and where an event is handled, so they aren't part of its fingerprint.
+LOCAL_KEYS = ("enrichment",)
+
+
+def fingerprint(event):
+    """
+    Returns a hash of the "event" dictionary that is the same for every
+    delivery of the event, whether it was enriched or not.
+    """
+    if any(key in event for key in LOCAL_KEYS):
+        event = dict((key, value) for key, value in event.items()
+                     if key not in LOCAL_KEYS)
+    return hashlib.sha1(json.dumps(event, sort_keys=True)).hexdigest()
+
+
+class IdempotencyStore(object):
+    """
+    Remembers which side effects were already performed, so that a handler
+    doesn't repeat them when an event is delivered again (after a reconnect,
+    a retry or a dead letter replay). Each side effect is identified by
+    key(), a hash of the handler, the target (e.g. an issue ID) and the
+    event's fingerprint. Keys are kept in the SQLite database "path" for
+    "ttl" seconds; the most recently used "max_cached" of them are also
+    kept in memory, so that checking a recent key doesn't touch the disk.
+    claim() makes the check and the side effect atomic within the process:
+    a second caller with the same key waits until the first one released
+    it, and then sees whether it was recorded. Usage:
+        key = store.key("RedmineHandler", issue_id, event)
+        if store.claim(key):
+            try:
+                ... perform the side effect ...
+                store.record(key)
+            finally:
+                store.release(key)
+    """
+
+    # Expired keys are deleted from the database every that many records.
+    PURGE_INTERVAL = 1000
+
+    def __init__(self, path, ttl=604800.0, max_cached=10000, metrics=None):
+        """
+        Opens (and if needed creates) the store at "path". Use ":memory:"
+        for a store that isn't persistent.
+        """
+        object.__init__(self)
+        self.path = path
+        self.ttl = ttl
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.__cache = LRUCache(max_cached)
+        self.__lock = threading.Lock()
+        self.__records = 0
+        self.__claims = threading.Condition()
+        self.__claimed = set()
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.execute("CREATE TABLE IF NOT EXISTS idempotency "
+                          "(key TEXT PRIMARY KEY, expires REAL)")
+        self.purge()
+
+    @classmethod
+    def from_config(cls, config, metrics=None):
+        """
+        Returns an IdempotencyStore configured by "file", "ttl" and
+        "max_cached" of the "idempotency" config section or None if there
+        is no file.
+        """
+        path = options.get(config, "idempotency", "file")
+        if path is None:
+            return None
+        return cls(path,
+                   options.getfloat(config, "idempotency", "ttl", 604800.0),
+                   options.getint(config, "idempotency", "max_cached", 10000),
+                   metrics)
+
+    def key(self, handler_name, target, event):
+        """
+        Returns the key of the side effect of "handler_name" on "target" for
+        the "event" dictionary.
+        """
+        return hashlib.sha1("%s\0%s\0%s" % (handler_name, target,
+                                            fingerprint(event))).hexdigest()
+
+    def seen(self, key):
+        """
+        Returns True if the side effect "key" was recorded and didn't expire.
+        """
+        now = time.time()
+        expires = self.__cache.get(key)
+        if expires is None:
+            with self.__lock:
+                row = self.__db.execute(
+                    "SELECT expires FROM idempotency WHERE key = ?",
+                    (key,)).fetchone()
+            if row is not None:
+                expires = row[0]
+                self.__cache.put(key, expires)
+        if expires is not None and expires > now:
+            self.metrics.increment("idempotency.hits")
+            return True
+        self.metrics.increment("idempotency.misses")
+        return False
+
+    def claim(self, key):
+        """
+        Waits until no other caller holds "key" and returns True if the side
+        effect wasn't recorded yet. The caller then holds the key and must
+        release() it.
+        """
+        with self.__claims:
+            while key in self.__claimed:
+                self.__claims.wait()
+            self.__claimed.add(key)
+        if self.seen(key):
+            self.release(key)
+            return False
+        return True
+
+    def release(self, key):
+        """
+        Lets the next caller claim "key".
+        """
+        with self.__claims:
+            self.__claimed.discard(key)
+            self.__claims.notify_all()
+
+    def record(self, key):
+        """
+        Records that the side effect "key" was performed.
+        """
+        expires = time.time() + self.ttl
+        self.__cache.put(key, expires)
+        with self.__lock:
+            self.__db.execute(
+                "INSERT OR REPLACE INTO idempotency VALUES (?, ?)",
+                (key, expires))
+            self.__db.commit()
+            self.__records += 1
+            purge = self.__records % IdempotencyStore.PURGE_INTERVAL == 0
+        if purge:
+            self.purge()
+
+    def purge(self):
+        """
+        Deletes the expired keys from the database.
+        """
+        with self.__lock:
+            self.__db.execute("DELETE FROM idempotency WHERE expires <= ?",
+                              (time.time(),))
+            self.__db.commit()
+
+    def close(self):
+        """
+        Closes the database.
+        """
+        with self.__lock:
+            self.__db.close()
@@ -0,0 +1,65 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+from gerritevent.cache import TTLCache
+from gerritevent.metrics import Metrics
+
+# Cached for issues the tracker doesn't know.
+_MISSING = False
+
+
+class IssueDirectory(object):
+    """
+    Caches which issue IDs exist in the issue tracker and which project
+    they belong to, so that handlers only write to real issues.
+    "fetch" is called with a list of issue IDs (strings) that aren't
+    cached and returns a dictionary that maps the existing ones to their
+    project (a dictionary like {"id": 3, "name": "Tools"}). Existing issues
+    are cached for "ttl" seconds and missing ones for "missing_ttl"
+    seconds, at most "max_size" of them.
+    """
+    def __init__(self, fetch, ttl=3600.0, missing_ttl=300.0, max_size=10000,
+                 metrics=None):
+        """
+        Constructs an empty IssueDirectory.
+        """
+        object.__init__(self)
+        self.__fetch = fetch
+        self.__missing_ttl = missing_ttl
+        self.__cache = TTLCache(max_size, ttl)
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+
+    def lookup(self, issue_ids):
+        """
+        Returns a dictionary that maps each of "issue_ids" to its project or
+        to None if there is no such issue. All uncached IDs are fetched with
+        one call. Exceptions of "fetch" are passed on.
+        """
+        projects = {}
+        unknown = []
+        for issue_id in issue_ids:
+            issue_id = str(issue_id)
+            project = self.__cache.get(issue_id)
+            if project is None:
+                unknown.append(issue_id)
+            elif project is _MISSING:
+                projects[issue_id] = None
+            else:
+                projects[issue_id] = project
+        self.metrics.increment("issues.hits", len(projects))
+        if not unknown:
+            return projects
+        self.metrics.increment("issues.misses", len(unknown))
+        found = self.__fetch(unknown)
+        for issue_id in unknown:
+            project = found.get(issue_id)
+            if project is None:
+                self.__cache.put(issue_id, _MISSING, self.__missing_ttl)
+            else:
+                self.__cache.put(issue_id, project)
+            projects[issue_id] = project
+        return projects
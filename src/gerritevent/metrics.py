@@ -0,0 +1,85 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+import threading
+
+
+class Metrics(object):
+    """
+    Thread-safe registry of counters, gauges and timings.
+    The dispatcher and the handlers record into a shared Metrics object and
+    anybody interested (a status page, a log line, a test) can take a
+    snapshot of the current values at any time.
+    """
+    def __init__(self):
+        """
+        Constructs an empty Metrics object.
+        """
+        object.__init__(self)
+        self.__lock = threading.Lock()
+        self.__counters = {}
+        self.__gauges = {}
+        self.__timings = {}
+        self.__sources = {}
+
+    def increment(self, name, value=1):
+        """
+        Adds "value" to the counter called "name".
+        """
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        """
+        Sets the gauge called "name" to "value".
+        """
+        with self.__lock:
+            self.__gauges[name] = value
+
+    def timing(self, name, seconds):
+        """
+        Records a duration in seconds for the timing called "name".
+        For each timing the count, the total and the maximum is kept.
+        """
+        with self.__lock:
+            count, total, maximum = self.__timings.get(name, (0, 0.0, 0.0))
+            self.__timings[name] = (count + 1,
+                                    total + seconds,
+                                    max(maximum, seconds))
+
+    def register(self, prefix, source):
+        """
+        Registers the callable "source" that returns a dictionary of values
+        computed on demand. Each snapshot includes them as
+        "<prefix>.<name>".
+        """
+        with self.__lock:
+            self.__sources[prefix] = source
+
+    def counter(self, name):
+        """
+        Returns the current value of the counter called "name".
+        """
+        with self.__lock:
+            return self.__counters.get(name, 0)
+
+    def snapshot(self):
+        """
+        Returns a dictionary with a copy of all current values.
+        Timings are reported as "<name>.count", "<name>.total" and
+        "<name>.max".
+        """
+        with self.__lock:
+            values = dict(self.__counters)
+            values.update(self.__gauges)
+            for name, (count, total, maximum) in self.__timings.items():
+                values[name + ".count"] = count
+                values[name + ".total"] = total
+                values[name + ".max"] = maximum
+            sources = list(self.__sources.items())
+        for prefix, source in sources:
+            for name, value in source().items():
+                values[prefix + "." + name] = value
+        return values
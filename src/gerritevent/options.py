@@ -0,0 +1,46 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+
+Helpers to read optional settings from a ConfigParser object.
+Each function returns ``default`` if the section or the option is missing.
+"""
+
+
+def get(config, section, option, default=None):
+    """Returns the string value of ``option`` in ``section``."""
+    if not config.has_option(section, option):
+        return default
+    return config.get(section, option)
+
+
+def getint(config, section, option, default=None):
+    """Returns the integer value of ``option`` in ``section``."""
+    if not config.has_option(section, option):
+        return default
+    return config.getint(section, option)
+
+
+def getfloat(config, section, option, default=None):
+    """Returns the float value of ``option`` in ``section``."""
+    if not config.has_option(section, option):
+        return default
+    return config.getfloat(section, option)
+
+
+def getboolean(config, section, option, default=False):
+    """Returns the boolean value of ``option`` in ``section``."""
+    if not config.has_option(section, option):
+        return default
+    return config.getboolean(section, option)
+
+
+def getlist(config, section, option, default=None):
+    """Returns the comma or whitespace separated values of ``option``."""
+    if not config.has_option(section, option):
+        if default is None:
+            return []
+        return default
+    value = config.get(section, option).replace(",", " ")
+    return value.split()
@@ -0,0 +1,306 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from gerritevent import options
+from gerritevent.metrics import Metrics
+from gerritevent.publisher import parse_address
+if sys.version_info < (3, 0):
+    import SocketServer as socketserver
+else:
+    import socketserver
+
+# The Linux value, for Pythons whose resource module doesn't name it.
+_RUSAGE_THREAD = 1
+
+
+def thread_cpu_time():
+    """
+    Returns the CPU seconds the calling thread used so far or None if the
+    platform can't tell.
+    """
+    clock_gettime = getattr(time, "clock_gettime", None)
+    if clock_gettime is not None and \
+            hasattr(time, "CLOCK_THREAD_CPUTIME_ID"):
+        return clock_gettime(time.CLOCK_THREAD_CPUTIME_ID)
+    if not sys.platform.startswith("linux"):
+        return None
+    import resource
+    usage = resource.getrusage(getattr(resource, "RUSAGE_THREAD",
+                                       _RUSAGE_THREAD))
+    return usage.ru_utime + usage.ru_stime
+
+
+def collapse(frame, root=None):
+    """
+    Returns the stack of "frame" in the collapsed format of flame graph
+    tools: the frames from the outermost to "frame" separated by ";",
+    starting with "root" if given.
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("%s (%s:%d)" % (code.co_name,
+                                     os.path.basename(code.co_filename),
+                                     code.co_firstlineno))
+        frame = frame.f_back
+    if root is not None:
+        names.append(root)
+    names.reverse()
+    return ";".join(names)
+
+
+class SamplingProfiler(object):
+    """
+    Finds out where the threads of a running dispatcher spend their time
+    by taking their stacks every "interval" seconds. Only the threads whose
+    name starts with one of "prefixes" are sampled (all but the profiler's
+    own if None). Nothing runs while no profile is taken.
+    """
+    def __init__(self, interval=0.01, prefixes=None, metrics=None):
+        """
+        Constructs a SamplingProfiler.
+        """
+        object.__init__(self)
+        self.__interval = interval
+        self.__prefixes = prefixes and tuple(prefixes)
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.__lock = threading.Lock()
+
+    def profile(self, seconds):
+        """
+        Samples the threads for "seconds" and returns a dictionary that maps
+        each collapsed stack (see collapse()) to the number of samples, or
+        None if another profile is being taken.
+        """
+        if not self.__lock.acquire(False):
+            return None
+        try:
+            return self.__profile(seconds)
+        finally:
+            self.__lock.release()
+
+    @staticmethod
+    def write(stacks, out):
+        """
+        Writes "stacks" as returned by profile() to the file-like "out", one
+        "<stack> <samples>" line each, as flamegraph.pl and speedscope read
+        them.
+        """
+        for stack, samples in sorted(stacks.items()):
+            out.write("%s %d\n" % (stack, samples))
+
+    def __profile(self, seconds):
+        """
+        Takes the samples. The caller must hold the lock.
+        """
+        own = threading.current_thread().ident
+        names = {}
+        stacks = {}
+        samples = 0
+        end = time.time() + seconds
+        while time.time() < end:
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                name = names.get(ident)
+                if name is None:
+                    names = dict((thread.ident, thread.name)
+                                 for thread in threading.enumerate())
+                    name = names.get(ident, str(ident))
+                if self.__prefixes is not None and \
+                        not name.startswith(self.__prefixes):
+                    continue
+                stack = collapse(frame, name)
+                stacks[stack] = stacks.get(stack, 0) + 1
+                samples += 1
+            time.sleep(self.__interval)
+        self.metrics.increment("profiler.samples", samples)
+        return stacks
+
+
+class _ProfilerRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Serves one request on the profiler socket. The client sends one line,
+    the seconds to profile (empty for the default), and gets the collapsed
+    stacks back. "cpu" returns the CPU seconds per handler as JSON instead.
+    """
+
+    def handle(self):
+        line = self.rfile.readline().strip()
+        service = self.server.service
+        if line == b"cpu":
+            self.wfile.write(json.dumps(service.cpu_times()).encode("utf-8"))
+            return
+        try:
+            seconds = float(line or service.seconds)
+        except ValueError:
+            self.wfile.write(b"error: expected seconds\n")
+            return
+        stacks = service.profiler.profile(seconds)
+        if stacks is None:
+            self.wfile.write(b"error: already profiling\n")
+            return
+        SamplingProfiler.write(stacks, self.wfile)
+
+
+class _ThreadingTCPServer(socketserver.ThreadingMixIn,
+                          socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _ThreadingUnixServer(socketserver.ThreadingMixIn,
+                           socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ProfilerService(object):
+    """
+    Takes profiles with a SamplingProfiler on demand: when the process gets
+    the signal "signum", a profile of "seconds" is written to
+    "<directory>/gerritevent-<pid>-<time>.folded"; a client of the socket at
+    "address" ("unix:/path" or "host:port") gets it directly.
+    The signal handler can only be installed from the main thread, so
+    construct the service (or the Dispatcher) there, and don't block the
+    main thread in a join() without timeout.
+    """
+    def __init__(self, profiler, seconds=10.0, signum=None, directory=None,
+                 address=None, metrics=None):
+        """
+        Constructs a ProfilerService and installs the signal handler. Call
+        start() to serve the socket.
+        """
+        object.__init__(self)
+        self.profiler = profiler
+        self.seconds = seconds
+        self.__directory = directory or "."
+        self.address = address
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.__server = None
+        if signum is not None:
+            try:
+                signal.signal(signum, self.__on_signal)
+            except ValueError, ex:
+                print("Failed to install the profiler signal: " + str(ex))
+
+    @classmethod
+    def from_config(cls, config, metrics=None):
+        """
+        Returns a ProfilerService configured by "signal" (e.g. "SIGUSR2"),
+        "seconds" (10), "directory" (the working directory), "address",
+        "interval" (0.01 seconds) and "threads" (thread name prefixes, all
+        threads by default) of the "profiler" config section.
+        """
+        section = "profiler"
+        signum = None
+        name = options.get(config, section, "signal")
+        if name is not None:
+            signum = getattr(signal, name.upper())
+        profiler = SamplingProfiler(
+            options.getfloat(config, section, "interval", 0.01),
+            options.getlist(config, section, "threads") or None,
+            metrics)
+        return cls(profiler,
+                   options.getfloat(config, section, "seconds", 10.0),
+                   signum,
+                   options.get(config, section, "directory"),
+                   options.get(config, section, "address"),
+                   metrics)
+
+    def start(self):
+        """
+        Binds the socket, if there is an address, and serves it in a
+        background thread.
+        """
+        if self.address is None:
+            return
+        family, bind_address = parse_address(self.address)
+        if family == socket.AF_UNIX:
+            if os.path.exists(bind_address):
+                os.unlink(bind_address)
+            server = _ThreadingUnixServer(bind_address,
+                                          _ProfilerRequestHandler)
+        else:
+            server = _ThreadingTCPServer(bind_address,
+                                         _ProfilerRequestHandler)
+            self.address = "%s:%d" % server.server_address
+        server.service = self
+        self.__server = server
+        thread = threading.Thread(target=server.serve_forever,
+                                  name="ProfilerService")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """
+        Stops serving the socket.
+        """
+        if self.__server is None:
+            return
+        self.__server.shutdown()
+        self.__server.server_close()
+        self.__server = None
+        family, bind_address = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(bind_address):
+            os.unlink(bind_address)
+
+    def cpu_times(self):
+        """
+        Returns a dictionary that maps the handler class names to the CPU
+        seconds their callbacks used so far (see HandlerGuard).
+        """
+        times = {}
+        for name, value in self.metrics.snapshot().items():
+            if name.startswith("handler.") and name.endswith(".cpu.total"):
+                times[name[len("handler."):-len(".cpu.total")]] = value
+        return times
+
+    def dump(self, seconds=None):
+        """
+        Takes a profile and writes it to a new file in the directory.
+        Returns the path of the file or None if another profile is being
+        taken.
+        """
+        stacks = self.profiler.profile(seconds or self.seconds)
+        if stacks is None:
+            return None
+        path = os.path.join(self.__directory, "gerritevent-%d-%s.folded"
+                            % (os.getpid(), time.strftime("%Y%m%d%H%M%S")))
+        with open(path, "w") as out:
+            SamplingProfiler.write(stacks, out)
+        return path
+
+    def __on_signal(self, signum, frame):
+        """
+        Takes the profile in a background thread, so the signal handler
+        returns at once.
+        """
+        thread = threading.Thread(target=self.__dump, name="ProfilerDump")
+        thread.daemon = True
+        thread.start()
+
+    def __dump(self):
+        """
+        Writes a profile and reports where.
+        """
+        try:
+            path = self.dump()
+            if path is None:
+                print("Already profiling")
+            else:
+                print("Wrote profile to " + path)
+        except Exception, ex:
+            print("Failed to write profile: " + str(ex))
@@ -0,0 +1,603 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+
+Republishes the Gerrit events of one dispatcher to other consumers.
+
+The PublisherHandler batches the events and hands them to a backend:
+LocalBrokerBackend talks to the LocalBroker shipped with this module,
+KafkaBackend, NatsBackend and RedisBackend talk to the respective servers.
+The local broker speaks JSON lines over a Unix or TCP socket:
+
+ * A publisher sends {"op": "publish", "id": ..., "events": [...]} (or
+   "data" with the base64 encoded, gzipped, newline separated events) and
+   gets {"op": "ack", "id": ...} back once the batch was delivered.
+ * A subscriber sends {"op": "subscribe"} and then receives one JSON event
+   per line.
+"""
+import base64
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import zlib
+from gerritevent import options
+from gerritevent.cache import LRUCache
+from gerritevent.handler import Handler
+from gerritevent.metrics import Metrics
+if sys.version_info < (3, 0):
+    import Queue as queue
+    import SocketServer as socketserver
+else:
+    import queue
+    import socketserver
+
+# Put into the publish queue to tell the sender to finish.
+_STOP = object()
+
+
+class Error(Exception):
+    """The basis for all error classes of this module."""
+    pass
+
+
+class DeliveryError(Error):
+    """Identifies a batch that the backend didn't acknowledge."""
+    pass
+
+
+def parse_address(address):
+    """
+    Returns a (family, address) tuple for "unix:/path/to/socket",
+    "tcp:host:port" or "host:port".
+    """
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:"):]
+    if address.startswith("tcp:"):
+        address = address[len("tcp:"):]
+    host, port = address.rsplit(":", 1)
+    return socket.AF_INET, (host, int(port))
+
+
+def compress(lines):
+    """
+    Returns the base64 encoded, gzip compressed, newline separated "lines".
+    """
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    data = compressor.compress("\n".join(lines).encode("utf-8"))
+    return base64.b64encode(data + compressor.flush())
+
+
+def decompress(data):
+    """
+    Returns the lines that were compressed with compress(). Data in the
+    zlib format of older publishers is accepted as well.
+    """
+    data = zlib.decompress(base64.b64decode(data), 32 + zlib.MAX_WBITS)
+    return data.decode("utf-8").split("\n")
+
+
+def subscribe(address, timeout=None):
+    """
+    Connects to the LocalBroker at "address" and yields each event as a
+    dictionary. Ends when the broker closes the connection.
+    """
+    family, address = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    sock.connect(address)
+    try:
+        sock.sendall(json.dumps({"op": "subscribe"}).encode("utf-8") + b"\n")
+        for line in sock.makefile("rb"):
+            yield json.loads(line)
+    finally:
+        sock.close()
+
+
+class _BrokerRequestHandler(socketserver.StreamRequestHandler):
+    """Serves one publisher or subscriber connection of the LocalBroker."""
+
+    def handle(self):
+        broker = self.server.broker
+        for line in self.rfile:
+            try:
+                frame = json.loads(line)
+            except ValueError:
+                continue
+            if frame.get("op") == "subscribe":
+                broker.add_subscriber(self.connection)
+                try:
+                    self.__wait_for_hang_up()
+                finally:
+                    broker.remove_subscriber(self.connection)
+                return
+            if frame.get("op") == "publish":
+                if "data" in frame:
+                    lines = decompress(frame["data"])
+                else:
+                    lines = [json.dumps(event) for event in frame["events"]]
+                broker.publish(frame["id"], lines)
+                ack = {"op": "ack", "id": frame["id"]}
+                self.wfile.write(json.dumps(ack).encode("utf-8") + b"\n")
+                self.wfile.flush()
+
+    def __wait_for_hang_up(self):
+        """
+        Blocks until the subscriber closes the connection. The socket has
+        the broker's send timeout, so read timeouts are expected here.
+        """
+        while True:
+            try:
+                if not self.connection.recv(4096):
+                    return
+            except socket.timeout:
+                continue
+            except socket.error:
+                return
+
+
+class _ThreadingTCPServer(socketserver.ThreadingMixIn,
+                          socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _ThreadingUnixServer(socketserver.ThreadingMixIn,
+                           socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class LocalBroker(object):
+    """
+    A small message broker that forwards every published event to all
+    connected subscribers. It listens on a Unix socket ("unix:/path") or a
+    TCP port ("host:port"), so other processes on the host can share the
+    events of one dispatcher without a broker installation.
+    Batches that are published twice (a publisher retrying after a lost
+    acknowledgement) are acknowledged but forwarded only once.
+    """
+    def __init__(self, address, send_timeout=5.0):
+        """
+        Constructs a LocalBroker. Call start() to start serving.
+        """
+        object.__init__(self)
+        self.address = address
+        self.__send_timeout = send_timeout
+        family, bind_address = parse_address(address)
+        if family == socket.AF_UNIX:
+            if os.path.exists(bind_address):
+                os.unlink(bind_address)
+            self.__server = _ThreadingUnixServer(bind_address,
+                                                 _BrokerRequestHandler)
+        else:
+            self.__server = _ThreadingTCPServer(bind_address,
+                                                _BrokerRequestHandler)
+            self.address = "%s:%d" % self.__server.server_address
+        self.__server.broker = self
+        self.__lock = threading.Lock()
+        self.__send_lock = threading.Lock()
+        self.__subscribers = []
+        self.__seen = LRUCache(10000)
+
+    def start(self):
+        """
+        Starts serving in a background thread.
+        """
+        thread = threading.Thread(target=self.__server.serve_forever,
+                                  name="LocalBroker")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """
+        Stops serving and closes the socket.
+        """
+        self.__server.shutdown()
+        self.__server.server_close()
+        family, bind_address = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(bind_address):
+            os.unlink(bind_address)
+
+    def add_subscriber(self, connection):
+        """
+        Starts forwarding events to the socket "connection".
+        """
+        connection.settimeout(self.__send_timeout)
+        with self.__lock:
+            self.__subscribers.append(connection)
+
+    def subscriber_count(self):
+        """
+        Returns the number of connected subscribers.
+        """
+        with self.__lock:
+            return len(self.__subscribers)
+
+    def remove_subscriber(self, connection):
+        """
+        Stops forwarding events to the socket "connection".
+        """
+        with self.__lock:
+            if connection in self.__subscribers:
+                self.__subscribers.remove(connection)
+
+    def publish(self, batch_id, lines):
+        """
+        Forwards the JSON "lines" of batch "batch_id" to all subscribers.
+        Subscribers that can't keep up are disconnected.
+        """
+        with self.__lock:
+            if batch_id in self.__seen:
+                return
+            self.__seen.put(batch_id, True)
+            subscribers = list(self.__subscribers)
+        data = "".join([line + "\n" for line in lines]).encode("utf-8")
+        # One batch after the other, so that lines never interleave.
+        with self.__send_lock:
+            for connection in subscribers:
+                try:
+                    connection.sendall(data)
+                except socket.error:
+                    self.remove_subscriber(connection)
+                    connection.close()
+
+
+class Backend(object):
+    """
+    Base class for the message bus backends of the PublisherHandler.
+    send() must either deliver the whole batch or raise an exception; the
+    handler then sends the same batch again.
+    """
+    def send(self, batch_id, events):
+        """
+        Delivers the list of event dictionaries "events".
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        """
+        Releases the connection to the message bus.
+        """
+        pass
+
+
+class LocalBrokerBackend(Backend):
+    """
+    Publishes to a LocalBroker and waits for its acknowledgement.
+    """
+    def __init__(self, address, compress_batches=True, timeout=30.0):
+        """
+        Constructs a LocalBrokerBackend for the broker at "address".
+        """
+        Backend.__init__(self)
+        self.__address = address
+        self.__compress = compress_batches
+        self.__timeout = timeout
+        self.__socket = None
+        self.__reader = None
+
+    def send(self, batch_id, events):
+        """
+        Sends the batch and waits for the acknowledgement.
+        """
+        frame = {"op": "publish", "id": batch_id}
+        lines = [json.dumps(event) for event in events]
+        if self.__compress:
+            frame["data"] = compress(lines).decode("ascii")
+        else:
+            frame["events"] = events
+        try:
+            if self.__socket is None:
+                self.__connect()
+            self.__socket.sendall(json.dumps(frame).encode("utf-8") + b"\n")
+            line = self.__reader.readline()
+            if not line:
+                raise DeliveryError("broker closed the connection")
+            ack = json.loads(line)
+            if ack.get("op") != "ack" or ack.get("id") != batch_id:
+                raise DeliveryError("unexpected answer: %r" % line)
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        """
+        Closes the connection to the broker.
+        """
+        if self.__socket is not None:
+            self.__socket.close()
+            self.__socket = None
+            self.__reader = None
+
+    def __connect(self):
+        """
+        Connects to the broker.
+        """
+        family, address = parse_address(self.__address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(self.__timeout)
+        sock.connect(address)
+        self.__socket = sock
+        self.__reader = sock.makefile("rb")
+
+
+class KafkaBackend(Backend):
+    """
+    Publishes each event as a message to a Kafka topic. The producer
+    batches and compresses; send() waits until all brokers in sync have the
+    messages. Requires the kafka-python package.
+    """
+    def __init__(self, address, topic, compress_batches=True):
+        """
+        Constructs a KafkaBackend for the comma separated bootstrap servers
+        in "address".
+        """
+        Backend.__init__(self)
+        from kafka import KafkaProducer
+        compression = None
+        if compress_batches:
+            compression = "gzip"
+        self.__producer = KafkaProducer(bootstrap_servers=address.split(","),
+                                        acks="all",
+                                        compression_type=compression,
+                                        linger_ms=50)
+        self.__topic = topic
+
+    def send(self, batch_id, events):
+        """
+        Sends the events and waits for the acknowledgements.
+        """
+        futures = [self.__producer.send(self.__topic,
+                                        json.dumps(event).encode("utf-8"))
+                   for event in events]
+        for future in futures:
+            future.get(timeout=30)
+
+    def close(self):
+        """
+        Flushes and closes the producer.
+        """
+        self.__producer.close()
+
+
+class NatsBackend(Backend):
+    """
+    Publishes each event as a message to a NATS subject. The batch is sent
+    in one go followed by a PING; the server's PONG confirms that it has
+    processed all messages. Speaks the plain NATS protocol, so no client
+    library is needed.
+    """
+    def __init__(self, address, subject, timeout=30.0):
+        """
+        Constructs a NatsBackend for the server at "host:port".
+        """
+        Backend.__init__(self)
+        self.__address = address
+        self.__subject = subject
+        self.__timeout = timeout
+        self.__socket = None
+        self.__reader = None
+
+    def send(self, batch_id, events):
+        """
+        Publishes the events and waits for the server's PONG.
+        """
+        data = []
+        for event in events:
+            payload = json.dumps(event).encode("utf-8")
+            data.append(("PUB %s %d\r\n" % (self.__subject, len(payload))
+                         ).encode("ascii"))
+            data.append(payload + b"\r\n")
+        data.append(b"PING\r\n")
+        try:
+            if self.__socket is None:
+                self.__connect()
+            self.__socket.sendall(b"".join(data))
+            while True:
+                line = self.__reader.readline()
+                if not line:
+                    raise DeliveryError("server closed the connection")
+                if line.startswith(b"PONG"):
+                    return
+                if line.startswith(b"PING"):
+                    self.__socket.sendall(b"PONG\r\n")
+                elif line.startswith(b"-ERR"):
+                    raise DeliveryError(line.strip())
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        """
+        Closes the connection to the server.
+        """
+        if self.__socket is not None:
+            self.__socket.close()
+            self.__socket = None
+            self.__reader = None
+
+    def __connect(self):
+        """
+        Connects and introduces this client to the server.
+        """
+        family, address = parse_address(self.__address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(self.__timeout)
+        sock.connect(address)
+        reader = sock.makefile("rb")
+        reader.readline()  # INFO
+        sock.sendall(b'CONNECT {"verbose": false, "pedantic": false}\r\n')
+        self.__socket = sock
+        self.__reader = reader
+
+
+class RedisBackend(Backend):
+    """
+    Appends each event to a Redis list with a single RPUSH per batch.
+    Requires the redis package.
+    """
+    def __init__(self, address, key):
+        """
+        Constructs a RedisBackend for the URL "address", e.g.
+        "redis://localhost:6379/0".
+        """
+        Backend.__init__(self)
+        import redis
+        self.__client = redis.StrictRedis.from_url(address)
+        self.__key = key
+
+    def send(self, batch_id, events):
+        """
+        Appends the events to the list.
+        """
+        self.__client.rpush(self.__key,
+                            *[json.dumps(event) for event in events])
+
+
+def create_backend(config, section="publisher"):
+    """
+    Returns the Backend configured by "backend" ("local", "kafka", "nats"
+    or "redis"), "address", "topic" and "compress" in ``section``.
+    """
+    name = options.get(config, section, "backend", "local")
+    address = config.get(section, "address")
+    topic = options.get(config, section, "topic", "gerrit-events")
+    compress_batches = options.getboolean(config, section, "compress", True)
+    if name == "local":
+        return LocalBrokerBackend(address, compress_batches)
+    if name == "kafka":
+        return KafkaBackend(address, topic, compress_batches)
+    if name == "nats":
+        return NatsBackend(address, topic)
+    if name == "redis":
+        return RedisBackend(address, topic)
+    raise ValueError('unknown backend %s' % name)
+
+
+class PublisherHandler(Handler):
+    """
+    Republishes all events to a message bus, so that many consumers can
+    share one Gerrit stream.
+    Configure it in the "publisher" config section: "backend", "address",
+    "topic" and "compress" select the Backend (see create_backend). Events
+    are sent in batches of up to "batch_size" (100) events, at the latest
+    after "batch_interval" (1.0) seconds. A batch is resent until the
+    backend acknowledges it (at-least-once delivery), waiting
+    "retry_interval" (5.0) seconds between attempts. At most "max_pending"
+    (10000) events are queued; beyond that the dispatcher waits.
+    The batches are sent by a background thread.
+    """
+    def __init__(self, config, backend=None, metrics=None):
+        """
+        Constructs a PublisherHandler and starts its sender thread.
+        """
+        Handler.__init__(self, config)
+        section = "publisher"
+        if backend is None:
+            backend = create_backend(config, section)
+        self.__backend = backend
+        self.__batch_size = options.getint(config, section, "batch_size", 100)
+        self.__batch_interval = options.getfloat(config, section,
+                                                 "batch_interval", 1.0)
+        self.__retry_interval = options.getfloat(config, section,
+                                                 "retry_interval", 5.0)
+        self.__queue = queue.Queue(
+            options.getint(config, section, "max_pending", 10000))
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.__prefix = "%x-%x" % (int(time.time() * 1000), id(self))
+        self.__sequence = 0
+        self.__closing = threading.Event()
+        self.__close_retries = 3
+        self.__sender = threading.Thread(target=self.__send_loop,
+                                         name="Publisher-sender")
+        self.__sender.daemon = True
+        self.__sender.start()
+
+    def patchset_created(self, event):
+        """Publishes the event."""
+        self.__queue.put(event)
+
+    def change_abandoned(self, event):
+        """Publishes the event."""
+        self.__queue.put(event)
+
+    def change_restored(self, event):
+        """Publishes the event."""
+        self.__queue.put(event)
+
+    def change_merged(self, event):
+        """Publishes the event."""
+        self.__queue.put(event)
+
+    def comment_added(self, event):
+        """Publishes the event."""
+        self.__queue.put(event)
+
+    def ref_updated(self, event):
+        """Publishes the event."""
+        self.__queue.put(event)
+
+    def close(self, retries=3):
+        """
+        Sends the queued events, giving up on a batch after "retries"
+        failed attempts, and closes the backend.
+        """
+        self.__closing.set()
+        self.__close_retries = retries
+        self.__queue.put(_STOP)
+        self.__sender.join()
+        self.__backend.close()
+
+    def __send_loop(self):
+        """
+        Collects batches from the queue and sends them until closed.
+        """
+        stopped = False
+        while not stopped:
+            batch = []
+            deadline = None
+            while len(batch) < self.__batch_size:
+                timeout = None
+                if deadline is not None:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                try:
+                    event = self.__queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if event is _STOP:
+                    stopped = True
+                    break
+                batch.append(event)
+                if deadline is None:
+                    deadline = time.time() + self.__batch_interval
+            if batch:
+                self.__send(batch)
+
+    def __send(self, batch):
+        """
+        Sends "batch" until the backend acknowledges it.
+        """
+        self.__sequence += 1
+        batch_id = "%s-%d" % (self.__prefix, self.__sequence)
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                self.__backend.send(batch_id, batch)
+                self.metrics.increment("publisher.batches")
+                self.metrics.increment("publisher.events", len(batch))
+                return
+            except Exception, ex:
+                self.metrics.increment("publisher.retries")
+                print("Failed to publish %d events: %s" % (len(batch), ex))
+            if self.__closing.is_set() and attempts >= self.__close_retries:
+                self.metrics.increment("publisher.lost", len(batch))
+                return
+            time.sleep(self.__retry_interval)
@@ -0,0 +1,185 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+import itertools
+import threading
+import time
+from gerritevent import options
+from gerritevent.metrics import Metrics
+
+
+class TokenBucket(object):
+    """
+    A bucket that holds up to "burst" tokens and is refilled with "rate"
+    tokens per second. This class is not thread-safe on its own.
+    """
+    def __init__(self, rate, burst):
+        """
+        Constructs a full TokenBucket.
+        """
+        object.__init__(self)
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.__tokens = self.burst
+        self.__updated = time.time()
+
+    def delay(self, now):
+        """
+        Returns the seconds until a token is available (0.0 if there is one).
+        """
+        self.__refill(now)
+        if self.__tokens >= 1.0:
+            return 0.0
+        return (1.0 - self.__tokens) / self.rate
+
+    def take(self, now):
+        """
+        Removes one token from the bucket.
+        """
+        self.__refill(now)
+        self.__tokens -= 1.0
+
+    def full(self, now):
+        """
+        Returns True if the bucket is full, i.e. it wasn't used for a while.
+        """
+        self.__refill(now)
+        return self.__tokens >= self.burst
+
+    def __refill(self, now):
+        """
+        Adds the tokens that accumulated since the last update.
+        """
+        elapsed = max(0.0, now - self.__updated)
+        self.__tokens = min(self.burst, self.__tokens + elapsed * self.rate)
+        self.__updated = now
+
+
+class RateLimiter(object):
+    """
+    Throttles outbound calls of a handler with token buckets.
+    There is one global bucket and, if "target_rate" is given, one bucket
+    per target (e.g. per Redmine issue). Calls are never dropped: acquire()
+    blocks until the call may be made. The next global token goes to the
+    first waiting caller whose target bucket has a token, in order of their
+    priority (lower value first, see "priorities") and then of arrival, so
+    a throttled target doesn't hold up the others. The time spent waiting
+    is recorded in "metrics" as the timing "ratelimit.<name>.wait".
+    Any Handler subclass can use a RateLimiter like this:
+
+    >>> self.__limiter = RateLimiter.from_config(config, "myhandler")
+    >>> self.__limiter.acquire(target=issue_id, event_type=event["type"])
+    """
+    def __init__(self, rate, burst=1, target_rate=None, target_burst=1,
+                 priorities=None, name="default", metrics=None,
+                 max_targets=10000):
+        """
+        Constructs a RateLimiter. "rate" and "target_rate" are in calls per
+        second, "priorities" maps event types to integer priorities.
+        """
+        object.__init__(self)
+        self.__bucket = TokenBucket(rate, burst)
+        self.__target_rate = target_rate
+        self.__target_burst = target_burst
+        self.__target_buckets = {}
+        self.__max_targets = max_targets
+        self.__priorities = priorities or {}
+        self.__name = name
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.__condition = threading.Condition()
+        self.__waiting = []
+        self.__sequence = itertools.count()
+
+    @classmethod
+    def from_config(cls, config, section, metrics=None):
+        """
+        Returns a RateLimiter configured by the options "rate_limit",
+        "rate_burst", "target_rate_limit", "target_rate_burst" and
+        "rate_priorities" (e.g. "change-merged:0 comment-added:10") of
+        ``section`` or None if there is no "rate_limit" option.
+        """
+        rate = options.getfloat(config, section, "rate_limit")
+        if rate is None:
+            return None
+        priorities = {}
+        for item in options.getlist(config, section, "rate_priorities"):
+            event_type, priority = item.split(":")
+            priorities[event_type] = int(priority)
+        return cls(rate,
+                   burst=options.getint(config, section, "rate_burst", 1),
+                   target_rate=options.getfloat(config, section,
+                                                "target_rate_limit"),
+                   target_burst=options.getint(config, section,
+                                               "target_rate_burst", 1),
+                   priorities=priorities,
+                   name=section,
+                   metrics=metrics)
+
+    def acquire(self, target=None, event_type=None):
+        """
+        Blocks until a call to "target" may be made and returns the seconds
+        spent waiting.
+        """
+        ticket = (self.__priorities.get(event_type, 0), next(self.__sequence))
+        start = time.time()
+        self.__condition.acquire()
+        try:
+            self.__waiting.append((ticket, target))
+            try:
+                while True:
+                    now = time.time()
+                    buckets = self.__buckets(target, now)
+                    delay = max([b.delay(now) for b in buckets])
+                    if delay <= 0.0 and self.__next_ticket(now) == ticket:
+                        for bucket in buckets:
+                            bucket.take(now)
+                        break
+                    # Without a delay an earlier caller takes the token and
+                    # notifies the others when it's done.
+                    self.__condition.wait(delay or None)
+            finally:
+                self.__waiting.remove((ticket, target))
+                self.__condition.notify_all()
+        finally:
+            self.__condition.release()
+        waited = time.time() - start
+        self.metrics.timing("ratelimit." + self.__name + ".wait", waited)
+        return waited
+
+    def __next_ticket(self, now):
+        """
+        Returns the ticket of the first waiting caller whose target bucket
+        has a token, or None. The caller must hold the condition.
+        """
+        for ticket, target in sorted(self.__waiting):
+            if self.__buckets(target, now)[-1].delay(now) <= 0.0:
+                return ticket
+        return None
+
+    def __buckets(self, target, now):
+        """
+        Returns the buckets that must have a token for a call to "target".
+        The caller must hold the condition.
+        """
+        if target is None or self.__target_rate is None:
+            return [self.__bucket]
+        bucket = self.__target_buckets.get(target)
+        if bucket is None:
+            if len(self.__target_buckets) >= self.__max_targets:
+                self.__forget_idle_targets(now)
+            bucket = TokenBucket(self.__target_rate, self.__target_burst)
+            self.__target_buckets[target] = bucket
+        return [self.__bucket, bucket]
+
+    def __forget_idle_targets(self, now):
+        """
+        Drops the buckets that are full. A full bucket behaves exactly like
+        a new one, so nothing is lost.
+        """
+        for target, bucket in list(self.__target_buckets.items()):
+            if bucket.full(now):
+                del self.__target_buckets[target]
@@ -0,0 +1,425 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+import json
+import os
+import sys
+import threading
+import time
+from gerritevent import tracing
+from gerritevent.gerrit_events import GerritEvent
+if sys.version_info < (3, 0):
+    import Queue as queue
+else:
+    import queue
+
+
+class Error(Exception):
+    """The basis for all error classes of this module."""
+    pass
+
+
+class HandlerTimeoutError(Error):
+    """Identifies a handler callback that didn't return in time."""
+    pass
+
+
+class CircuitOpenError(Error):
+    """Identifies a call that was refused because the circuit is open."""
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Stops calling a failing downstream for a while.
+    After "failure_threshold" consecutive failures the breaker opens and
+    refuses all calls for "reset_timeout" seconds. Then a single trial call
+    is let through (half-open): if it succeeds the breaker closes again,
+    otherwise it stays open for another "reset_timeout" seconds.
+    """
+
+    CLOSED = 'closed'
+
+    OPEN = 'open'
+
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=60.0):
+        """
+        Constructs a closed CircuitBreaker.
+        """
+        object.__init__(self)
+        self.__failure_threshold = failure_threshold
+        self.__reset_timeout = reset_timeout
+        self.__lock = threading.Lock()
+        self.__failures = 0
+        self.__opened_at = None
+        self.__trial = False
+
+    def state(self):
+        """
+        Returns one of CLOSED, OPEN or HALF_OPEN.
+        """
+        with self.__lock:
+            return self.__state()
+
+    def allow(self):
+        """
+        Returns True if a call may be made now. In half-open state only one
+        trial call is allowed until its outcome was recorded.
+        """
+        with self.__lock:
+            state = self.__state()
+            if state == CircuitBreaker.CLOSED:
+                return True
+            if state == CircuitBreaker.HALF_OPEN and not self.__trial:
+                self.__trial = True
+                return True
+            return False
+
+    def success(self):
+        """
+        Records a successful call and closes the breaker.
+        """
+        with self.__lock:
+            self.__failures = 0
+            self.__opened_at = None
+            self.__trial = False
+
+    def failure(self):
+        """
+        Records a failed call and opens the breaker if the threshold is
+        reached or the trial call failed.
+        """
+        with self.__lock:
+            self.__failures += 1
+            self.__trial = False
+            if (self.__opened_at is not None or
+                    self.__failures >= self.__failure_threshold):
+                self.__opened_at = time.time()
+
+    def __state(self):
+        """
+        Returns the current state. The caller must hold the lock.
+        """
+        if self.__opened_at is None:
+            return CircuitBreaker.CLOSED
+        if time.time() - self.__opened_at >= self.__reset_timeout:
+            return CircuitBreaker.HALF_OPEN
+        return CircuitBreaker.OPEN
+
+
+class DeadLetterStore(object):
+    """
+    Keeps events that a handler failed to handle in a local file, one JSON
+    object per line, so that they can be replayed later on.
+    """
+    def __init__(self, path):
+        """
+        Constructs a DeadLetterStore that appends to the file at "path".
+        """
+        object.__init__(self)
+        self.__path = path
+        self.__lock = threading.Lock()
+
+    def add(self, handler_name, callback, event, error):
+        """
+        Stores "event" which failed in "callback" of the handler named
+        "handler_name" with "error".
+        """
+        line = json.dumps({
+            "handler": handler_name,
+            "callback": callback,
+            "error": str(error),
+            "time": int(time.time()),
+            "event": event
+        })
+        with self.__lock:
+            dead_letters = open(self.__path, "a")
+            try:
+                dead_letters.write(line + "\n")
+            finally:
+                dead_letters.close()
+
+    def entries(self):
+        """
+        Returns a list with all stored entries.
+        """
+        with self.__lock:
+            return self.__read()
+
+    def replay(self, handlers):
+        """
+        Hands each stored event once more to the handler it failed in.
+        "handlers" is a list of handler objects, matched by class name.
+        Handlers with "typed_events" get the decoded GerritEvent.
+        Entries that fail again or have no matching handler are kept.
+        Returns the number of successfully replayed events.
+        """
+        by_name = dict((type(h).__name__, h) for h in handlers)
+        with self.__lock:
+            entries = self.__read()
+            kept = []
+            for entry in entries:
+                handler = by_name.get(entry["handler"])
+                if handler is None:
+                    kept.append(entry)
+                    continue
+                try:
+                    event = entry["event"]
+                    if getattr(handler, "typed_events", False) is True:
+                        event = GerritEvent.decode_dict(event)
+                    getattr(handler, entry["callback"])(event)
+                except Exception, ex:
+                    entry["error"] = str(ex)
+                    kept.append(entry)
+            self.__write(kept)
+        return len(entries) - len(kept)
+
+    def __read(self):
+        """
+        Reads all entries. The caller must hold the lock.
+        """
+        if not os.path.exists(self.__path):
+            return []
+        dead_letters = open(self.__path)
+        try:
+            return [json.loads(line) for line in dead_letters if line.strip()]
+        finally:
+            dead_letters.close()
+
+    def __write(self, entries):
+        """
+        Replaces the file with "entries". The caller must hold the lock.
+        """
+        tmp_path = self.__path + ".tmp"
+        dead_letters = open(tmp_path, "w")
+        try:
+            for entry in entries:
+                dead_letters.write(json.dumps(entry) + "\n")
+        finally:
+            dead_letters.close()
+        os.rename(tmp_path, self.__path)
+
+
+class _CallSlot(object):
+    """
+    A long-lived thread that runs the calls of a HandlerGuard with a
+    timeout, so that such calls don't start a thread each. The guard's lock
+    protects "busy", which is set until the call returned.
+    """
+    def __init__(self, name, lock):
+        object.__init__(self)
+        self.busy = False
+        self.__lock = lock
+        self.__requests = queue.Queue()
+        thread = threading.Thread(target=self.__run, name=name)
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, method, event, context):
+        """
+        Runs "method" with "event" in the slot's thread, within the tracing
+        "context" of the caller (see tracing.context()), and returns an
+        Event that is set once it returned, and the list its error is put
+        into. The caller must have marked the slot busy.
+        """
+        done = threading.Event()
+        errors = []
+        self.__requests.put((method, event, context, done, errors))
+        return done, errors
+
+    def __run(self):
+        """
+        Runs the submitted calls one after the other.
+        """
+        while True:
+            method, event, context, done, errors = self.__requests.get()
+            tracing.activate(*context)
+            try:
+                method(event)
+            except Exception, ex:
+                errors.append(ex)
+            tracing.activate(None)
+            with self.__lock:
+                self.busy = False
+            done.set()
+
+
+class HandlerGuard(object):
+    """
+    Wraps all calls into one handler, so that a failing or hanging handler
+    can't take the dispatcher or the other handlers down.
+    Each call is subject to an optional timeout and a CircuitBreaker. Events
+    that fail, time out or are refused by the open breaker are written to an
+    optional DeadLetterStore. Failures are counted in "metrics" under
+    "handler.<class name>.<what>". If the calling thread has a trace, each
+    call is recorded as span "handler.<class name>.<callback>".
+    With a "limit" at most that many calls run at the same time; further
+    callers wait and the handler counts as saturated meanwhile.
+    With a "timeout" the calls run in up to "limit" (or one) long-lived
+    threads. A call that timed out keeps its thread until it returns; only
+    if all of them hang, calls are refused as timed out.
+    With a "cpu_clock" (a callable returning the CPU seconds of the calling
+    thread, like gerritevent.profiling.thread_cpu_time) the CPU time of
+    each call is recorded as timing "handler.<class name>.cpu".
+    """
+    def __init__(self, handler, metrics, timeout=None, breaker=None,
+                 dead_letters=None, limit=None, cpu_clock=None):
+        """
+        Constructs a HandlerGuard for "handler".
+        """
+        object.__init__(self)
+        self.handler = handler
+        self.name = type(handler).__name__
+        self.typed = getattr(handler, "typed_events", False) is True
+        self.bulk = getattr(handler, "bulk_ref_updates", False) is True
+        self.__metrics = metrics
+        self.__timeout = timeout
+        if breaker is None:
+            breaker = CircuitBreaker()
+        self.breaker = breaker
+        self.__dead_letters = dead_letters
+        self.__call_slots = []
+        self.__call_slots_size = limit or 1
+        self.__call_slots_lock = threading.Lock()
+        self.__slots = None
+        if limit is not None:
+            self.__slots = threading.Semaphore(limit)
+        self.__waiting_lock = threading.Lock()
+        self.__waiting = 0
+        self.__cpu_clock = cpu_clock
+
+    def saturated(self):
+        """
+        Returns True if callers are waiting for the handler's limit.
+        """
+        return self.__waiting > 0
+
+    def call(self, callback, event, raw=None):
+        """
+        Invokes the method named "callback" of the handler with "event".
+        If "event" is a decoded GerritEvent, "raw" is the dictionary it was
+        decoded from; that one is written to the dead-letter store.
+        Returns True if the handler succeeded.
+        """
+        prefix = "handler." + self.name + "."
+        if raw is None:
+            raw = event
+        if not self.breaker.allow():
+            self.__metrics.increment(prefix + "short_circuited")
+            self.__dead_letter(callback, raw, CircuitOpenError("open"))
+            return False
+        if self.__slots is None:
+            return self.__call(prefix, callback, event, raw)
+        if not self.__slots.acquire(False):
+            self.__metrics.increment(prefix + "saturated")
+            with self.__waiting_lock:
+                self.__waiting += 1
+            try:
+                self.__slots.acquire()
+            finally:
+                with self.__waiting_lock:
+                    self.__waiting -= 1
+        try:
+            return self.__call(prefix, callback, event, raw)
+        finally:
+            self.__slots.release()
+
+    def __call(self, prefix, callback, event, raw):
+        """
+        Invokes the callback and records the outcome.
+        """
+        trace = tracing.current()
+        span = None
+        if trace is not None:
+            span = trace.begin(prefix + callback)
+        error = None
+        method = getattr(self.handler, callback)
+        if self.__cpu_clock is not None:
+            method = self.__measure_cpu(method, prefix + "cpu")
+        start = time.time()
+        try:
+            self.__invoke(method, event)
+        except Exception, ex:
+            error = ex
+            self.breaker.failure()
+            self.__metrics.increment(prefix + "failures")
+            if isinstance(ex, HandlerTimeoutError):
+                self.__metrics.increment(prefix + "timeouts")
+            print(self.name + "." + callback + " failed: " + str(ex))
+            self.__dead_letter(callback, raw, ex)
+            return False
+        finally:
+            self.__metrics.timing(prefix + "duration", time.time() - start)
+            if span is not None:
+                trace.end(span, error)
+        self.breaker.success()
+        return True
+
+    def __measure_cpu(self, method, name):
+        """
+        Returns "method" wrapped to record its CPU time as timing "name", in
+        whichever thread it runs.
+        """
+        def measured(event):
+            start = self.__cpu_clock()
+            try:
+                method(event)
+            finally:
+                if start is not None:
+                    self.__metrics.timing(name, self.__cpu_clock() - start)
+        return measured
+
+    def __invoke(self, method, event):
+        """
+        Calls "method" with "event", in a call slot if there's a timeout.
+        A call that timed out keeps running in the background and keeps its
+        slot until it has returned.
+        """
+        if self.__timeout is None:
+            method(event)
+            return
+        slot = self.__take_call_slot()
+        done, errors = slot.submit(method, event, tracing.context())
+        done.wait(self.__timeout)
+        if not done.is_set():
+            with self.__call_slots_lock:
+                hanging = slot.busy
+            if hanging:
+                raise HandlerTimeoutError("no result after %ss"
+                                          % self.__timeout)
+        if errors:
+            raise errors[0]
+
+    def __take_call_slot(self):
+        """
+        Returns an idle call slot marked busy, starting a new one if the
+        pool isn't full yet.
+        """
+        with self.__call_slots_lock:
+            for slot in self.__call_slots:
+                if not slot.busy:
+                    slot.busy = True
+                    return slot
+            if len(self.__call_slots) >= self.__call_slots_size:
+                raise HandlerTimeoutError("previous calls still running")
+            slot = _CallSlot("%s-call-%d" % (self.name,
+                                             len(self.__call_slots) + 1),
+                             self.__call_slots_lock)
+            slot.busy = True
+            self.__call_slots.append(slot)
+            return slot
+
+    def __dead_letter(self, callback, event, error):
+        """
+        Writes the failed event to the dead-letter store, if there is one.
+        """
+        if self.__dead_letters is None:
+            return
+        try:
+            self.__dead_letters.add(self.name, callback, event, error)
+        except Exception, ex:
+            print("Failed to write dead letter: " + str(ex))
@@ -0,0 +1,486 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+import fnmatch
+import json
+import os
+import re
+import sys
+import threading
+from string import Template
+from gerritevent import options
+from gerritevent import tracing
+from gerritevent.gerrit_objects import GerritApproval
+from gerritevent.handler import Handler
+from gerritevent.metrics import Metrics
+from gerritevent.scheduling import event_project
+if sys.version_info < (3, 0):
+    from ConfigParser import ConfigParser
+else:
+    from configparser import ConfigParser
+
+# The prefix of the config sections that hold rules.
+SECTION_PREFIX = "rule "
+
+# A condition on an approval, like "Code-Review>=2".
+_APPROVAL = re.compile(r"^([\w-]+)(>=|<=|=|>|<)(-?\d+)$")
+
+_COMPARE = {
+    ">=": lambda value, limit: value >= limit,
+    "<=": lambda value, limit: value <= limit,
+    "=": lambda value, limit: value == limit,
+    ">": lambda value, limit: value > limit,
+    "<": lambda value, limit: value < limit,
+}
+
+
+class Error(Exception):
+    """The basis for all error classes of this module."""
+    pass
+
+
+class RuleError(Error):
+    """Identifies a rule that can't be compiled."""
+    pass
+
+
+class ActionError(Error):
+    """
+    Identifies rule actions that failed; "errors" holds the (rule name,
+    exception) tuples.
+    """
+    def __init__(self, errors):
+        Error.__init__(self, ", ".join("rule %s failed: %s" % (name, ex)
+                                       for name, ex in errors))
+        self.errors = errors
+
+
+def event_branch(event):
+    """
+    Returns the branch of the event dictionary or None. For "ref-updated"
+    events it's the updated ref without "refs/heads/".
+    """
+    change = event.get("change")
+    if change:
+        return change.get("branch")
+    ref_name = (event.get("refUpdate") or {}).get("refName")
+    if ref_name and ref_name.startswith("refs/heads/"):
+        return ref_name[len("refs/heads/"):]
+    return ref_name
+
+
+def event_values(event):
+    """
+    Returns the values the action templates can use: every nested value of
+    the event as "<key>_<key>" (e.g. "change_number", "patchSet_revision",
+    "refUpdate_newRev"), "type", "project", "branch", each approval as
+    "approval_<label>" (e.g. "approval_Code_Review") and the whole event as
+    JSON in "event".
+    """
+    values = {}
+    pending = [("", event)]
+    while pending:
+        prefix, value = pending.pop()
+        if isinstance(value, dict):
+            for key, item in value.items():
+                pending.append((prefix + "_" + key if prefix else key, item))
+        elif not isinstance(value, list):
+            values[prefix] = value
+    values["project"] = event_project(event) or ""
+    values["branch"] = event_branch(event) or ""
+    for approval in event.get("approvals") or []:
+        label = GerritApproval.label_name(approval["type"])
+        values["approval_" + label.replace("-", "_")] = approval["value"]
+    values["event"] = json.dumps(event)
+    return values
+
+
+class Action(object):
+    """
+    Base class for what a rule does when it matches.
+    """
+    def run(self, values):
+        """
+        Runs the action with the event "values" (see event_values()).
+        """
+        raise NotImplementedError()
+
+
+class TemplateAction(Action):
+    """
+    Renders "template" (a string.Template) and appends the result as a line
+    to the file "path", or prints it if there is no path.
+    """
+    def __init__(self, template, path=None):
+        Action.__init__(self)
+        self.template = Template(template)
+        self.path = path
+        self.__lock = threading.Lock()
+
+    def run(self, values):
+        text = self.template.safe_substitute(values)
+        if self.path is None:
+            print(text)
+            return
+        with self.__lock:
+            with open(self.path, "a") as out:
+                out.write(text + "\n")
+
+
+class HttpAction(Action):
+    """
+    Sends a "method" request to the rendered "url" template with the
+    rendered "body" template and the "headers". Answers of 300 and above
+    are errors. "http" returns the httplib2.Http object of the calling
+    thread.
+    """
+    def __init__(self, http, url, method="POST", body=None, headers=None):
+        Action.__init__(self)
+        self.__http = http
+        self.url = Template(url)
+        self.method = method
+        self.body = None
+        if body is not None:
+            self.body = Template(body)
+        self.headers = headers or {}
+
+    def run(self, values):
+        url = self.url.safe_substitute(values)
+        body = None
+        if self.body is not None:
+            body = self.body.safe_substitute(values)
+        with tracing.span("http." + self.method, url=url):
+            response, _content = self.__http().request(
+                uri=url, method=self.method, body=body,
+                headers=self.headers)
+        if response.status >= 300:
+            raise IOError("%s %s answered %d" % (self.method, url,
+                                                 response.status))
+
+
+class Rule(object):
+    """
+    "When event X in project Y with label Z then do A": the conditions of
+    one rule and its action. "types" and "projects" are sets (empty for
+    any), "branches" fnmatch patterns, "approvals" (label, operator, value)
+    tuples that must all hold and "subject" and "comment" compiled regular
+    expressions searched in the change subject and the comment.
+    """
+    def __init__(self, name, action, types=None, projects=None,
+                 branches=None, approvals=None, subject=None, comment=None):
+        """
+        Constructs a Rule.
+        """
+        object.__init__(self)
+        self.name = name
+        self.action = action
+        self.types = set(types or [])
+        self.projects = set(projects or [])
+        self.branches = list(branches or [])
+        self.approvals = list(approvals or [])
+        self.subject = subject
+        self.comment = comment
+
+    @classmethod
+    def from_config(cls, config, section, http=None):
+        """
+        Returns the Rule in "section" (named "rule <name>"): the conditions
+        "types", "projects", "branches" (patterns like "release/*"),
+        "approvals" (like "Code-Review>=2 Verified=1"), "subject" and
+        "comment" (regular expressions) and the "action": "http" with "url",
+        "method" (POST), "body" and "content_type" (application/json), or
+        "template" with "template" and "file". Raises RuleError if the rule
+        is invalid. "http" returns the httplib2.Http object of the calling
+        thread.
+        """
+        name = section[len(SECTION_PREFIX):]
+        approvals = []
+        for item in options.getlist(config, section, "approvals"):
+            match = _APPROVAL.match(item)
+            if match is None:
+                raise RuleError("rule %s: bad approval %r" % (name, item))
+            label, operator, value = match.groups()
+            approvals.append((label, operator, int(value)))
+        try:
+            subject = cls.__regex(config, section, "subject")
+            comment = cls.__regex(config, section, "comment")
+        except re.error, ex:
+            raise RuleError("rule %s: %s" % (name, ex))
+        kind = options.get(config, section, "action", "template")
+        if kind == "http":
+            if http is None:
+                raise RuleError("rule %s: no HTTP client" % name)
+            if not config.has_option(section, "url"):
+                raise RuleError("rule %s: http needs a url" % name)
+            action = HttpAction(
+                http, config.get(section, "url"),
+                options.get(config, section, "method", "POST").upper(),
+                options.get(config, section, "body"),
+                {"Content-type": options.get(config, section, "content_type",
+                                             "application/json")})
+        elif kind == "template":
+            if not config.has_option(section, "template"):
+                raise RuleError("rule %s: template needs a template" % name)
+            action = TemplateAction(config.get(section, "template"),
+                                    options.get(config, section, "file"))
+        else:
+            raise RuleError("rule %s: unknown action %r" % (name, kind))
+        return cls(name, action,
+                   options.getlist(config, section, "types"),
+                   options.getlist(config, section, "projects"),
+                   options.getlist(config, section, "branches"),
+                   approvals, subject, comment)
+
+    def matches(self, event):
+        """
+        Returns True if the conditions besides type and project hold for
+        the "event" dictionary. The RuleIndex checks type and project.
+        """
+        if self.branches:
+            branch = event_branch(event)
+            if branch is None or not [pattern for pattern in self.branches
+                                      if fnmatch.fnmatchcase(branch,
+                                                             pattern)]:
+                return False
+        if self.subject is not None and not self.subject.search(
+                (event.get("change") or {}).get("subject") or ""):
+            return False
+        if self.comment is not None and \
+                not self.comment.search(event.get("comment") or ""):
+            return False
+        for label, operator, limit in self.approvals:
+            if not self.__approved(event, label, operator, limit):
+                return False
+        return True
+
+    @staticmethod
+    def __approved(event, label, operator, limit):
+        """
+        Returns True if the event has an approval for "label" whose value
+        compares to "limit" with "operator".
+        """
+        for approval in event.get("approvals") or []:
+            if GerritApproval.label_name(approval["type"]) != label:
+                continue
+            try:
+                value = int(approval["value"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            if _COMPARE[operator](value, limit):
+                return True
+        return False
+
+    @staticmethod
+    def __regex(config, section, option):
+        """
+        Returns the compiled regular expression "option" or None.
+        """
+        pattern = options.get(config, section, option)
+        if pattern is None:
+            return None
+        return re.compile(pattern)
+
+
+class RuleIndex(object):
+    """
+    The rules keyed by event type and project, so that an event is only
+    checked against the rules that name its type and project (or leave
+    either open), however many rules there are. Matching rules are
+    returned in the order of "rules". The index isn't changed after
+    construction, so it can be swapped while it is used.
+    """
+    def __init__(self, rules):
+        """
+        Constructs a RuleIndex of the list "rules".
+        """
+        object.__init__(self)
+        self.rules = list(rules)
+        self.__index = {}
+        for position, rule in enumerate(self.rules):
+            for event_type in rule.types or [None]:
+                for project in rule.projects or [None]:
+                    self.__index.setdefault((event_type, project), []).append(
+                        (position, rule))
+
+    def __len__(self):
+        return len(self.rules)
+
+    def match(self, event):
+        """
+        Returns the rules that match the "event" dictionary.
+        """
+        event_type = event.get("type")
+        project = event_project(event)
+        candidates = []
+        for key in ((event_type, project), (event_type, None),
+                    (None, project), (None, None)):
+            candidates.extend(self.__index.get(key, ()))
+        if len(candidates) > 1:
+            candidates.sort(key=lambda candidate: candidate[0])
+        return [rule for _position, rule in candidates if rule.matches(event)]
+
+
+class RuleHandler(Handler):
+    """
+    Runs declarative rules instead of code: each "rule <name>" config
+    section says on which events (types, projects, branches, approvals,
+    subject and comment patterns) which action (an HTTP request or a
+    rendered template) is run; see Rule.from_config(). The rules are read
+    from the "file" of the "rules" config section, or from the main config
+    if there is none, and compiled into a RuleIndex.
+    The file is read again when it changed, checked every "reload_interval"
+    (30) seconds, or when reload() is called. The new index replaces the
+    old one at once, so events are never matched against half of the
+    rules and dispatching doesn't wait for the reload. A file with invalid
+    rules is reported and the old rules are kept.
+    Each action runs on its own: a failing one is counted in "metrics" as
+    "rules.<name>.failures" and doesn't stop the others. Once all of them
+    ran, an ActionError is raised, so that the HandlerGuard records the
+    failure (and a replay of the event runs all its rules again).
+    """
+
+    # Actions only share the index and per-thread HTTP connections.
+    max_concurrency = 4
+
+    def __init__(self, config, metrics=None):
+        """
+        Constructs a RuleHandler and compiles the rules. Raises RuleError if
+        they are invalid.
+        """
+        Handler.__init__(self, config)
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.__config = config
+        self.__path = options.get(config, "rules", "file")
+        self.__local = threading.local()
+        self.__httplib2 = None
+        self.__mtime = None
+        self.__reload_lock = threading.Lock()
+        self.index = self.__compile()
+        self.__stopping = threading.Event()
+        self.__watcher = None
+        interval = options.getfloat(config, "rules", "reload_interval", 30.0)
+        if self.__path is not None and interval > 0:
+            self.__watcher = threading.Thread(target=self.__watch,
+                                              args=(interval,),
+                                              name="RuleHandler-reload")
+            self.__watcher.daemon = True
+            self.__watcher.start()
+
+    def patchset_created(self, event):
+        """Runs the matching rules."""
+        self.__run(event)
+
+    def change_abandoned(self, event):
+        """Runs the matching rules."""
+        self.__run(event)
+
+    def change_restored(self, event):
+        """Runs the matching rules."""
+        self.__run(event)
+
+    def change_merged(self, event):
+        """Runs the matching rules."""
+        self.__run(event)
+
+    def comment_added(self, event):
+        """Runs the matching rules."""
+        self.__run(event)
+
+    def ref_updated(self, event):
+        """Runs the matching rules."""
+        self.__run(event)
+
+    def reload(self):
+        """
+        Reads the rules file again and swaps in the new index. Returns False
+        and keeps the old rules if the new ones are invalid.
+        """
+        with self.__reload_lock:
+            try:
+                index = self.__compile()
+            except Exception, ex:
+                self.metrics.increment("rules.reload_failures")
+                print("Failed to reload rules: " + str(ex))
+                return False
+            self.index = index
+        self.metrics.increment("rules.reloads")
+        print("Loaded %d rules" % len(index))
+        return True
+
+    def close(self):
+        """
+        Stops watching the rules file.
+        """
+        self.__stopping.set()
+        if self.__watcher is not None:
+            self.__watcher.join()
+
+    def __run(self, event):
+        """
+        Runs the actions of the rules that match "event". Raises an
+        ActionError after running all of them if any failed.
+        """
+        rules = self.index.match(event)
+        if not rules:
+            return
+        values = event_values(event)
+        errors = []
+        for rule in rules:
+            self.metrics.increment("rules." + rule.name + ".matched")
+            try:
+                rule.action.run(values)
+            except Exception, ex:
+                self.metrics.increment("rules." + rule.name + ".failures")
+                errors.append((rule.name, ex))
+        if errors:
+            raise ActionError(errors)
+
+    def __compile(self):
+        """
+        Reads and compiles the rules into a new RuleIndex.
+        """
+        config = self.__config
+        if self.__path is not None:
+            self.__mtime = os.path.getmtime(self.__path)
+            config = ConfigParser()
+            if not config.read(self.__path):
+                raise IOError("can't read " + self.__path)
+        rules = []
+        for section in config.sections():
+            if section.startswith(SECTION_PREFIX):
+                rules.append(Rule.from_config(config, section, self.__http))
+        return RuleIndex(rules)
+
+    def __http(self):
+        """
+        Returns the httplib2.Http object of the calling thread.
+        """
+        http = getattr(self.__local, "http", None)
+        if http is None:
+            if self.__httplib2 is None:
+                # Loaded on first use, so that rules without HTTP actions
+                # don't need httplib2.
+                import httplib2
+                self.__httplib2 = httplib2
+            http = self.__httplib2.Http()
+            self.__local.http = http
+        return http
+
+    def __watch(self, interval):
+        """
+        Reloads the rules whenever the file changed, until closed.
+        """
+        while True:
+            self.__stopping.wait(interval)
+            if self.__stopping.is_set():
+                break
+            try:
+                changed = os.path.getmtime(self.__path) != self.__mtime
+            except OSError:
+                changed = False
+            if changed:
+                self.reload()
@@ -0,0 +1,215 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+import collections
+import heapq
+import itertools
+import threading
+import time
+from gerritevent import options
+from gerritevent.metrics import Metrics
+
+
+def event_project(event):
+    """
+    Returns the project of the event dictionary or None.
+    """
+    container = event.get("change") or event.get("refUpdate") or event
+    return container.get("project")
+
+
+class _Lane(object):
+    """
+    The queued events of one change, in the order they were put.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.entries = collections.deque()
+        self.key = None
+        self.busy = False
+
+
+class PriorityEventQueue(object):
+    """
+    Queue of event dictionaries that hands out urgent events first.
+    "priorities" maps priority classes to integer priorities (lower value
+    first, "default" for everything else). A class is an event type
+    ("change-merged"), a project ("@tools") or both
+    ("comment-added@tools"); the most specific one wins. With "aging" an
+    event gains one priority level for every "aging" seconds it waits, so
+    that no class starves; 0 disables aging.
+    Events of the same change (or the same ref for "ref-updated") are
+    always handed out in the order they were put: a change's urgent event
+    lifts the change's earlier events instead of overtaking them. Items that
+    aren't event dictionaries, like a stop marker, come after all events,
+    unless they are put with the event they belong to.
+    The time each event waited is recorded with "metrics" as timing
+    "queue_wait.<class>".
+    This class implements the put(), get() and qsize() part of Queue.
+    Several consumers use checkout() and release() instead of get(), which
+    keeps the order of each change across them.
+    """
+    def __init__(self, priorities=None, default=0, aging=1.0, metrics=None):
+        """
+        Constructs an empty PriorityEventQueue.
+        """
+        object.__init__(self)
+        self.__priorities = priorities or {}
+        self.__default = default
+        self.__aging = aging
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.__condition = threading.Condition()
+        self.__sequence = itertools.count()
+        self.__lanes = {}
+        self.__heap = []
+        self.__size = 0
+
+    @classmethod
+    def from_config(cls, config, metrics=None):
+        """
+        Returns a PriorityEventQueue configured by "priorities" (e.g.
+        "change-merged:0 ref-updated:0 comment-added:10 @sandbox:20"),
+        "default_priority" (0) and "priority_aging" (1.0 seconds) of the
+        "dispatcher" config section.
+        """
+        priorities = {}
+        for item in options.getlist(config, "dispatcher", "priorities"):
+            name, priority = item.rsplit(":", 1)
+            priorities[name] = int(priority)
+        return cls(priorities,
+                   options.getint(config, "dispatcher", "default_priority", 0),
+                   options.getfloat(config, "dispatcher", "priority_aging",
+                                    1.0),
+                   metrics)
+
+    def classify(self, event):
+        """
+        Returns the priority class and the priority of "event".
+        """
+        event_type = event.get("type")
+        project = event_project(event)
+        for name in ("%s@%s" % (event_type, project), "@%s" % project,
+                     event_type):
+            if name in self.__priorities:
+                return name, self.__priorities[name]
+        return "default", self.__default
+
+    def put(self, item, event=None):
+        """
+        Queues "item". It's scheduled like the event dictionary "event",
+        which is the item itself by default.
+        """
+        now = time.time()
+        sequence = next(self.__sequence)
+        if event is None and isinstance(item, dict):
+            event = item
+        if event is not None:
+            name, priority = self.classify(event)
+            if self.__aging > 0:
+                key = (priority * self.__aging + now, sequence)
+            else:
+                key = (priority, now, sequence)
+            lane_name = self.__lane_name(event, sequence)
+        else:
+            name = None
+            key = (float("inf"), float("inf"), sequence)
+            lane_name = ("item", sequence)
+        with self.__condition:
+            lane = self.__lanes.get(lane_name)
+            if lane is None:
+                lane = _Lane(lane_name)
+                self.__lanes[lane_name] = lane
+            lane.entries.append((key, now, name, item))
+            if lane.busy:
+                # Pushed by release().
+                pass
+            elif lane.key is None or key < lane.key:
+                lane.key = key
+                heapq.heappush(self.__heap, (key, lane))
+            self.__size += 1
+            self.__condition.notify()
+
+    def get(self):
+        """
+        Removes and returns the most urgent item, waiting until there is
+        one.
+        """
+        item, _lane, _waited = self.__take(False)
+        return item
+
+    def checkout(self):
+        """
+        Like get(), but returns the item, its lane and the seconds it waited.
+        No other item of the lane is handed out until release() was called
+        with it.
+        """
+        return self.__take(True)
+
+    def release(self, lane):
+        """
+        Lets the next item of "lane" (as returned by checkout()) be handed
+        out.
+        """
+        with self.__condition:
+            lane.busy = False
+            if lane.entries:
+                lane.key = min(entry[0] for entry in lane.entries)
+                heapq.heappush(self.__heap, (lane.key, lane))
+                self.__condition.notify()
+            else:
+                del self.__lanes[lane.name]
+
+    def qsize(self):
+        """
+        Returns the number of queued items.
+        """
+        with self.__condition:
+            return self.__size
+
+    def __take(self, checkout):
+        """
+        Removes the most urgent item, waiting until there is one, and
+        returns it with its lane and the seconds it waited. With "checkout"
+        the lane stays busy until it is released.
+        """
+        with self.__condition:
+            while True:
+                while not self.__heap:
+                    self.__condition.wait()
+                key, lane = heapq.heappop(self.__heap)
+                if key == lane.key:
+                    break
+            _key, queued, name, item = lane.entries.popleft()
+            self.__size -= 1
+            if checkout:
+                lane.busy = True
+                lane.key = None
+            elif lane.entries:
+                lane.key = min(entry[0] for entry in lane.entries)
+                heapq.heappush(self.__heap, (lane.key, lane))
+            else:
+                lane.key = None
+                del self.__lanes[lane.name]
+        waited = time.time() - queued
+        if name is not None:
+            self.metrics.timing("queue_wait." + name, waited)
+        return item, lane, waited
+
+    def __lane_name(self, event, sequence):
+        """
+        Returns the name of the lane whose order "event" has to keep.
+        """
+        change = event.get("change")
+        if change and "number" in change:
+            return ("change", str(change["number"]))
+        ref_update = event.get("refUpdate")
+        if ref_update:
+            return ("ref", ref_update.get("project"),
+                    ref_update.get("refName"))
+        if event.get("type") == "ref-updated-bulk":
+            return ("bulk", event.get("project"))
+        return ("event", sequence)
@@ -0,0 +1,209 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+import json
+import threading
+import time
+from gerritevent import options
+from gerritevent.metrics import Metrics
+
+
+class CommandError(Exception):
+    """
+    Raised when a Gerrit command exits with a non-zero status.
+    """
+    def __init__(self, command, status, stderr):
+        Exception.__init__(self, "gerrit %s exited with %d: %s"
+                           % (command, status, stderr.strip()))
+        self.command = command
+        self.status = status
+        self.stderr = stderr
+
+
+class _Transport(object):
+    """
+    An SSH client of the GerritCommandPool and the number of channels in
+    use on it.
+    """
+    def __init__(self, client, owned):
+        self.client = client
+        self.owned = owned
+        self.active = 0
+
+    def alive(self):
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+
+def quote(argument):
+    """
+    Returns "argument" quoted as one argument of a Gerrit command.
+    """
+    return '"' + argument.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class GerritCommandPool(object):
+    """
+    Runs Gerrit commands for handlers on SSH channels of already
+    authenticated connections instead of a new connection per call.
+    The dispatcher shares the connection of its event stream with the pool;
+    when all connections carry "channels_per_transport" commands, the pool
+    opens up to "max_transports" more with the callable "connect" (which
+    the dispatcher sets to its own _connect_to_gerrit if it's None). At most
+    "max_concurrent" commands run at the same time; further callers wait.
+    Usage:
+        for change in pool.run_gerrit_command("query --format=JSON 4711"):
+            ...
+    """
+    def __init__(self, connect=None, max_concurrent=4,
+                 channels_per_transport=4, max_transports=2, timeout=60.0,
+                 metrics=None):
+        """
+        Constructs an empty GerritCommandPool.
+        """
+        object.__init__(self)
+        self.connect = connect
+        self.__channels_per_transport = channels_per_transport
+        self.__max_transports = max_transports
+        self.__timeout = timeout
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.__semaphore = threading.Semaphore(max_concurrent)
+        self.__lock = threading.Lock()
+        self.__connect_lock = threading.Lock()
+        self.__transports = []
+
+    @classmethod
+    def from_config(cls, config, metrics=None):
+        """
+        Returns a GerritCommandPool configured by "max_commands" (4),
+        "channels_per_transport" (4), "max_transports" (2) and
+        "command_timeout" (60 seconds) of the "gerrit" config section.
+        """
+        section = "gerrit"
+        return cls(None,
+                   options.getint(config, section, "max_commands", 4),
+                   options.getint(config, section, "channels_per_transport",
+                                  4),
+                   options.getint(config, section, "max_transports", 2),
+                   options.getfloat(config, section, "command_timeout", 60.0),
+                   metrics)
+
+    def share(self, client):
+        """
+        Lets the pool open channels on the connected SSH "client", which
+        stays owned by the caller.
+        """
+        with self.__lock:
+            self.__transports.insert(0, _Transport(client, False))
+
+    def unshare(self, client):
+        """
+        Stops using the shared "client". Running commands finish.
+        """
+        with self.__lock:
+            self.__transports = [transport for transport in self.__transports
+                                 if transport.client is not client]
+
+    def run_gerrit_command(self, command, timeout=None):
+        """
+        Runs "gerrit <command>" and yields each line of its output as soon
+        as it arrives: parsed if it's JSON (like the output of
+        "query --format=JSON"), otherwise as string. Raises CommandError if
+        the command fails.
+        """
+        if timeout is None:
+            timeout = self.__timeout
+        self.__semaphore.acquire()
+        start = time.time()
+        transport = None
+        channel = None
+        try:
+            transport = self.__checkout()
+            channel = transport.client.get_transport().open_session()
+            channel.settimeout(timeout)
+            channel.exec_command("gerrit " + command)
+            for line in channel.makefile("r"):
+                line = line.rstrip("\r\n")
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield line
+            status = channel.recv_exit_status()
+            if status != 0:
+                self.metrics.increment("gerrit_commands.failures")
+                raise CommandError(command, status,
+                                   channel.makefile_stderr("r").read())
+        finally:
+            if channel is not None:
+                channel.close()
+            if transport is not None:
+                with self.__lock:
+                    transport.active -= 1
+            self.__semaphore.release()
+            self.metrics.timing("gerrit_commands", time.time() - start)
+
+    def query(self, query, *flags):
+        """
+        Runs "gerrit query" for "query" with the extra "flags" (e.g.
+        "--files", "--current-patch-set") and returns the list of change
+        dictionaries.
+        """
+        command = "query --format=JSON %s %s" % (" ".join(flags),
+                                                 quote(query))
+        return [row for row in self.run_gerrit_command(command)
+                if isinstance(row, dict) and row.get("type") != "stats"]
+
+    def close(self):
+        """
+        Closes the connections the pool opened itself.
+        """
+        with self.__lock:
+            transports, self.__transports = self.__transports, []
+        for transport in transports:
+            if transport.owned:
+                transport.client.close()
+
+    def __checkout(self):
+        """
+        Returns the least busy live transport and counts one more channel
+        on it, connecting a new one if all are busy.
+        """
+        with self.__connect_lock:
+            with self.__lock:
+                transport = self.__least_busy()
+                if transport is not None and \
+                        transport.active < self.__channels_per_transport:
+                    transport.active += 1
+                    return transport
+                owned = len([t for t in self.__transports if t.owned])
+            if transport is None or owned < self.__max_transports:
+                client = self.connect()
+                self.metrics.increment("gerrit_commands.connects")
+                with self.__lock:
+                    transport = _Transport(client, True)
+                    self.__transports.append(transport)
+            with self.__lock:
+                transport.active += 1
+                return transport
+
+    def __least_busy(self):
+        """
+        Returns the live transport with the fewest channels in use (or
+        None), closing the dead ones the pool owns.
+        """
+        alive = []
+        for transport in self.__transports:
+            if transport.alive():
+                alive.append(transport)
+            elif transport.owned:
+                transport.client.close()
+        self.__transports = alive
+        if not alive:
+            return None
+        return min(alive, key=lambda transport: transport.active)
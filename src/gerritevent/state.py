@@ -0,0 +1,343 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+import json
+import os
+import threading
+import time
+from gerritevent import options
+from gerritevent.cache import LRUCache
+from gerritevent.gerrit_objects import GerritApproval
+from gerritevent.handler import Handler
+
+
+class _LabelVotes(object):
+    """The votes of all reviewers for one label of one patch set."""
+
+    __slots__ = ('votes', 'value')
+
+    def __init__(self):
+        self.votes = {}
+        self.value = None
+
+    def vote(self, reviewer, value):
+        """
+        Records the vote of "reviewer" and updates the aggregated value: the
+        lowest vote if it is negative (a veto), otherwise the highest one.
+        """
+        self.votes[reviewer] = value
+        lowest = min(self.votes.values())
+        if lowest < 0:
+            self.value = lowest
+        else:
+            self.value = max(self.votes.values())
+
+
+class _ChangeVotes(object):
+    """The votes of all patch sets of one change."""
+
+    __slots__ = ('current', 'patchsets')
+
+    def __init__(self):
+        self.current = None
+        self.patchsets = {}
+
+    def patchset(self, number):
+        """Returns the votes per label of patch set "number"."""
+        if number is None:
+            number = self.current
+        return self.patchsets.get(number, {})
+
+
+class ApprovalIndex(Handler):
+    """
+    Keeps the current label votes of recently active changes in memory.
+    Register the index as a handler in front of the handlers that use it;
+    it learns the votes from "patchset-created" and "comment-added" events.
+    The number of changes kept is bounded by "max_changes" in the
+    "approvals" config section (10000 by default); the least recently
+    active change is forgotten first. All lookups are O(1):
+
+    >>> index.value(1234, 'Verified')
+    1
+    """
+    def __init__(self, config):
+        """
+        Constructs an empty ApprovalIndex.
+        """
+        Handler.__init__(self, config)
+        self.__changes = LRUCache(
+            options.getint(config, "approvals", "max_changes", 10000))
+
+    def patchset_created(self, event):
+        """
+        Makes the new patch set the current one. It starts without votes.
+        """
+        with self.__changes.lock:
+            change = self.__change(event)
+            number = int(event["patchSet"]["number"])
+            if change.current is None or number > change.current:
+                change.current = number
+
+    def comment_added(self, event):
+        """
+        Records the votes of the comment's author.
+        """
+        approvals = event.get("approvals") or []
+        author = event["author"]
+        reviewer = author.get("email") or author.get("name")
+        with self.__changes.lock:
+            change = self.__change(event)
+            number = int(event["patchSet"]["number"])
+            if change.current is None or number > change.current:
+                change.current = number
+            labels = change.patchsets.setdefault(number, {})
+            for approval in approvals:
+                label = GerritApproval.label_name(approval["type"])
+                votes = labels.get(label)
+                if votes is None:
+                    votes = labels[label] = _LabelVotes()
+                votes.vote(reviewer, int(approval["value"]))
+
+    def current_patchset(self, change_number):
+        """
+        Returns the number of the latest known patch set of the change or
+        None if the change is unknown.
+        """
+        with self.__changes.lock:
+            change = self.__changes.get(int(change_number))
+            if change is None:
+                return None
+            return change.current
+
+    def value(self, change_number, label, patchset=None):
+        """
+        Returns the aggregated value of "label" (e.g. "Verified" or "VRIF")
+        on the current or the given patch set, or None if nobody voted.
+        """
+        with self.__changes.lock:
+            votes = self.__votes(change_number, label, patchset)
+            if votes is None:
+                return None
+            return votes.value
+
+    def votes(self, change_number, label, patchset=None):
+        """
+        Returns a dictionary mapping each reviewer to their vote on "label".
+        """
+        with self.__changes.lock:
+            votes = self.__votes(change_number, label, patchset)
+            if votes is None:
+                return {}
+            return dict(votes.votes)
+
+    def labels(self, change_number, patchset=None):
+        """
+        Returns a dictionary mapping each voted label to its aggregated
+        value on the current or the given patch set.
+        """
+        with self.__changes.lock:
+            change = self.__changes.get(int(change_number))
+            if change is None:
+                return {}
+            labels = change.patchset(patchset)
+            return dict((label, votes.value)
+                        for label, votes in labels.items())
+
+    def verified(self, change_number):
+        """Returns the current "Verified" value of the change."""
+        return self.value(change_number, 'Verified')
+
+    def code_review(self, change_number):
+        """Returns the current "Code-Review" value of the change."""
+        return self.value(change_number, 'Code-Review')
+
+    def __change(self, event):
+        """
+        Returns the votes of the event's change, creating them if needed.
+        The caller must hold the lock.
+        """
+        number = int(event["change"]["number"])
+        change = self.__changes.get(number)
+        if change is None:
+            change = _ChangeVotes()
+            self.__changes.put(number, change)
+        return change
+
+    def __votes(self, change_number, label, patchset):
+        """
+        Returns the _LabelVotes or None. The caller must hold the lock.
+        """
+        change = self.__changes.get(int(change_number))
+        if change is None:
+            return None
+        label = GerritApproval.label_name(label)
+        return change.patchset(patchset).get(label)
+
+
+class ChangeView(Handler):
+    """
+    Keeps the latest known state of recently active changes in memory:
+    project, branch, change ID, URL, subject, owner, current patch set and
+    status ("NEW", "MERGED" or "ABANDONED"). Register the view as a handler
+    in front of the handlers that use it.
+    The "changes" config section sets the number of changes kept
+    ("max_changes", 10000 by default; the least recently active change is
+    forgotten first) and an optional "snapshot_file" that the view is
+    written to every "snapshot_interval" seconds (60 by default) and on
+    close(). A new view starts from the snapshot, if there is one.
+    """
+    def __init__(self, config):
+        """
+        Constructs a ChangeView and loads the snapshot, if configured.
+        """
+        Handler.__init__(self, config)
+        self.__changes = LRUCache(
+            options.getint(config, "changes", "max_changes", 10000))
+        self.__snapshot_file = options.get(config, "changes", "snapshot_file")
+        self.__snapshot_interval = options.getfloat(
+            config, "changes", "snapshot_interval", 60.0)
+        self.__dirty = False
+        self.__closed = threading.Event()
+        # Serializes the writers of the snapshot file.
+        self.__snapshot_lock = threading.Lock()
+        self.__snapshotter = None
+        if self.__snapshot_file is not None:
+            self.load()
+            self.__snapshotter = threading.Thread(
+                target=self.__snapshot_loop, name="ChangeView-snapshot")
+            self.__snapshotter.daemon = True
+            self.__snapshotter.start()
+
+    def get(self, change_number):
+        """
+        Returns a dictionary with the state of the change or None if the
+        change is unknown.
+        """
+        change = self.__changes.get(int(change_number))
+        if change is None:
+            return None
+        return dict(change)
+
+    def __len__(self):
+        """Returns the number of changes in the view."""
+        return len(self.__changes)
+
+    def patchset_created(self, event):
+        """
+        Records the new current patch set.
+        """
+        self.__update(event, status="NEW")
+
+    def change_abandoned(self, event):
+        """
+        Marks the change as abandoned.
+        """
+        self.__update(event, status="ABANDONED")
+
+    def change_restored(self, event):
+        """
+        Marks the change as new again.
+        """
+        self.__update(event, status="NEW")
+
+    def change_merged(self, event):
+        """
+        Marks the change as merged.
+        """
+        self.__update(event, status="MERGED")
+
+    def comment_added(self, event):
+        """
+        Refreshes the change from the comment's snapshot of it.
+        """
+        self.__update(event)
+
+    def close(self):
+        """
+        Writes a final snapshot and stops the periodic snapshots.
+        """
+        self.__closed.set()
+        if self.__snapshotter is not None:
+            self.__snapshotter.join()
+        if self.__snapshot_file is not None:
+            self.snapshot()
+
+    def snapshot(self):
+        """
+        Writes the view to the snapshot file, least recently active change
+        first. The file is replaced atomically, by one caller at a time.
+        """
+        with self.__snapshot_lock:
+            with self.__changes.lock:
+                data = json.dumps({"version": 1,
+                                   "changes": self.__changes.items()})
+                self.__dirty = False
+            tmp_path = self.__snapshot_file + ".tmp"
+            snapshot = open(tmp_path, "w")
+            try:
+                snapshot.write(data)
+            finally:
+                snapshot.close()
+            os.rename(tmp_path, self.__snapshot_file)
+
+    def load(self):
+        """
+        Fills the view from the snapshot file, if it exists.
+        """
+        if not os.path.exists(self.__snapshot_file):
+            return
+        snapshot = open(self.__snapshot_file)
+        try:
+            items = json.load(snapshot)["changes"]
+        finally:
+            snapshot.close()
+        with self.__changes.lock:
+            for number, change in items:
+                self.__changes.put(int(number), change)
+
+    def __update(self, event, status=None):
+        """
+        Merges the change and patch set of "event" into the view.
+        """
+        dct = event["change"]
+        number = int(dct["number"])
+        with self.__changes.lock:
+            change = self.__changes.get(number)
+            if change is None:
+                change = {"number": number, "status": "NEW",
+                          "current_patchset": None}
+                self.__changes.put(number, change)
+            for key in ("project", "branch", "id", "subject", "url"):
+                if key in dct:
+                    change[key] = dct[key]
+            if "owner" in dct:
+                change["owner"] = dict(dct["owner"])
+            patchset = event.get("patchSet")
+            if patchset is not None:
+                number = int(patchset["number"])
+                if (change["current_patchset"] is None or
+                        number > change["current_patchset"]):
+                    change["current_patchset"] = number
+            if status is not None:
+                change["status"] = status
+            change["updated"] = int(time.time())
+            self.__dirty = True
+
+    def __snapshot_loop(self):
+        """
+        Writes a snapshot every "snapshot_interval" seconds if the view
+        changed, until the view is closed.
+        """
+        while True:
+            self.__closed.wait(self.__snapshot_interval)
+            if self.__closed.is_set():
+                break
+            if not self.__dirty:
+                continue
+            try:
+                self.snapshot()
+            except Exception, ex:
+                print("Failed to write ChangeView snapshot: " + str(ex))
@@ -0,0 +1,269 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+import contextlib
+import json
+import random
+import threading
+import time
+from gerritevent import options
+
+# Holds the trace of the event the current thread works on.
+_local = threading.local()
+
+
+def current():
+    """
+    Returns the Trace the calling thread works on or None.
+    """
+    return getattr(_local, "trace", None)
+
+
+def context():
+    """
+    Returns the Trace the calling thread works on and its innermost open
+    span, to be handed to activate() in another thread, or (None, None).
+    """
+    trace = current()
+    if trace is None:
+        return None, None
+    return trace, trace.innermost()
+
+
+def activate(trace, parent=None):
+    """
+    Makes "trace" (or None) the Trace of the calling thread. The spans the
+    thread begins are children of the span "parent" (the root by default).
+    """
+    _local.trace = trace
+    if trace is not None:
+        trace.adopt(parent)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """
+    Records the enclosed block as span "name" of the current trace, if
+    there is one. Meant for outbound calls of handlers, e.g.
+        with tracing.span("http.PUT", url=url):
+            http.request(...)
+    """
+    trace = current()
+    if trace is None:
+        yield
+        return
+    span_id = trace.begin(name, **attributes)
+    error = None
+    try:
+        yield
+    except Exception, ex:
+        error = ex
+        raise
+    finally:
+        trace.end(span_id, error)
+
+
+class Trace(object):
+    """
+    The spans recorded for one event, from reading it to the last handler.
+    Spans nest per thread: a span is the child of the innermost span its
+    thread has open, of the span the thread was activated with (see
+    activate()) or of the root. Times are seconds since the epoch.
+    """
+    def __init__(self, exporter, start=None):
+        """
+        Constructs a Trace whose root span "event" starts at "start".
+        """
+        object.__init__(self)
+        self.trace_id = "%032x" % random.getrandbits(128)
+        self.__exporter = exporter
+        self.spans = []
+        self.__open = {}
+        self.__lock = threading.Lock()
+        # Holds the "stack" of open spans and the "parent" of each thread.
+        self.__local = threading.local()
+        self.root = self.__open_span("event", None, start, {})
+
+    def adopt(self, parent=None):
+        """
+        Makes the spans the calling thread begins children of "parent" (the
+        root by default).
+        """
+        self.__local.parent = parent
+
+    def innermost(self):
+        """
+        Returns the ID of the span the calling thread's next span is a child
+        of.
+        """
+        stack = getattr(self.__local, "stack", None)
+        if stack:
+            return stack[-1]
+        return getattr(self.__local, "parent", None) or self.root
+
+    def begin(self, name, start=None, **attributes):
+        """
+        Starts the span "name" as child of the calling thread's innermost
+        span and returns its ID.
+        """
+        span_id = self.__open_span(name, self.innermost(), start, attributes)
+        if getattr(self.__local, "stack", None) is None:
+            self.__local.stack = []
+        self.__local.stack.append(span_id)
+        return span_id
+
+    def end(self, span_id, error=None, end=None, **attributes):
+        """
+        Ends the span "span_id", marking it as failed if "error" is given.
+        """
+        stack = getattr(self.__local, "stack", None)
+        if stack and span_id in stack:
+            stack.remove(span_id)
+        with self.__lock:
+            span = self.__open.pop(span_id, None)
+            if span is None:
+                return
+            span["end"] = end or time.time()
+            span["attributes"].update(attributes)
+            if error is not None:
+                span["error"] = str(error)
+            self.spans.append(span)
+
+    def add(self, name, start, end, **attributes):
+        """
+        Records the already finished span "name".
+        """
+        self.end(self.begin(name, start, **attributes), end=end)
+
+    def finish(self, **attributes):
+        """
+        Ends all open spans, the root last, and hands the trace to the
+        exporter.
+        """
+        with self.__lock:
+            spans = sorted(self.__open.values(),
+                           key=lambda span: (span["span_id"] != self.root,
+                                             span["start"]))
+        for span in reversed(spans):
+            self.end(span["span_id"],
+                     **(attributes if span["span_id"] == self.root else {}))
+        try:
+            self.__exporter.export(self.spans)
+        except Exception, ex:
+            print("Failed to export trace: " + str(ex))
+
+    def __open_span(self, name, parent_id, start, attributes):
+        """
+        Records the span "name" as open and returns its ID.
+        """
+        span_id = "%016x" % random.getrandbits(64)
+        with self.__lock:
+            self.__open[span_id] = {
+                "trace_id": self.trace_id, "span_id": span_id,
+                "parent_id": parent_id, "name": name,
+                "start": start or time.time(), "attributes": attributes}
+        return span_id
+
+
+class Exporter(object):
+    """
+    Base class for the exporters the Tracer hands finished traces to.
+    """
+    def export(self, spans):
+        """
+        Exports the list of span dictionaries of one trace.
+        """
+        raise NotImplementedError()
+
+
+class JSONFileExporter(Exporter):
+    """
+    Appends each span as one JSON line to the file "path".
+    """
+    def __init__(self, path):
+        Exporter.__init__(self)
+        self.path = path
+        self.__lock = threading.Lock()
+
+    def export(self, spans):
+        lines = "".join(json.dumps(span) + "\n" for span in spans)
+        with self.__lock:
+            with open(self.path, "a") as traces:
+                traces.write(lines)
+
+
+class OpenTelemetryExporter(Exporter):
+    """
+    Re-creates the spans with the OpenTelemetry API, so that they go to
+    whatever the OpenTelemetry SDK of the process is configured with.
+    Needs the opentelemetry-api package.
+    """
+    def __init__(self, name="gerritevent"):
+        Exporter.__init__(self)
+        from opentelemetry import trace
+        self.__trace = trace
+        self.__tracer = trace.get_tracer(name)
+
+    def export(self, spans):
+        created = {}
+        for span in sorted(spans, key=lambda span: span["start"]):
+            context = None
+            parent = created.get(span["parent_id"])
+            if parent is not None:
+                context = self.__trace.set_span_in_context(parent)
+            otel_span = self.__tracer.start_span(
+                span["name"], context=context,
+                attributes=span["attributes"],
+                start_time=int(span["start"] * 1e9))
+            if "error" in span:
+                otel_span.set_attribute("error", span["error"])
+            created[span["span_id"]] = otel_span
+        for span in spans:
+            created[span["span_id"]].end(end_time=int(span["end"] * 1e9))
+
+
+class Tracer(object):
+    """
+    Starts a Trace for a "sample_rate" share of the events (0.0 to 1.0)
+    and exports it with "exporter" when it's finished. Unsampled events
+    get no Trace at all, so tracing costs one random number per event.
+    """
+    def __init__(self, exporter, sample_rate=1.0):
+        """
+        Constructs a Tracer.
+        """
+        object.__init__(self)
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Returns a Tracer configured by "sample_rate" (0.01), "exporter"
+        ("json" or "opentelemetry") and "file" (for "json") of the "tracing"
+        config section, or None if there is no such section or nothing is
+        sampled.
+        """
+        section = "tracing"
+        if not config.has_section(section):
+            return None
+        sample_rate = options.getfloat(config, section, "sample_rate", 0.01)
+        if sample_rate <= 0:
+            return None
+        if options.get(config, section, "exporter", "json") == \
+                "opentelemetry":
+            exporter = OpenTelemetryExporter()
+        else:
+            exporter = JSONFileExporter(config.get(section, "file"))
+        return cls(exporter, sample_rate)
+
+    def start(self, start=None):
+        """
+        Returns a new Trace starting at "start", or None if the event isn't
+        sampled.
+        """
+        if random.random() >= self.sample_rate:
+            return None
+        return Trace(self.exporter, start)
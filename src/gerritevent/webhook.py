@@ -0,0 +1,227 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+import hashlib
+import hmac
+import json
+import sys
+import threading
+from gerritevent import options
+from gerritevent.metrics import Metrics
+from gerritevent.publisher import parse_address
+if sys.version_info < (3, 0):
+    import BaseHTTPServer as httpserver
+    import Queue as queue
+    import SocketServer as socketserver
+else:
+    import http.server as httpserver
+    import queue
+    import socketserver
+
+# Put into the intake queue to tell the forwarder that no more events come.
+_STOP = object()
+
+SIGNATURE_HEADER = "X-Gerrit-Signature"
+
+
+def sign(secret, body):
+    """
+    Returns the signature of the request "body" as expected in the
+    X-Gerrit-Signature header: "sha256=" and the hex HMAC-SHA256 digest.
+    """
+    return "sha256=" + hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+
+def _constant_time_compare(first, second):
+    """
+    Returns True if the strings are equal, taking the same time wherever
+    they differ. Used where hmac.compare_digest() is missing (before
+    Python 2.7.7).
+    """
+    result = len(first) ^ len(second)
+    if len(first) != len(second):
+        # Still compares all characters of "first".
+        second = first
+    for left, right in zip(first, second):
+        result |= ord(left) ^ ord(right)
+    return result == 0
+
+_compare_digest = getattr(hmac, "compare_digest", _constant_time_compare)
+
+
+def normalize(body):
+    """
+    Returns the list of event dictionaries in the webhook request "body".
+    The body holds one event, a JSON array of events or one event per line,
+    each in the JSON format of "gerrit stream-events". Events that are
+    wrapped like {"event": {...}} are unwrapped. Raises ValueError if the
+    body isn't valid.
+    """
+    body = body.strip()
+    if body.startswith(b"["):
+        events = json.loads(body)
+    else:
+        events = [json.loads(line) for line in body.splitlines()
+                  if line.strip()]
+    normalized = []
+    for event in events:
+        if isinstance(event, dict) and isinstance(event.get("event"), dict):
+            event = event["event"]
+        if not isinstance(event, dict) or "type" not in event:
+            raise ValueError("Not a Gerrit event: " + repr(event)[:100])
+        normalized.append(event)
+    return normalized
+
+
+class _WebhookRequestHandler(httpserver.BaseHTTPRequestHandler):
+    """
+    Accepts the event POSTs of the Gerrit webhooks plugin.
+    """
+
+    def do_POST(self):
+        receiver = self.server.receiver
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        status = receiver.receive(body, self.headers.get(SIGNATURE_HEADER))
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                           httpserver.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class WebhookReceiver(object):
+    """
+    Receives Gerrit events pushed by the webhooks plugin over HTTP, as an
+    alternative or in addition to "gerrit stream-events" over SSH.
+    Each POST to "address" ("host:port") may carry a batch of events (see
+    normalize()). If a "secret" is given, the X-Gerrit-Signature header
+    must hold the HMAC of the body (see sign()). Accepted batches wait in an
+    intake queue of at most "max_pending" events and are handed one by one
+    to "sink" by a forwarder thread; when the queue is full the request is
+    answered with 503 so the sender retries later. A batch of more than
+    "max_pending" events never fits and is answered with 413.
+    """
+    def __init__(self, address, sink, secret=None, max_pending=1000,
+                 metrics=None):
+        """
+        Constructs a WebhookReceiver. Call start() to start serving.
+        """
+        object.__init__(self)
+        self.address = address
+        self.__sink = sink
+        self.__secret = secret
+        self.__max_pending = max_pending
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.__intake = queue.Queue()
+        self.__pending = 0
+        self.__lock = threading.Lock()
+        self.__server = None
+        self.__forwarder = None
+
+    @classmethod
+    def from_config(cls, config, sink, metrics=None):
+        """
+        Returns a WebhookReceiver configured by "address", "secret" and
+        "max_pending" of the "webhook" config section or None if there is
+        no address.
+        """
+        address = options.get(config, "webhook", "address")
+        if address is None:
+            return None
+        return cls(address, sink,
+                   options.get(config, "webhook", "secret"),
+                   options.getint(config, "webhook", "max_pending", 1000),
+                   metrics)
+
+    def start(self):
+        """
+        Binds the socket and starts serving in background threads.
+        """
+        _family, bind_address = parse_address(self.address)
+        self.__server = _ThreadingHTTPServer(bind_address,
+                                             _WebhookRequestHandler)
+        self.__server.receiver = self
+        self.address = "%s:%d" % self.__server.server_address
+        self.__forwarder = threading.Thread(target=self.__forward,
+                                            name="WebhookReceiver-forwarder")
+        self.__forwarder.daemon = True
+        self.__forwarder.start()
+        thread = threading.Thread(target=self.__server.serve_forever,
+                                  name="WebhookReceiver")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """
+        Stops accepting requests and hands all accepted events to the sink.
+        """
+        if self.__server is None:
+            return
+        self.__server.shutdown()
+        self.__server.server_close()
+        self.__server = None
+        self.__intake.put(_STOP)
+        self.__forwarder.join()
+
+    def pending(self):
+        """
+        Returns the number of accepted events not yet handed to the sink.
+        """
+        with self.__lock:
+            return self.__pending
+
+    def receive(self, body, signature=None):
+        """
+        Verifies and queues the events of one request. Returns the HTTP
+        status to answer with.
+        """
+        self.metrics.increment("webhook.requests")
+        if self.__secret is not None and not _compare_digest(
+                sign(self.__secret, body), str(signature or "")):
+            self.metrics.increment("webhook.unauthorized")
+            return 401
+        try:
+            events = normalize(body)
+        except ValueError:
+            self.metrics.increment("webhook.invalid")
+            return 400
+        if len(events) > self.__max_pending:
+            self.metrics.increment("webhook.too_large")
+            return 413
+        with self.__lock:
+            if self.__pending + len(events) > self.__max_pending:
+                self.metrics.increment("webhook.overflows")
+                return 503
+            self.__pending += len(events)
+        self.__intake.put(events)
+        self.metrics.increment("webhook.events", len(events))
+        return 202
+
+    def __forward(self):
+        """
+        Hands the queued events to the sink until told to stop.
+        """
+        while True:
+            events = self.__intake.get()
+            if events is _STOP:
+                break
+            for event in events:
+                try:
+                    self.__sink(event)
+                except Exception, ex:
+                    print((str(self)) + " Failed to forward event: " +
+                          str(ex))
+            with self.__lock:
+                self.__pending -= len(events)
@@ -0,0 +1,404 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+import threading
+import time
+from gerritevent import options
+from gerritevent import tracing
+from gerritevent.metrics import Metrics
+from gerritevent.scheduling import PriorityEventQueue
+
+# Put into the queue to end one worker.
+_STOP = object()
+
+# Put into the queue to end one worker if the pool is larger than wanted.
+_RETIRE = object()
+
+
+class Autoscaler(object):
+    """
+    Decides how many workers a WorkerPool needs, between "min_workers" and
+    "max_workers".
+    The pressure on the pool is the mean time the events waited in the
+    queue, or the time the queued backlog will take at the observed handler
+    latency, whichever is larger. After "up_after" consecutive intervals
+    with a pressure above "scale_up_wait" seconds the pool grows by half
+    (at least by one worker); after "down_after" consecutive intervals
+    below "scale_down_wait" seconds it shrinks by one worker. The gap
+    between the two and the consecutive intervals keep the pool from
+    flapping. While a handler is saturated (see HandlerGuard) the pool
+    doesn't grow, since more workers would only wait for that handler.
+    """
+    def __init__(self, min_workers=1, max_workers=4, scale_up_wait=1.0,
+                 scale_down_wait=0.1, up_after=2, down_after=6):
+        """
+        Constructs an Autoscaler.
+        """
+        object.__init__(self)
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.__scale_up_wait = scale_up_wait
+        self.__scale_down_wait = scale_down_wait
+        self.__up_after = up_after
+        self.__down_after = down_after
+        self.__up = 0
+        self.__down = 0
+
+    def decide(self, workers, wait, latency, backlog, saturated=False):
+        """
+        Returns the number of workers for the next interval, given the
+        current number of "workers", the mean queue "wait" and handler
+        "latency" (in seconds) of the last interval, the number of queued
+        events ("backlog") and whether a handler is "saturated".
+        """
+        pressure = wait
+        if workers > 0:
+            pressure = max(wait, backlog * latency / workers)
+        if pressure > self.__scale_up_wait and not saturated:
+            self.__up += 1
+            self.__down = 0
+        elif pressure < self.__scale_down_wait:
+            self.__down += 1
+            self.__up = 0
+        else:
+            self.__up = 0
+            self.__down = 0
+        target = workers
+        if self.__up >= self.__up_after:
+            self.__up = 0
+            target = workers + max(1, workers // 2)
+        elif self.__down >= self.__down_after:
+            self.__down = 0
+            target = workers - 1
+        return max(self.min_workers, min(self.max_workers, target))
+
+
+class WorkerPool(object):
+    """
+    Threads that take items from a PriorityEventQueue and hand them to the
+    callable "work". The lane of an item is checked out while it's worked
+    on, so that the events of one change are still handled one after the
+    other and in order.
+    The pool starts with "autoscaler.min_workers" threads. If it may grow,
+    the "autoscaler" is asked every "interval" seconds how many workers are
+    needed; "saturated" is a callable that tells whether a handler is at
+    its limit. Changes are printed and counted in "metrics" as
+    "workers.scaled_up" and "workers.scaled_down"; the gauges "workers",
+    "workers.queue_wait" and "workers.latency" show the last interval.
+    """
+    def __init__(self, events_queue, work, autoscaler=None, interval=5.0,
+                 saturated=None, metrics=None, name="worker"):
+        """
+        Constructs a WorkerPool. Call start() to start the workers.
+        """
+        object.__init__(self)
+        self.__queue = events_queue
+        self.__work = work
+        if autoscaler is None:
+            autoscaler = Autoscaler(1, 1)
+        self.autoscaler = autoscaler
+        self.__interval = interval
+        self.__saturated = saturated
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.__name = name
+        self.__lock = threading.Lock()
+        self.__threads = []
+        self.__target = autoscaler.min_workers
+        self.__markers = 0
+        self.__started = 0
+        self.__waits = [0, 0.0]
+        self.__latencies = [0, 0.0]
+        self.__stopping = threading.Event()
+        self.__scaler = None
+
+    @classmethod
+    def from_config(cls, config, events_queue, work, saturated=None,
+                    metrics=None, name="worker"):
+        """
+        Returns a WorkerPool configured by "min_workers" (1), "max_workers"
+        (1), "scale_interval" (5 seconds), "scale_up_wait" (1.0 seconds),
+        "scale_down_wait" (0.1 seconds), "scale_up_after" (2 intervals) and
+        "scale_down_after" (6 intervals) of the "dispatcher" config section.
+        """
+        section = "dispatcher"
+        min_workers = options.getint(config, section, "min_workers", 1)
+        autoscaler = Autoscaler(
+            min_workers,
+            max(min_workers,
+                options.getint(config, section, "max_workers", min_workers)),
+            options.getfloat(config, section, "scale_up_wait", 1.0),
+            options.getfloat(config, section, "scale_down_wait", 0.1),
+            options.getint(config, section, "scale_up_after", 2),
+            options.getint(config, section, "scale_down_after", 6))
+        return cls(events_queue, work, autoscaler,
+                   options.getfloat(config, section, "scale_interval", 5.0),
+                   saturated, metrics, name)
+
+    def start(self):
+        """
+        Starts the workers and, if the pool may grow, the autoscaling.
+        """
+        self.resize(self.autoscaler.min_workers)
+        if self.autoscaler.max_workers > self.autoscaler.min_workers:
+            self.__scaler = threading.Thread(target=self.__scale_loop,
+                                             name=self.__name + "-scaler")
+            self.__scaler.daemon = True
+            self.__scaler.start()
+
+    def size(self):
+        """
+        Returns the number of running workers.
+        """
+        with self.__lock:
+            return len(self.__threads)
+
+    def backlog(self):
+        """
+        Returns the number of queued items, not counting the pool's own
+        markers.
+        """
+        with self.__lock:
+            markers = self.__markers
+        return max(0, self.__queue.qsize() - markers)
+
+    def resize(self, workers):
+        """
+        Starts or retires workers until there are "workers" of them. Retired
+        workers end once they finished their current item and the queue
+        has no more events.
+        """
+        with self.__lock:
+            if self.__stopping.is_set():
+                return
+            self.__target = workers
+            missing = workers - len(self.__threads)
+            for _ in range(missing):
+                self.__started += 1
+                thread = threading.Thread(
+                    target=self.__run,
+                    name="%s-%d" % (self.__name, self.__started))
+                thread.daemon = True
+                self.__threads.append(thread)
+                thread.start()
+            retire = max(0, -missing)
+            self.__markers += retire
+        for _ in range(retire):
+            self.__queue.put(_RETIRE)
+
+    def stop(self):
+        """
+        Tells all workers to end once the queued events are handled.
+        """
+        with self.__lock:
+            self.__stopping.set()
+            self.__target = 0
+            workers = len(self.__threads)
+            self.__markers += workers
+        for _ in range(workers):
+            self.__queue.put(_STOP)
+
+    def join(self, timeout=None):
+        """
+        Waits at most "timeout" seconds (or until done if None) for the
+        workers to end after stop(). Returns True if all of them ended.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.__lock:
+            threads = list(self.__threads)
+        if self.__scaler is not None:
+            threads.append(self.__scaler)
+        for thread in threads:
+            if deadline is None:
+                thread.join()
+            else:
+                thread.join(max(0.0, deadline - time.time()))
+        return self.size() == 0
+
+    def __run(self):
+        """
+        Works on the queued items until told to end.
+        """
+        while True:
+            item, lane, waited = self.__queue.checkout()
+            if item is _STOP or item is _RETIRE:
+                self.__queue.release(lane)
+                with self.__lock:
+                    self.__markers -= 1
+                    if item is _STOP or \
+                            len(self.__threads) > self.__target:
+                        self.__threads.remove(threading.current_thread())
+                        return
+                continue
+            start = time.time()
+            try:
+                self.__work(item)
+            except Exception, ex:
+                print(self.__name + " failed: " + str(ex))
+            finally:
+                self.__queue.release(lane)
+                latency = time.time() - start
+                with self.__lock:
+                    self.__waits[0] += 1
+                    self.__waits[1] += waited
+                    self.__latencies[0] += 1
+                    self.__latencies[1] += latency
+
+    def __scale_loop(self):
+        """
+        Adjusts the number of workers every interval until stopped.
+        """
+        while True:
+            self.__stopping.wait(self.__interval)
+            if self.__stopping.is_set():
+                break
+            try:
+                self.__scale()
+            except Exception, ex:
+                print(self.__name + " failed to scale: " + str(ex))
+
+    def __scale(self):
+        """
+        Asks the autoscaler for the number of workers and applies it.
+        """
+        with self.__lock:
+            waits, self.__waits = self.__waits, [0, 0.0]
+            latencies, self.__latencies = self.__latencies, [0, 0.0]
+            workers = len(self.__threads)
+        wait = 0.0
+        if waits[0]:
+            wait = waits[1] / waits[0]
+        latency = 0.0
+        if latencies[0]:
+            latency = latencies[1] / latencies[0]
+        backlog = self.backlog()
+        saturated = self.__saturated is not None and self.__saturated()
+        self.metrics.gauge("workers", workers)
+        self.metrics.gauge("workers.queue_wait", wait)
+        self.metrics.gauge("workers.latency", latency)
+        target = self.autoscaler.decide(workers, wait, latency, backlog,
+                                        saturated)
+        if target == workers:
+            return
+        if target > workers:
+            self.metrics.increment("workers.scaled_up")
+        else:
+            self.metrics.increment("workers.scaled_down")
+        print("%s scaling from %d to %d workers (queue wait %.3fs, "
+              "latency %.3fs, backlog %d)"
+              % (self.__name, workers, target, wait, latency, backlog))
+        self.resize(target)
+        self.metrics.gauge("workers", target)
+
+
+class HandlerExecutor(object):
+    """
+    Runs the calls of one HandlerGuard in "threads" threads of its own, so
+    that a slow handler only holds up its own calls: the workers queue the
+    calls and move on to the other handlers. The calls for the events of
+    one change still run one after the other and in order.
+    At most "max_backlog" calls wait; further callers block until there is
+    room again, which counts as saturated and in "metrics" as
+    "handler.<class name>.backlog_full".
+    """
+    def __init__(self, guard, threads=1, max_backlog=1000, metrics=None):
+        """
+        Constructs a HandlerExecutor. Call start() to start its threads.
+        """
+        object.__init__(self)
+        self.guard = guard
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.__queue = PriorityEventQueue()
+        self.__pool = WorkerPool(self.__queue, self.__run,
+                                 Autoscaler(threads, threads),
+                                 name="handler-" + guard.name)
+        self.__room = threading.Semaphore(max_backlog)
+        self.__lock = threading.Lock()
+        self.__waiting = 0
+        # Counts the queued calls by id() of their events.
+        self.__queued = {}
+
+    def start(self):
+        """
+        Starts the threads.
+        """
+        self.__pool.start()
+
+    def saturated(self):
+        """
+        Returns True if callers wait for room in the backlog.
+        """
+        return self.__waiting > 0
+
+    def backlog(self):
+        """
+        Returns the number of queued calls.
+        """
+        return self.__pool.backlog()
+
+    def queued(self):
+        """
+        Returns the set of id()s of the events with queued calls.
+        """
+        with self.__lock:
+            return set(self.__queued)
+
+    def submit(self, callback, event, raw=None, done=None):
+        """
+        Queues the call of "callback" with "event" (see HandlerGuard.call())
+        and calls "done" once it returned. The trace of the calling thread
+        and its innermost span are carried over.
+        """
+        if not self.__room.acquire(False):
+            self.metrics.increment("handler." + self.guard.name +
+                                   ".backlog_full")
+            with self.__lock:
+                self.__waiting += 1
+            try:
+                self.__room.acquire()
+            finally:
+                with self.__lock:
+                    self.__waiting -= 1
+        if raw is None:
+            raw = event
+        with self.__lock:
+            self.__queued[id(raw)] = self.__queued.get(id(raw), 0) + 1
+        self.__queue.put((callback, event, raw, tracing.context(), done),
+                         raw)
+
+    def stop(self):
+        """
+        Tells the threads to end once the queued calls are done.
+        """
+        self.__pool.stop()
+
+    def join(self, timeout=None):
+        """
+        Waits like WorkerPool.join() and returns True if all threads ended.
+        """
+        return self.__pool.join(timeout)
+
+    def __run(self, item):
+        """
+        Makes one queued call.
+        """
+        callback, event, raw, context, done = item
+        with self.__lock:
+            self.__queued[id(raw)] -= 1
+            if not self.__queued[id(raw)]:
+                del self.__queued[id(raw)]
+        tracing.activate(*context)
+        try:
+            self.guard.call(callback, event, raw=raw)
+        finally:
+            tracing.activate(None)
+            self.__room.release()
+            if done is not None:
+                done()
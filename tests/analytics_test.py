@@ -0,0 +1,178 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+from gerritevent.analytics import QuantileSketch
+from gerritevent.analytics import ReviewLatencyHandler
+from gerritevent.analytics import RollingQuantileSketch
+from gerritevent.metrics import Metrics
+import sample_events
+import sys
+import unittest
+import StringIO
+if sys.version_info < (3, 0):
+    from ConfigParser import ConfigParser
+else:
+    from configparser import ConfigParser
+
+
+class QuantileSketchTest(unittest.TestCase):
+    """
+    This class tests the quantile sketches of gerritevent.analytics.
+    """
+    def test_relative_accuracy(self):
+        """
+        Test that the estimates are within the relative accuracy and the
+        number of buckets stays bounded.
+        """
+        sketch = QuantileSketch(accuracy=0.01, max_bins=1024)
+        for value in range(1, 10001):
+            sketch.add(value)
+        for q in (0.5, 0.9, 0.99):
+            expected = q * 9999 + 1
+            self.assertTrue(abs(sketch.quantile(q) - expected) <=
+                            0.011 * expected)
+        self.assertTrue(len(sketch.bins) <= 1024)
+        small = QuantileSketch(max_bins=10)
+        for value in range(1, 10001):
+            small.add(value)
+        self.assertEqual(10, len(small.bins))
+        self.assertEqual(None, QuantileSketch().quantile(0.5))
+
+    def test_rolling_window(self):
+        """
+        Test that values older than the window are forgotten.
+        """
+        rolling = RollingQuantileSketch(window=100, slots=10)
+        rolling.add(1000, now=0)
+        rolling.add(10, now=95)
+        self.assertEqual(2, rolling.sketch(now=99).count)
+        self.assertEqual(1, rolling.sketch(now=150).count)
+        self.assertEqual(0, rolling.sketch(now=300).count)
+
+    def test_late_values_keep_live_slots(self):
+        """
+        Test that a value older than the window doesn't reset the slot the
+        current values are in.
+        """
+        rolling = RollingQuantileSketch(window=100, slots=10)
+        rolling.add(10, now=1005)
+        rolling.add(20, now=1006)
+        rolling.add(30, now=5)
+        self.assertEqual(2, rolling.sketch(now=1009).count)
+
+
+class ReviewLatencyHandlerTest(unittest.TestCase):
+    """
+    This class tests the gerritevent.analytics.ReviewLatencyHandler class.
+    """
+    def test_latencies(self):
+        """
+        Test time to first review, time to merge and patch sets per change.
+        """
+        config = ConfigParser()
+        config.readfp(StringIO.StringIO("""[review_latency]
+window: 1000000000000
+"""))
+        metrics = Metrics()
+        handler = ReviewLatencyHandler(config, metrics)
+        handler.patchset_created(sample_events.patchset_created(
+            1, 1, created_on=1000))
+        own = sample_events.comment_added(1, 1, author="alice")
+        own["eventCreatedOn"] = 1100
+        handler.comment_added(own)
+        review = sample_events.comment_added(1, 1)
+        review["eventCreatedOn"] = 1600
+        handler.comment_added(review)
+        handler.patchset_created(sample_events.patchset_created(
+            1, 2, created_on=2000))
+        merged = sample_events.change_merged(1, 2)
+        merged["eventCreatedOn"] = 4600
+        handler.change_merged(merged)
+        values = metrics.snapshot()
+        self.assertEqual(1, values["review.tools.time_to_first_review.count"])
+        self.assertAlmostEqual(
+            600, values["review.tools.time_to_first_review.p50"], delta=6)
+        self.assertAlmostEqual(
+            3600, values["review.tools.time_to_merge.p99"], delta=36)
+        self.assertAlmostEqual(
+            2, values["review.tools.patchsets.p50"], delta=0.02)
+
+    def test_author_without_email(self):
+        """
+        Test that an author without email counts as the owner only if the
+        usernames match, and never because both emails are missing.
+        """
+        config = ConfigParser()
+        config.readfp(StringIO.StringIO("""[review_latency]
+window: 1000000000000
+"""))
+        metrics = Metrics()
+        handler = ReviewLatencyHandler(config, metrics)
+        for number in (1, 2):
+            handler.patchset_created(sample_events.patchset_created(
+                number, 1, created_on=1000))
+        own = sample_events.comment_added(1, 1, author="alice")
+        own["author"] = {"name": "Alice", "username": "alice"}
+        own["change"]["owner"] = {"name": "Alice", "username": "alice"}
+        own["eventCreatedOn"] = 1100
+        handler.comment_added(own)
+        review = sample_events.comment_added(2, 1)
+        del review["author"]["email"]
+        del review["change"]["owner"]["email"]
+        review["eventCreatedOn"] = 1300
+        handler.comment_added(review)
+        values = metrics.snapshot()
+        self.assertEqual(1, values["review.tools.time_to_first_review.count"])
+        self.assertAlmostEqual(
+            300, values["review.tools.time_to_first_review.p50"], delta=3)
+
+    def test_changes_created_before_start(self):
+        """
+        Test that changes whose patch set creation wasn't seen are timed
+        from the patch set of their events.
+        """
+        config = ConfigParser()
+        config.readfp(StringIO.StringIO("""[review_latency]
+window: 1000000000000
+"""))
+        metrics = Metrics()
+        handler = ReviewLatencyHandler(config, metrics)
+        review = sample_events.comment_added(1, 1)
+        review["patchSet"]["createdOn"] = 1000
+        review["eventCreatedOn"] = 1400
+        handler.comment_added(review)
+        merged = sample_events.change_merged(2, 3)
+        merged["patchSet"]["createdOn"] = 1000
+        merged["eventCreatedOn"] = 1900
+        handler.change_merged(merged)
+        values = metrics.snapshot()
+        self.assertAlmostEqual(
+            400, values["review.tools.time_to_first_review.p50"], delta=4)
+        self.assertAlmostEqual(
+            900, values["review.tools.time_to_merge.p50"], delta=9)
+        self.assertAlmostEqual(
+            3, values["review.tools.patchsets.p50"], delta=0.03)
+
+    def test_projects_are_bounded(self):
+        """
+        Test that only the most recently active projects are kept.
+        """
+        config = ConfigParser()
+        config.readfp(StringIO.StringIO("""[review_latency]
+window: 1000000000000
+max_projects: 2
+"""))
+        metrics = Metrics()
+        handler = ReviewLatencyHandler(config, metrics)
+        for number, project in enumerate(["a", "b", "c"]):
+            merged = sample_events.change_merged(number)
+            merged["change"]["project"] = project
+            merged["eventCreatedOn"] = 2000
+            handler.change_merged(merged)
+        projects = set(name.split(".")[0] for name in handler.values())
+        self.assertEqual(set(["b", "c"]), projects)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,231 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+from gerritevent.cluster import ClusterMember
+from gerritevent.cluster import SQLiteLeaseStore
+import gerritevent
+import mock
+import os
+import sample_events
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import StringIO
+if sys.version_info < (3, 0):
+    from ConfigParser import ConfigParser
+else:
+    from configparser import ConfigParser
+
+
+def project_events(count):
+    """
+    Returns "count" events of as many projects.
+    """
+    events = []
+    for number in range(count):
+        event = sample_events.comment_added(number)
+        event["change"]["project"] = "project-%d" % number
+        events.append(event)
+    return events
+
+
+class ClusterMemberTest(unittest.TestCase):
+    """
+    This class tests the gerritevent.cluster.ClusterMember class with the
+    SQLiteLeaseStore.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "leases.db")
+        self.replayed = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def member(self, node):
+        return ClusterMember(SQLiteLeaseStore(self.path),
+                             self.replayed.append, node=node, partitions=8,
+                             ttl=0.3)
+
+    def test_partitions_are_shared(self):
+        """
+        Test that two members split the partitions and accept every event
+        exactly once.
+        """
+        first = self.member("first")
+        second = self.member("second")
+        first.rebalance()
+        self.assertEqual(set(range(8)), first.owned())
+        second.rebalance()
+        first.rebalance()
+        second.rebalance()
+        self.assertEqual(set(range(8)), first.owned() | second.owned())
+        self.assertEqual(set(), first.owned() & second.owned())
+        self.assertTrue(first.owned() and second.owned())
+        for event in project_events(40):
+            self.assertNotEqual(first.accept(event), second.accept(event))
+
+    def test_failover_replays_unfinished_events(self):
+        """
+        Test that the partitions of a dead member are taken over and its
+        unfinished events are handed to the sink.
+        """
+        first = self.member("first")
+        second = self.member("second")
+        first.rebalance()
+        events = [sample_events.comment_added(1) for _ in range(3)]
+        for number, event in enumerate(events):
+            event["comment"] = "comment %d" % number
+            self.assertTrue(first.accept(event))
+            self.assertFalse(second.accept(event))
+            if number < 2:
+                first.done(event)
+            if number == 1:
+                first.rebalance()
+        # "first" dies without releasing its leases.
+        time.sleep(0.35)
+        second.rebalance()
+        self.assertEqual(set(range(8)), second.owned())
+        self.assertEqual([events[2]], self.replayed)
+
+    def test_sink_runs_without_lock(self):
+        """
+        Test that the replayed events are handed to the sink while the
+        member keeps accepting events, which follow the replayed ones.
+        """
+        first = self.member("first")
+        events = project_events(3)
+        for event in events:
+            event["change"]["project"] = "tools"
+        first.rebalance()
+        self.assertTrue(first.accept(events[0]))
+        first.done(events[0])
+        first.rebalance()
+        self.assertTrue(first.accept(events[1]))
+        sunk = []
+
+        def sink(event):
+            # A concurrent reader accepts a new event meanwhile.
+            if not sunk:
+                reader = threading.Thread(target=second.accept,
+                                          args=(events[2],))
+                reader.start()
+                reader.join(5)
+                self.assertFalse(reader.is_alive())
+            sunk.append(event)
+        second = ClusterMember(SQLiteLeaseStore(self.path), sink,
+                               node="second", partitions=8, ttl=0.3)
+        second.accept(events[0])
+        second.accept(events[1])
+        time.sleep(0.35)
+        second.rebalance()
+        self.assertEqual([events[1], events[2]], sunk)
+        self.assertEqual(1, second.metrics.counter("cluster.replayed"))
+        self.assertEqual(set(range(8)), second.owned())
+
+    def test_restart_accepts_new_events(self):
+        """
+        Test that a node restarted after a clean stop accepts the new events
+        although the watermark it left isn't in its buffer.
+        """
+        first = self.member("first")
+        first.rebalance()
+        for event in project_events(10):
+            self.assertTrue(first.accept(event))
+            first.done(event)
+        first.stop()
+        restarted = self.member("first")
+        restarted.rebalance()
+        self.assertEqual(set(range(8)), restarted.owned())
+        events = project_events(20)[10:]
+        self.assertEqual([True] * 10,
+                         [restarted.accept(event) for event in events])
+        self.assertEqual(0, restarted.metrics.counter("cluster.skipped"))
+
+    def test_watermark_left_the_buffer(self):
+        """
+        Test that a new owner whose buffer lost the watermark accepts the
+        following events and skips only the watermark if it shows up.
+        """
+        first = ClusterMember(SQLiteLeaseStore(self.path),
+                              self.replayed.append, node="first",
+                              partitions=1, ttl=0.3, buffer_size=3)
+        second = ClusterMember(SQLiteLeaseStore(self.path),
+                               self.replayed.append, node="second",
+                               partitions=1, ttl=0.3, buffer_size=3)
+        first.rebalance()
+        events = project_events(10)
+        for event in events[:6]:
+            self.assertTrue(first.accept(event))
+            first.done(event)
+            self.assertFalse(second.accept(event))
+        first.rebalance()
+        # "first" dies after a few more events, which push the watermark
+        # of its last renewal out of the buffer of "second".
+        for event in events[6:]:
+            self.assertTrue(first.accept(event))
+            first.done(event)
+            self.assertFalse(second.accept(event))
+        time.sleep(0.35)
+        second.rebalance()
+        self.assertEqual(set([0]), second.owned())
+        self.assertEqual([], self.replayed)
+        later = sample_events.comment_added(99)
+        self.assertTrue(second.accept(later))
+        self.assertEqual(0, second.metrics.counter("cluster.skipped"))
+        self.assertFalse(second.accept(events[5]))
+        self.assertEqual(1, second.metrics.counter("cluster.skipped"))
+
+
+class ClusterDispatcherTest(unittest.TestCase):
+    """
+    This class tests gerritevent.Dispatcher objects in cluster mode.
+    """
+    def test_each_event_is_handled_once(self):
+        """
+        Test that two dispatchers fed with the same events handle each of
+        them exactly once between them.
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            dispatchers = []
+            handlers = []
+            for node in ("first", "second"):
+                config = ConfigParser()
+                config.readfp(StringIO.StringIO("""[cluster]
+lease_file: %s
+node: %s
+partitions: 8
+lease_ttl: 0.3
+""" % (os.path.join(directory, "leases.db"), node)))
+                handler = mock.MagicMock()
+                handlers.append(handler)
+                dispatchers.append(gerritevent.Dispatcher(config, [handler]))
+                dispatchers[-1].start()
+            for _ in range(100):
+                owned = [dispatcher.cluster.owned()
+                         for dispatcher in dispatchers]
+                if owned[0] and owned[1] and \
+                        len(owned[0] | owned[1]) == 8 and \
+                        not owned[0] & owned[1]:
+                    break
+                time.sleep(0.02)
+            events = project_events(40)
+            for event in events:
+                for dispatcher in dispatchers:
+                    dispatcher.submit(event)
+            for dispatcher in dispatchers:
+                self.assertTrue(dispatcher.stop(timeout=5))
+            calls = [handler.comment_added.call_count for handler in handlers]
+            self.assertEqual(40, sum(calls))
+            self.assertTrue(calls[0] and calls[1])
+        finally:
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    unittest.main()
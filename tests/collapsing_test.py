@@ -0,0 +1,180 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+from gerritevent.collapsing import RefUpdateCollapser
+from gerritevent.gerrit_events import GerritEvent
+from gerritevent.gerrit_events import GerritRefUpdatedBulkEvent
+from gerritevent.metrics import Metrics
+import gerritevent
+import mock
+import os
+import sample_events
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import StringIO
+if sys.version_info < (3, 0):
+    from ConfigParser import ConfigParser
+else:
+    from configparser import ConfigParser
+
+
+class RecordingHandler(object):
+    """
+    Records the ref updates it gets, one by one or in bulks.
+    """
+    def __init__(self, bulk_ref_updates=False, typed_events=False):
+        self.bulk_ref_updates = bulk_ref_updates
+        self.typed_events = typed_events
+        self.single = []
+        self.bulks = []
+
+    def ref_updated(self, event):
+        self.single.append(event)
+
+    def ref_updated_bulk(self, event):
+        self.bulks.append(event)
+
+
+class RefUpdateCollapserTest(unittest.TestCase):
+    """
+    This class tests the gerritevent.collapsing.RefUpdateCollapser class.
+    """
+    def setUp(self):
+        self.bulks = []
+        self.handed_out = threading.Event()
+
+    def sink(self, bulk, events):
+        self.assertEqual(len(bulk["refUpdates"]), len(events))
+        self.bulks.append(bulk)
+        self.handed_out.set()
+
+    def test_collapses_per_project_until_max_size(self):
+        """
+        Test that a full bulk is handed out at once, per project and in the
+        order of the events.
+        """
+        metrics = Metrics()
+        collapser = RefUpdateCollapser(self.sink, window=60.0, max_size=3,
+                                       metrics=metrics)
+        for tag in range(4):
+            collapser.add(sample_events.ref_updated(
+                ref_name="refs/tags/v%d" % tag))
+        collapser.add(sample_events.ref_updated(project="web"))
+        self.assertEqual(1, len(self.bulks))
+        self.assertEqual("tools", self.bulks[0]["project"])
+        self.assertEqual(["refs/tags/v0", "refs/tags/v1", "refs/tags/v2"],
+                         [update["refName"]
+                          for update in self.bulks[0]["refUpdates"]])
+        self.assertEqual(2, collapser.pending())
+        left = collapser.stop()
+        self.assertEqual([("tools", 1), ("web", 1)],
+                         [(bulk["project"], len(events))
+                          for bulk, events in left])
+        self.assertEqual(5, metrics.counter("ref_updates.collapsed"))
+        self.assertEqual(3, metrics.counter("ref_updates.bulks"))
+
+    def test_window_hands_out_bulk(self):
+        """
+        Test that a bulk is handed out once its window passed and decodes to
+        a GerritRefUpdatedBulkEvent.
+        """
+        collapser = RefUpdateCollapser(self.sink, window=0.05, max_size=100)
+        collapser.start()
+        try:
+            collapser.add(sample_events.ref_updated(new_rev="a" * 40))
+            collapser.add(sample_events.ref_updated(new_rev="b" * 40))
+            self.handed_out.wait(5)
+        finally:
+            collapser.stop()
+        self.assertEqual(1, len(self.bulks))
+        bulk = GerritEvent.decode_dict(self.bulks[0])
+        self.assertEqual(GerritRefUpdatedBulkEvent, type(bulk))
+        self.assertEqual("tools", bulk.project)
+        self.assertEqual(["a" * 40, "b" * 40],
+                         [update.new_rev for update in bulk.ref_updates])
+
+
+class DispatcherBulkTest(unittest.TestCase):
+    """
+    This class tests that the dispatcher routes the ref updates by the
+    handlers' "bulk_ref_updates".
+    """
+    def test_only_opted_in_handlers_get_bulks(self):
+        """
+        Test that handlers without "bulk_ref_updates" still get each event
+        and the others get bulks, which are flushed when stopping.
+        """
+        config = ConfigParser()
+        config.readfp(StringIO.StringIO("""
+[dispatcher]
+ref_update_window: 60
+ref_update_max_size: 2
+"""))
+        single = RecordingHandler()
+        bulk = RecordingHandler(bulk_ref_updates=True)
+        typed = RecordingHandler(bulk_ref_updates=True, typed_events=True)
+        dispatcher = gerritevent.Dispatcher(config, [single, bulk, typed])
+        dispatcher.start()
+        for tag in range(3):
+            dispatcher.submit(sample_events.ref_updated(
+                ref_name="refs/tags/v%d" % tag))
+        dispatcher.submit(sample_events.change_merged(1))
+        self.assertTrue(dispatcher.stop(timeout=5))
+        self.assertEqual(3, len(single.single))
+        self.assertEqual([], single.bulks)
+        self.assertEqual([], bulk.single)
+        self.assertEqual([2, 1], [len(event["refUpdates"])
+                                  for event in bulk.bulks])
+        self.assertEqual(["refs/tags/v0", "refs/tags/v1"],
+                         [update.ref_name
+                          for update in typed.bulks[0].ref_updates])
+        self.assertEqual(2, dispatcher.metrics.counter("ref_updates.bulks"))
+
+    def test_collapsed_events_stay_in_flight(self):
+        """
+        Test that the cluster is told that a collapsed event was handled
+        only once its bulk was handled.
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            config = ConfigParser()
+            config.readfp(StringIO.StringIO("""
+[dispatcher]
+ref_update_window: 60
+
+[cluster]
+lease_file: %s
+partitions: 1
+""" % os.path.join(directory, "leases.db")))
+            bulk = RecordingHandler(bulk_ref_updates=True)
+            dispatcher = gerritevent.Dispatcher(config, [bulk])
+            done = mock.MagicMock(wraps=dispatcher.cluster.done)
+            dispatcher.cluster.done = done
+            dispatcher.start()
+            for _ in range(100):
+                if dispatcher.cluster.owned():
+                    break
+                time.sleep(0.02)
+            event = sample_events.ref_updated()
+            dispatcher.submit(event)
+            dispatcher.submit(sample_events.change_merged(1))
+            for _ in range(100):
+                if done.call_count:
+                    break
+                time.sleep(0.02)
+            self.assertEqual([mock.call(sample_events.change_merged(1))],
+                             done.call_args_list)
+            self.assertTrue(dispatcher.stop(timeout=5))
+            self.assertEqual(1, len(bulk.bulks))
+            self.assertEqual(mock.call(event), done.call_args)
+        finally:
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+from gerritevent import gerrit_events
+from gerritevent.columnar import EventColumns
+from gerritevent.gerrit_events import GerritEvent
+import json
+import sample_events
+import unittest
+
+
+class DecodeManyTest(unittest.TestCase):
+    """
+    This class tests gerritevent.gerrit_events.GerritEvent.decode_many.
+    """
+    def setUp(self):
+        self.lines = [
+            json.dumps(sample_events.patchset_created(1)),
+            json.dumps(sample_events.ref_updated()),
+            json.dumps(sample_events.comment_added(1)),
+            "not json",
+            json.dumps({"type": "reviewer-added"}),
+            json.dumps(sample_events.change_merged(1))
+        ]
+
+    def test_order_and_types(self):
+        """
+        Test that the events come back in input order.
+        """
+        events = GerritEvent.decode_many(self.lines, skip_errors=True)
+        self.assertEqual(["patchset-created", "ref-updated", "comment-added",
+                          "change-merged"], [e.type for e in events])
+        self.assertTrue(isinstance(events[2],
+                                   gerrit_events.GerritCommentAddedEvent))
+
+    def test_errors(self):
+        """
+        Test that errors are raised unless skipped.
+        """
+        self.assertRaises(ValueError, GerritEvent.decode_many, self.lines)
+        del self.lines[3]
+        self.assertRaises(gerrit_events.DecodeError,
+                          GerritEvent.decode_many, self.lines)
+
+
+class EventColumnsTest(unittest.TestCase):
+    """
+    This class tests the gerritevent.columnar.EventColumns class.
+    """
+    def setUp(self):
+        day = 86400
+        events = [
+            sample_events.comment_added(1, project="tools"),
+            sample_events.comment_added(2, project="tools"),
+            sample_events.comment_added(3, project="web"),
+            sample_events.patchset_created(4, project="web"),
+            sample_events.ref_updated(project="web")
+        ]
+        events[0]["eventCreatedOn"] = 10 * day
+        events[1]["eventCreatedOn"] = 11 * day
+        events[2]["eventCreatedOn"] = 10 * day + 5
+        self.columns = EventColumns.from_lines(
+            [json.dumps(e) for e in events] + ["garbage"])
+
+    def test_columns(self):
+        """
+        Test that strings are dictionary encoded and numbers kept.
+        """
+        self.assertEqual(5, len(self.columns))
+        self.assertEqual(2, len(self.columns.dictionaries["project"]))
+        self.assertEqual([1, 2, 3, 4, -1],
+                         self.columns.column("change_number"))
+        self.assertEqual("bob@example.com", self.columns.column("account")[0])
+        self.assertEqual("carol@example.com",
+                         self.columns.column("account")[4])
+
+    def test_count_by(self):
+        """
+        Test grouping reviews per project per day.
+        """
+        self.assertEqual({("tools", 10): 1, ("tools", 11): 1, ("web", 10): 1},
+                         self.columns.count_by(["project", "day"],
+                                               event_type="comment-added"))
+        self.assertEqual({("web",): 3, ("tools",): 2},
+                         self.columns.count_by(["project"]))
+        self.assertEqual({}, self.columns.count_by(["project"],
+                                                   event_type="unknown"))
+
+if __name__ == '__main__':
+    unittest.main()
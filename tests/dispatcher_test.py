@@ -4,9 +4,13 @@ License: LGPL
 Author: Konrad Kleine <kleine@gonicus.de>
 """
 import gerritevent
+from gerritevent import gerrit_events
 import mock
+import sample_events
 import json
 import sys
+import threading
+import time
 import unittest
 import StringIO
 if sys.version_info < (3, 0):
@@ -135,5 +139,169 @@ passphrase: tester
         """
         self.dispatcher._disconnect_from_gerrit.assert_called_once()
 
+
+class BlockingStream(object):
+    """
+    Mimics the stdout of "gerrit stream-events": yields the given lines and
+    then blocks like an idle stream until it gets closed.
+    """
+    def __init__(self, lines):
+        self.lines = lines
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        for line in self.lines:
+            yield line
+        self.closed.wait(10)
+
+
+class DispatcherStopTest(unittest.TestCase):
+    """
+    This class tests the graceful shutdown of the gerritevent.Dispatcher.
+    """
+    def setUp(self):
+        """
+        Prepare a dispatcher that reads two events and then idles.
+        """
+        config_contents = StringIO.StringIO("""[gerrit]
+host: gerritserver
+port: 29418
+user: alice
+ssh_private_key: /foo/bar
+passphrase: tester
+         """)
+        self.config = ConfigParser()
+        self.config.readfp(config_contents)
+        self.handler = mock.MagicMock(name="handler")
+        self.dispatcher = gerritevent.Dispatcher(
+            config=self.config,
+            handlers=[self.handler],
+            endless=True
+        )
+        self.stream = BlockingStream([
+            json.dumps({"type": "comment-added"}),
+            json.dumps({"type": "comment-added"})
+        ])
+        client = mock.MagicMock()
+        client.exec_command.return_value = [None, self.stream, None]
+        self.dispatcher._connect_to_gerrit = mock.MagicMock(
+            name="_connect_to_gerrit",
+            return_value=client
+        )
+        self.dispatcher._disconnect_from_gerrit = mock.MagicMock(
+            name="_disconnect_from_gerrit",
+            side_effect=lambda client: self.stream.closed.set()
+        )
+
+    def wait_for_events(self, count):
+        """
+        Waits until the dispatcher has read "count" events.
+        """
+        for _ in range(100):
+            if self.dispatcher.metrics.counter("events_read") >= count:
+                return
+            time.sleep(0.05)
+        self.fail("dispatcher didn't read %d events" % count)
+
+    def test_stop_drains_events(self):
+        """
+        Test that stop() lets a slow handler finish all events that were
+        already read, closes the handler and disconnects once.
+        """
+        self.handler.comment_added.side_effect = lambda e: time.sleep(0.2)
+        self.dispatcher.start()
+        self.wait_for_events(2)
+        self.assertTrue(self.dispatcher.stop(timeout=5))
+        self.assertFalse(self.dispatcher.is_alive())
+        self.assertEqual(2, self.handler.comment_added.call_count)
+        self.assertEqual(1, self.handler.close.call_count)
+        self.assertEqual(
+            1, self.dispatcher._disconnect_from_gerrit.call_count)
+        self.assertEqual(
+            2, self.dispatcher.metrics.counter("events_dispatched"))
+
+    def test_stop_respects_deadline(self):
+        """
+        Test that stop() gives up on handlers that don't finish in time.
+        """
+        release = threading.Event()
+        self.handler.comment_added.side_effect = lambda e: release.wait(10)
+        self.dispatcher.start()
+        self.wait_for_events(2)
+        try:
+            self.assertFalse(self.dispatcher.stop(timeout=0.2))
+            self.dispatcher.join(5)
+            self.assertEqual(
+                1, self.dispatcher.metrics.counter("events_dropped"))
+        finally:
+            release.set()
+
+class DispatchEventTest(unittest.TestCase):
+    """
+    This class tests how gerritevent.Dispatcher._dispatch_event copes with
+    failing handlers.
+    """
+    def test_failing_handler_doesnt_stop_others(self):
+        """
+        Test that an exception in one handler is contained and the next
+        handler still gets the event.
+        """
+        config = ConfigParser()
+        config.readfp(StringIO.StringIO("""[gerrit]
+host: gerritserver
+port: 29418
+user: alice
+ssh_private_key: /foo/bar
+passphrase: tester
+         """))
+        failing = mock.MagicMock(name="failing")
+        failing.comment_added.side_effect = IOError("Redmine is down")
+        working = mock.MagicMock(name="working")
+        dispatcher = gerritevent.Dispatcher(config, [failing, working])
+        event = {"type": "comment-added"}
+        dispatcher._dispatch_event(event)
+        dispatcher._dispatch_event({"type": "reviewer-added"})
+        working.comment_added.assert_called_once_with(event)
+        self.assertEqual(
+            1, dispatcher.metrics.counter("handler.MagicMock.failures"))
+        self.assertEqual(1, dispatcher.metrics.counter("events_ignored"))
+
+    def test_typed_events(self):
+        """
+        Test that handlers with "typed_events" share one decoded event while
+        the others still get the dictionary.
+        """
+        config = ConfigParser()
+        config.readfp(StringIO.StringIO("""[gerrit]
+host: gerritserver
+port: 29418
+user: alice
+ssh_private_key: /foo/bar
+passphrase: tester
+         """))
+        received = []
+
+        class TypedHandler(gerritevent.Handler):
+            typed_events = True
+
+            def comment_added(self, event):
+                received.append(event)
+
+        raw = mock.MagicMock(name="raw")
+        dispatcher = gerritevent.Dispatcher(
+            config, [TypedHandler(config), TypedHandler(config), raw])
+        event = sample_events.comment_added()
+        dispatcher._dispatch_event(event)
+        self.assertEqual(2, len(received))
+        self.assertTrue(received[0] is received[1])
+        self.assertTrue(isinstance(received[0],
+                                   gerrit_events.GerritCommentAddedEvent))
+        self.assertEqual(1042, received[0].change.number)
+        raw.comment_added.assert_called_once_with(event)
+        del event["author"]
+        dispatcher._dispatch_event(event)
+        self.assertEqual(2, len(received))
+        self.assertEqual(1, dispatcher.metrics.counter("events_undecodable"))
+
 if __name__ == '__main__':
     unittest.main()
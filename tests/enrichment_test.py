@@ -0,0 +1,114 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+from gerritevent.enrichment import Enricher
+from gerritevent.gerrit_events import GerritEvent
+from gerritevent.idempotency import fingerprint
+import sample_events
+import threading
+import time
+import unittest
+
+
+class FakeQueryResponder(object):
+    """
+    Answers "gerrit query" like GerritCommandPool.query and counts the
+    calls.
+    """
+    def __init__(self):
+        self.calls = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, query, *flags):
+        self.calls.append((query, flags))
+        self.release.wait(5)
+        number = query.split(":")[1]
+        if number == "404":
+            return []
+        return [{"number": number, "topic": "topic-" + number,
+                 "currentPatchSet": {"files": [{"file": "README"}]}}]
+
+
+class EnricherTest(unittest.TestCase):
+    """
+    This class tests the gerritevent.enrichment.Enricher class.
+    """
+    def setUp(self):
+        self.responder = FakeQueryResponder()
+        self.enricher = Enricher(self.responder,
+                                 ["--current-patch-set", "--files"],
+                                 ttl=0.2, max_size=2)
+
+    def test_enrich_once_per_patchset(self):
+        """
+        Test that the data is attached to the events and queried once per
+        change and patch set.
+        """
+        first = sample_events.comment_added(1)
+        second = sample_events.comment_added(1)
+        self.enricher.enrich(first)
+        self.enricher.enrich(second)
+        self.assertEqual("topic-1", first["enrichment"]["topic"])
+        self.assertEqual(first["enrichment"], second["enrichment"])
+        self.assertEqual([("change:1", ("--current-patch-set", "--files"))],
+                         self.responder.calls)
+        self.enricher.enrich(sample_events.patchset_created(1, 2))
+        self.assertEqual(2, len(self.responder.calls))
+
+    def test_typed_events_and_fingerprint(self):
+        """
+        Test that decoded events carry the enrichment and that it doesn't
+        change the fingerprint of the event.
+        """
+        event = sample_events.comment_added(1)
+        plain = fingerprint(event)
+        self.assertEqual(None, GerritEvent.decode_dict(event).enrichment)
+        self.enricher.enrich(event)
+        self.assertEqual(plain, fingerprint(event))
+        self.assertEqual("topic-1",
+                         GerritEvent.decode_dict(event).enrichment["topic"])
+
+    def test_ttl_size_and_unknown_changes(self):
+        """
+        Test that entries expire, the cache is bounded and changes Gerrit
+        doesn't know are left alone.
+        """
+        for number in (1, 2, 3, 1):
+            self.enricher.lookup(number, 1)
+        self.assertEqual(4, len(self.responder.calls))
+        self.enricher.lookup(3, 1)
+        self.assertEqual(4, len(self.responder.calls))
+        time.sleep(0.25)
+        self.enricher.lookup(3, 1)
+        self.assertEqual(5, len(self.responder.calls))
+        event = sample_events.change_merged(404)
+        self.enricher.enrich(event)
+        self.assertFalse("enrichment" in event)
+        self.enricher.enrich(sample_events.ref_updated())
+        self.assertEqual(6, len(self.responder.calls))
+
+    def test_concurrent_lookups_are_coalesced(self):
+        """
+        Test that concurrent lookups of the same change query only once.
+        """
+        self.responder.release.clear()
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(self.enricher.lookup(7, 1)))
+            for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        self.responder.release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(1, len(self.responder.calls))
+        self.assertEqual(3, len(results))
+        self.assertEqual(2, self.enricher.metrics.counter(
+            "enrichment.coalesced"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+from gerritevent.export import ColumnarExportHandler
+import gzip
+import json
+import os
+import sample_events
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+import StringIO
+if sys.version_info < (3, 0):
+    from ConfigParser import ConfigParser
+else:
+    from configparser import ConfigParser
+
+
+class ColumnarExportHandlerTest(unittest.TestCase):
+    """
+    This class tests the gerritevent.export.ColumnarExportHandler class.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def handler(self, flush_interval=300):
+        """
+        Returns a handler writing gzipped JSON files.
+        """
+        config = ConfigParser()
+        config.readfp(StringIO.StringIO("""[export]
+directory: %s
+max_events: 2
+flush_interval: %s
+format: json
+""" % (self.directory, flush_interval)))
+        return ColumnarExportHandler(config)
+
+    def files(self):
+        """
+        Returns the contents of all written files, oldest first.
+        """
+        contents = []
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith(".tmp"):
+                continue
+            data = gzip.open(os.path.join(self.directory, name)).read()
+            contents.append(json.loads(data))
+        return contents
+
+    def test_flush_on_size_and_close(self):
+        """
+        Test that full buffers and the rest on close() are written.
+        """
+        handler = self.handler()
+        handler.patchset_created(sample_events.patchset_created(1))
+        handler.comment_added(sample_events.comment_added(1))
+        handler.change_merged(sample_events.change_merged(1))
+        handler.close()
+        files = self.files()
+        self.assertEqual(2, len(files))
+        self.assertEqual([1, 1], files[0]["columns"]["change_number"])
+        self.assertEqual(["tools"], files[0]["dictionaries"]["project"])
+        self.assertEqual(["change-merged"], files[1]["dictionaries"]["type"])
+
+    def test_flush_on_time(self):
+        """
+        Test that the writer flushes a partial buffer after the interval.
+        """
+        handler = self.handler(flush_interval=0.1)
+        handler.ref_updated(sample_events.ref_updated())
+        for _ in range(50):
+            if self.files():
+                break
+            time.sleep(0.05)
+        self.assertEqual(1, len(self.files()))
+        handler.close()
+        self.assertEqual(1, len(self.files()))
+
+if __name__ == '__main__':
+    unittest.main()
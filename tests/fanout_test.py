@@ -0,0 +1,136 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+from gerritevent.fanout import FanoutServer
+import json
+import os
+import sample_events
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+
+class FanoutServerTest(unittest.TestCase):
+    """
+    This class tests the gerritevent.fanout.FanoutServer class.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = FanoutServer(
+            "unix:" + os.path.join(self.directory, "fanout"),
+            sse_address="127.0.0.1:0", max_buffer=2)
+        self.server.start()
+        self.sockets = []
+
+    def tearDown(self):
+        self.server.stop()
+        for sock in self.sockets:
+            sock.close()
+        shutil.rmtree(self.directory)
+
+    def subscribe(self, request):
+        """
+        Connects a subscriber, sends "request" and waits until the server
+        registered it.
+        """
+        count = self.server.subscriber_count()
+        if request.startswith(b"GET"):
+            sock = socket.create_connection(
+                ("127.0.0.1", int(self.server.sse_address.split(":")[1])))
+        else:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.server.address[len("unix:"):])
+        sock.settimeout(5)
+        sock.sendall(request)
+        self.sockets.append(sock)
+        for _ in range(100):
+            if self.server.subscriber_count() > count:
+                break
+            time.sleep(0.01)
+        return sock
+
+    def broadcast(self, event):
+        """
+        Broadcasts "event" like the dispatcher does and returns the line.
+        """
+        line = json.dumps(event)
+        self.server.broadcast(line, event)
+        return line
+
+    def receive(self, sock, terminator, count):
+        """
+        Reads from "sock" until "terminator" was seen "count" times.
+        """
+        data = b""
+        while data.count(terminator) < count:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def test_filters(self):
+        """
+        Test that every subscriber gets the original lines it asked for.
+        """
+        everything = self.subscribe(b"\n")
+        merged = self.subscribe(b'{"types": ["change-merged"]}\n')
+        first = self.broadcast(sample_events.comment_added(1))
+        second = self.broadcast(sample_events.change_merged(1))
+        self.assertEqual(first + "\n" + second + "\n",
+                         self.receive(everything, b"\n", 2))
+        self.assertEqual(second + "\n", self.receive(merged, b"\n", 1))
+
+    def test_server_sent_events(self):
+        """
+        Test that an HTTP subscriber gets the events as Server-Sent Events.
+        """
+        sock = self.subscribe(b"GET /events?type=change-merged HTTP/1.0\r\n"
+                              b"\r\n")
+        self.broadcast(sample_events.comment_added(1))
+        line = self.broadcast(sample_events.change_merged(1))
+        data = self.receive(sock, b"\n\n", 1)
+        self.assertTrue(data.startswith(b"HTTP/1.0 200"))
+        self.assertTrue(b"text/event-stream" in data)
+        self.assertTrue(data.endswith(b"\r\n\r\ndata: " + line + b"\n\n"))
+
+    def test_slow_subscriber_is_evicted(self):
+        """
+        Test that a subscriber that doesn't keep up is disconnected without
+        holding up the others.
+        """
+        self.subscribe(b"\n")
+        # Keep the subscriber's sender busy by not reading at all: once the
+        # socket buffers are full, its own buffer runs over.
+        event = sample_events.comment_added(1)
+        event["padding"] = "x" * 65536
+        for _ in range(100):
+            if not self.server.subscriber_count():
+                break
+            self.broadcast(event)
+        self.assertEqual(0, self.server.subscriber_count())
+        self.assertEqual(1, self.server.metrics.counter("fanout.evicted"))
+
+    def test_disconnected_subscriber_is_removed(self):
+        """
+        Test that a subscriber that goes away is removed although no event
+        it wants is broadcast.
+        """
+        sock = self.subscribe(b'{"types": ["change-merged"]}\n')
+        sse = self.subscribe(b"GET /events?type=change-merged HTTP/1.0\r\n"
+                             b"\r\n")
+        self.assertEqual(2, self.server.subscriber_count())
+        sock.close()
+        sse.close()
+        for _ in range(300):
+            if not self.server.subscriber_count():
+                break
+            time.sleep(0.01)
+        self.assertEqual(0, self.server.subscriber_count())
+
+if __name__ == '__main__':
+    unittest.main()
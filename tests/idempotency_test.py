@@ -0,0 +1,166 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+from gerritevent.idempotency import IdempotencyStore
+import gerritevent
+import mock
+import os
+import sample_events
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import StringIO
+if sys.version_info < (3, 0):
+    from ConfigParser import ConfigParser
+else:
+    from configparser import ConfigParser
+
+
+class IdempotencyStoreTest(unittest.TestCase):
+    """
+    This class tests the gerritevent.idempotency.IdempotencyStore class.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "idempotency.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_keys_survive_restart(self):
+        """
+        Test that recorded keys are still known after reopening the store
+        and that the key depends on handler, target and event.
+        """
+        event = sample_events.comment_added(1)
+        store = IdempotencyStore(self.path)
+        key = store.key("RedmineHandler", "42", event)
+        self.assertNotEqual(key, store.key("RedmineHandler", "43", event))
+        self.assertNotEqual(key, store.key("OtherHandler", "42", event))
+        self.assertNotEqual(key, store.key("RedmineHandler", "42",
+                                           sample_events.comment_added(2)))
+        self.assertEqual(key, store.key("RedmineHandler", "42", dict(event)))
+        self.assertFalse(store.seen(key))
+        store.record(key)
+        self.assertTrue(store.seen(key))
+        store.close()
+        store = IdempotencyStore(self.path)
+        self.assertTrue(store.seen(key))
+        self.assertEqual(1, store.metrics.counter("idempotency.hits"))
+        store.close()
+
+    def test_keys_expire(self):
+        """
+        Test that keys are forgotten after the TTL.
+        """
+        store = IdempotencyStore(":memory:", ttl=0.05)
+        store.record("key")
+        self.assertTrue(store.seen("key"))
+        time.sleep(0.1)
+        self.assertFalse(store.seen("key"))
+        store.close()
+
+
+class RedmineHandlerIdempotencyTest(unittest.TestCase):
+    """
+    This class tests that the gerritevent.RedmineHandler doesn't add the
+    same comment twice.
+    """
+    def test_redelivered_event(self):
+        """
+        Test that a redelivered event doesn't add comments again, unless
+        Redmine refused them the first time.
+        """
+        config = ConfigParser()
+        config.readfp(StringIO.StringIO("""[redmine]
+issue_url: http://redmine/issues/%d.json
+api_key: secret
+comment_added_template: $comment
+[idempotency]
+file: :memory:
+"""))
+        httplib2 = mock.MagicMock()
+        http = httplib2.Http.return_value
+        response = mock.MagicMock(status=500)
+        http.request.return_value = (response, "")
+        event = sample_events.comment_added(1)
+        event["comment"] = "Fixes #42"
+        with mock.patch.dict(sys.modules, {"httplib2": httplib2}):
+            handler = gerritevent.RedmineHandler(config)
+            handler.comment_added(event)
+            response.status = 200
+            handler.comment_added(event)
+            handler.comment_added(event)
+        handler.close()
+        self.assertEqual(2, http.request.call_count)
+
+    def test_parallel_redelivery(self):
+        """
+        Test that two deliveries of an event handled at the same time add
+        the comment once, and that a refused comment can be added by the
+        next delivery.
+        """
+        config = ConfigParser()
+        config.readfp(StringIO.StringIO("""[redmine]
+issue_url: http://redmine/issues/%d.json
+api_key: secret
+comment_added_template: $comment
+[idempotency]
+file: :memory:
+"""))
+        httplib2 = mock.MagicMock()
+        http = httplib2.Http.return_value
+        statuses = [500, 200]
+
+        def request(**kwargs):
+            time.sleep(0.05)
+            return mock.MagicMock(status=statuses.pop(0)), ""
+        http.request.side_effect = request
+        event = sample_events.comment_added(1)
+        event["comment"] = "Fixes #42"
+        with mock.patch.dict(sys.modules, {"httplib2": httplib2}):
+            handler = gerritevent.RedmineHandler(config)
+            threads = [threading.Thread(target=handler.comment_added,
+                                        args=(event,)) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(5)
+        handler.close()
+        self.assertEqual(2, http.request.call_count)
+
+    def test_enriched_redelivery(self):
+        """
+        Test that a redelivery is recognized although only one of the
+        deliveries was enriched, or both with different data.
+        """
+        config = ConfigParser()
+        config.readfp(StringIO.StringIO("""[redmine]
+issue_url: http://redmine/issues/%d.json
+api_key: secret
+comment_added_template: $comment
+[idempotency]
+file: :memory:
+"""))
+        httplib2 = mock.MagicMock()
+        http = httplib2.Http.return_value
+        http.request.return_value = (mock.MagicMock(status=200), "")
+        event = sample_events.comment_added(1)
+        event["comment"] = "Fixes #42"
+        enriched = dict(event, enrichment={"topic": "crash"})
+        refreshed = dict(event, enrichment={"topic": "crash", "open": False})
+        with mock.patch.dict(sys.modules, {"httplib2": httplib2}):
+            handler = gerritevent.RedmineHandler(config)
+            handler.comment_added(event)
+            handler.comment_added(enriched)
+            handler.comment_added(refreshed)
+        handler.close()
+        self.assertEqual(1, http.request.call_count)
+
+if __name__ == '__main__':
+    unittest.main()
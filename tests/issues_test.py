@@ -0,0 +1,130 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+from gerritevent.issues import IssueDirectory
+import gerritevent
+import json
+import mock
+import sample_events
+import sys
+import time
+import unittest
+import StringIO
+if sys.version_info < (3, 0):
+    from ConfigParser import ConfigParser
+    from urlparse import parse_qs, urlparse
+else:
+    from configparser import ConfigParser
+    from urllib.parse import parse_qs, urlparse
+
+
+class IssueDirectoryTest(unittest.TestCase):
+    """
+    This class tests the gerritevent.issues.IssueDirectory class.
+    """
+    def test_positive_and_negative_entries(self):
+        """
+        Test that uncached IDs are fetched in one batch and that existing
+        and missing issues expire separately.
+        """
+        fetched = []
+
+        def fetch(issue_ids):
+            fetched.append(sorted(issue_ids))
+            return {"1": {"id": 3, "name": "Tools"}}
+
+        directory = IssueDirectory(fetch, ttl=60, missing_ttl=0.05)
+        self.assertEqual({"1": {"id": 3, "name": "Tools"}, "2": None},
+                         directory.lookup(["1", "2"]))
+        self.assertEqual({"1": {"id": 3, "name": "Tools"}, "2": None},
+                         directory.lookup([1, 2]))
+        time.sleep(0.1)
+        directory.lookup(["1", "2"])
+        self.assertEqual([["1", "2"], ["2"]], fetched)
+
+
+class FakeRedmine(object):
+    """
+    Answers the issue lookups and comment PUTs of the RedmineHandler.
+    """
+    def __init__(self, issues):
+        self.issues = issues
+        self.requests = []
+
+    def request(self, uri, method, body=None, headers=None):
+        self.requests.append((method, uri))
+        if method == "GET":
+            query = parse_qs(urlparse(uri).query)
+            ids = query["issue_id"][0].split(",")
+            ids = [str(int(issue_id)) for issue_id in ids]
+            issues = [{"id": int(issue_id), "project": self.issues[issue_id]}
+                      for issue_id in ids if issue_id in self.issues]
+            return mock.MagicMock(status=200), json.dumps({"issues": issues})
+        return mock.MagicMock(status=200), ""
+
+
+class RedmineHandlerIssueTest(unittest.TestCase):
+    """
+    This class tests that the gerritevent.RedmineHandler only comments on
+    existing issues of the allowed Redmine projects.
+    """
+    def test_only_valid_issues_get_comments(self):
+        """
+        Test that missing issues and issues of other projects are skipped
+        and that the lookups are batched and cached.
+        """
+        config = ConfigParser()
+        config.readfp(StringIO.StringIO("""[redmine]
+issue_url: http://redmine/issues/%d.json
+api_key: secret
+comment_added_template: $comment
+validate_issues: yes
+[redmine_projects]
+tools: Tools, 7
+"""))
+        redmine = FakeRedmine({"1": {"id": 3, "name": "Tools"},
+                               "2": {"id": 7, "name": "Infrastructure"},
+                               "3": {"id": 9, "name": "Secret"}})
+        httplib2 = mock.MagicMock()
+        httplib2.Http.return_value = redmine
+        event = sample_events.comment_added(1)
+        event["comment"] = "Fixes #1, #2, #3 and #4"
+        with mock.patch.dict(sys.modules, {"httplib2": httplib2}):
+            handler = gerritevent.RedmineHandler(config)
+            handler.comment_added(event)
+            handler.comment_added(event)
+        lookups = [uri for method, uri in redmine.requests if method == "GET"]
+        puts = sorted(uri for method, uri in redmine.requests
+                      if method == "PUT")
+        self.assertEqual(1, len(lookups))
+        self.assertTrue(lookups[0].startswith("http://redmine/issues.json?"))
+        self.assertEqual(["http://redmine/issues/1.json"] * 2 +
+                         ["http://redmine/issues/2.json"] * 2, puts)
+
+    def test_leading_zeros(self):
+        """
+        Test that IDs written with leading zeros are found and commented on
+        once.
+        """
+        config = ConfigParser()
+        config.readfp(StringIO.StringIO("""[redmine]
+issue_url: http://redmine/issues/%d.json
+api_key: secret
+comment_added_template: $comment
+validate_issues: yes
+"""))
+        redmine = FakeRedmine({"12": {"id": 3, "name": "Tools"}})
+        httplib2 = mock.MagicMock()
+        httplib2.Http.return_value = redmine
+        event = sample_events.comment_added(1, subject="Fix crash, see #012")
+        event["comment"] = "Fixes #0012"
+        with mock.patch.dict(sys.modules, {"httplib2": httplib2}):
+            handler = gerritevent.RedmineHandler(config)
+            handler.comment_added(event)
+        puts = [uri for method, uri in redmine.requests if method == "PUT"]
+        self.assertEqual(["http://redmine/issues/12.json"], puts)
+
+if __name__ == '__main__':
+    unittest.main()
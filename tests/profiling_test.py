@@ -0,0 +1,151 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+from gerritevent.metrics import Metrics
+from gerritevent.profiling import ProfilerService, SamplingProfiler
+from gerritevent.profiling import collapse, thread_cpu_time
+from gerritevent.resilience import HandlerGuard
+import json
+import os
+import sample_events
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import StringIO
+if sys.version_info < (3, 0):
+    from ConfigParser import ConfigParser
+else:
+    from configparser import ConfigParser
+
+
+def spin(seconds):
+    """
+    Keeps the CPU busy for "seconds".
+    """
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+class BusyHandler(object):
+    """
+    Burns CPU on every merged change.
+    """
+    def change_merged(self, event):
+        spin(0.05)
+
+
+class ProfilerTest(unittest.TestCase):
+    """
+    This class tests the gerritevent.profiling module.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.busy, name="busy-worker")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.stop.set()
+        self.thread.join(5)
+        shutil.rmtree(self.directory)
+
+    def busy(self):
+        while not self.stop.is_set():
+            spin(0.01)
+
+    def test_collapse(self):
+        """
+        Test that stacks are written from the outermost frame on.
+        """
+        stack = collapse(sys._getframe(), "main")
+        names = stack.split(";")
+        self.assertEqual("main", names[0])
+        self.assertTrue(names[-1].startswith("test_collapse (profiling_test"))
+
+    def test_profile_selected_threads(self):
+        """
+        Test that only the threads with the given prefixes are sampled and
+        that only one profile is taken at a time.
+        """
+        profiler = SamplingProfiler(0.005, ["busy-"])
+        results = []
+        other = threading.Thread(
+            target=lambda: results.append(profiler.profile(0.3)))
+        other.start()
+        time.sleep(0.05)
+        self.assertEqual(None, profiler.profile(0.1))
+        other.join(5)
+        stacks = results[0]
+        self.assertTrue(sum(stacks.values()) > 10)
+        for stack in stacks:
+            self.assertTrue(stack.startswith("busy-worker;"))
+        self.assertTrue([stack for stack in stacks if "spin (" in stack])
+        out = StringIO.StringIO()
+        SamplingProfiler.write(stacks, out)
+        for line in out.getvalue().splitlines():
+            self.assertTrue(int(line.rsplit(" ", 1)[1]) > 0)
+
+    def test_signal_and_socket(self):
+        """
+        Test that a signal writes a profile file and that the socket answers
+        with the stacks and the CPU times of the handlers.
+        """
+        config = ConfigParser()
+        config.readfp(StringIO.StringIO("""[profiler]
+signal: SIGUSR2
+seconds: 0.1
+interval: 0.005
+directory: %s
+address: 127.0.0.1:0
+""" % self.directory))
+        metrics = Metrics()
+        service = ProfilerService.from_config(config, metrics)
+        try:
+            os.kill(os.getpid(), signal.SIGUSR2)
+            for _ in range(100):
+                if os.listdir(self.directory):
+                    break
+                time.sleep(0.02)
+            time.sleep(0.1)
+            profiles = os.listdir(self.directory)
+            self.assertEqual(1, len(profiles))
+            self.assertTrue(profiles[0].endswith(".folded"))
+
+            guard = HandlerGuard(BusyHandler(), metrics,
+                                 cpu_clock=thread_cpu_time)
+            guard.call("change_merged", sample_events.change_merged(1))
+            service.start()
+            host, port = service.address.split(":")
+            self.assertTrue("busy-worker;" in
+                            self.request(host, port, "0.1\n"))
+            cpu = json.loads(self.request(host, port, "cpu\n"))
+            self.assertTrue(cpu["BusyHandler"] > 0.01)
+        finally:
+            service.stop()
+            signal.signal(signal.SIGUSR2, signal.SIG_DFL)
+
+    def request(self, host, port, line):
+        connection = socket.create_connection((host, int(port)), 5)
+        try:
+            connection.sendall(line)
+            answer = []
+            while True:
+                data = connection.recv(4096)
+                if not data:
+                    break
+                answer.append(data)
+            return "".join(answer)
+        finally:
+            connection.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+from gerritevent import publisher
+import base64
+import gzip
+import mock
+import os
+import sample_events
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+import StringIO
+if sys.version_info < (3, 0):
+    from ConfigParser import ConfigParser
+else:
+    from configparser import ConfigParser
+
+
+class PublisherTest(unittest.TestCase):
+    """
+    This class tests the gerritevent.publisher.PublisherHandler together
+    with the LocalBroker.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.address = "unix:" + os.path.join(self.directory, "broker")
+        self.broker = publisher.LocalBroker(self.address)
+        self.broker.start()
+        self.config = ConfigParser()
+        self.config.readfp(StringIO.StringIO("""[publisher]
+backend: local
+address: %s
+batch_size: 2
+batch_interval: 0.05
+retry_interval: 0
+""" % self.address))
+
+    def tearDown(self):
+        self.broker.stop()
+        shutil.rmtree(self.directory)
+
+    def subscribe(self, count):
+        """
+        Starts a subscriber that collects "count" events and returns the
+        list they are collected in.
+        """
+        received = []
+
+        def collect():
+            for event in publisher.subscribe(self.address, timeout=5):
+                received.append(event)
+                if len(received) == count:
+                    return
+
+        thread = threading.Thread(target=collect)
+        thread.daemon = True
+        thread.start()
+        for _ in range(100):
+            if self.broker.subscriber_count():
+                break
+            time.sleep(0.01)
+        return received, thread
+
+    def test_publish_to_subscribers(self):
+        """
+        Test that all events reach every subscriber in order.
+        """
+        first, first_thread = self.subscribe(3)
+        second, second_thread = self.subscribe(3)
+        handler = publisher.PublisherHandler(self.config)
+        events = [sample_events.patchset_created(1),
+                  sample_events.comment_added(1),
+                  sample_events.change_merged(1)]
+        handler.patchset_created(events[0])
+        handler.comment_added(events[1])
+        handler.change_merged(events[2])
+        handler.close()
+        first_thread.join(5)
+        second_thread.join(5)
+        self.assertEqual(events, first)
+        self.assertEqual(events, second)
+        self.assertEqual(2, handler.metrics.counter("publisher.batches"))
+
+    def test_duplicate_batches_forwarded_once(self):
+        """
+        Test that a resent batch is acknowledged but not forwarded again.
+        """
+        received, thread = self.subscribe(2)
+        backend = publisher.LocalBrokerBackend(self.address)
+        backend.send("batch-1", [{"n": 1}])
+        backend.send("batch-1", [{"n": 1}])
+        backend.send("batch-2", [{"n": 2}])
+        backend.close()
+        thread.join(5)
+        self.assertEqual([{"n": 1}, {"n": 2}], received)
+
+    def test_retries_until_acknowledged(self):
+        """
+        Test that a failed batch is sent again with the same ID.
+        """
+        backend = mock.MagicMock(name="backend")
+        backend.send.side_effect = [IOError("down"), None]
+        handler = publisher.PublisherHandler(self.config, backend=backend)
+        handler.ref_updated(sample_events.ref_updated())
+        handler.close()
+        self.assertEqual(2, backend.send.call_count)
+        first, second = backend.send.call_args_list
+        self.assertEqual(first, second)
+        self.assertEqual(1, handler.metrics.counter("publisher.retries"))
+        self.assertEqual(1, handler.metrics.counter("publisher.events"))
+
+    def test_compressed_batches_are_gzip(self):
+        """
+        Test that compressed batches are real gzip data and that batches of
+        older publishers in the zlib format are still read.
+        """
+        lines = ['{"type": "ref-updated"}', '{"type": "change-merged"}']
+        data = base64.b64decode(publisher.compress(lines))
+        self.assertEqual("\n".join(lines),
+                         gzip.GzipFile(fileobj=StringIO.StringIO(data)).read())
+        self.assertEqual(lines,
+                         publisher.decompress(publisher.compress(lines)))
+        old = base64.b64encode(zlib.compress("\n".join(lines)))
+        self.assertEqual(lines, publisher.decompress(old))
+
+if __name__ == '__main__':
+    unittest.main()
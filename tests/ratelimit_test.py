@@ -0,0 +1,99 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+from gerritevent.ratelimit import RateLimiter
+import sys
+import threading
+import time
+import unittest
+import StringIO
+if sys.version_info < (3, 0):
+    from ConfigParser import ConfigParser
+else:
+    from configparser import ConfigParser
+
+
+class RateLimiterTest(unittest.TestCase):
+    """
+    This class tests the gerritevent.ratelimit.RateLimiter class.
+    """
+    def test_burst_then_throttle(self):
+        """
+        Test that a burst passes immediately and the next call waits for
+        the bucket to refill.
+        """
+        limiter = RateLimiter(rate=10, burst=3)
+        for _ in range(3):
+            self.assertTrue(limiter.acquire() < 0.05)
+        self.assertTrue(limiter.acquire() >= 0.05)
+        self.assertEqual(4, limiter.metrics.snapshot()[
+            "ratelimit.default.wait.count"])
+
+    def test_per_target(self):
+        """
+        Test that a busy target is throttled while others are not.
+        """
+        limiter = RateLimiter(rate=1000, burst=100, target_rate=5)
+        limiter.acquire(target="1")
+        self.assertTrue(limiter.acquire(target="2") < 0.05)
+        self.assertTrue(limiter.acquire(target="1") >= 0.1)
+
+    def test_throttled_target_does_not_block_others(self):
+        """
+        Test that a caller waiting for its target's bucket doesn't hold up
+        callers for a target that still has budget.
+        """
+        limiter = RateLimiter(rate=1000, burst=100, target_rate=2,
+                              priorities={"change-merged": 0})
+        limiter.acquire(target="1")
+        waited = []
+        thread = threading.Thread(
+            target=lambda: waited.append(
+                limiter.acquire(target="1", event_type="change-merged")))
+        thread.start()
+        time.sleep(0.05)
+        self.assertTrue(limiter.acquire(target="2") < 0.05)
+        self.assertTrue(limiter.acquire(target="3") < 0.05)
+        thread.join(5)
+        self.assertTrue(waited[0] >= 0.3)
+
+    def test_priorities(self):
+        """
+        Test that queued callers with a better priority are served first.
+        """
+        limiter = RateLimiter(rate=20, burst=1,
+                              priorities={"change-merged": 0,
+                                          "comment-added": 10})
+        limiter.acquire()
+        order = []
+
+        def call(event_type):
+            limiter.acquire(event_type=event_type)
+            order.append(event_type)
+
+        threads = []
+        for event_type in ["comment-added", "comment-added", "change-merged"]:
+            threads.append(threading.Thread(target=call, args=(event_type,)))
+            threads[-1].start()
+            time.sleep(0.005)
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(["change-merged", "comment-added", "comment-added"],
+                         order)
+
+    def test_from_config(self):
+        """
+        Test that a limiter is only built if "rate_limit" is configured.
+        """
+        config = ConfigParser()
+        config.readfp(StringIO.StringIO("""[redmine]
+rate_limit: 2
+rate_priorities: change-merged:0, comment-added:10
+"""))
+        self.assertTrue(RateLimiter.from_config(config, "redmine") is not None)
+        self.assertTrue(RateLimiter.from_config(config, "other") is None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+from gerritevent.metrics import Metrics
+from gerritevent.resilience import CircuitBreaker
+from gerritevent.resilience import DeadLetterStore
+from gerritevent.resilience import HandlerGuard
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+
+class FailingHandler(object):
+    """
+    A handler that fails as long as "broken" is True.
+    """
+    def __init__(self):
+        self.broken = True
+        self.events = []
+
+    def comment_added(self, event):
+        if self.broken:
+            raise IOError("Redmine is down")
+        self.events.append(event)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    """
+    This class tests the gerritevent.resilience.CircuitBreaker class.
+    """
+    def test_opens_and_recovers(self):
+        """
+        Test that the breaker opens after the threshold, lets one trial
+        call through after the reset timeout and closes on success.
+        """
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertEqual(CircuitBreaker.OPEN, breaker.state())
+        self.assertFalse(breaker.allow())
+        time.sleep(0.15)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.success()
+        self.assertEqual(CircuitBreaker.CLOSED, breaker.state())
+
+    def test_failed_trial_reopens(self):
+        """
+        Test that a failing trial call opens the breaker again.
+        """
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.1)
+        breaker.failure()
+        time.sleep(0.15)
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertEqual(CircuitBreaker.OPEN, breaker.state())
+
+
+class HandlerGuardTest(unittest.TestCase):
+    """
+    This class tests the gerritevent.resilience.HandlerGuard class together
+    with the DeadLetterStore.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = DeadLetterStore(os.path.join(self.directory, "dl.json"))
+        self.metrics = Metrics()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_failures_are_dead_lettered_and_replayed(self):
+        """
+        Test that failed and short-circuited events end up in the store and
+        can be replayed once the handler works again.
+        """
+        handler = FailingHandler()
+        guard = HandlerGuard(handler, self.metrics,
+                             breaker=CircuitBreaker(1, 60),
+                             dead_letters=self.store)
+        self.assertFalse(guard.call("comment_added", {"id": 1}))
+        self.assertFalse(guard.call("comment_added", {"id": 2}))
+        self.assertEqual(
+            1, self.metrics.counter("handler.FailingHandler.failures"))
+        self.assertEqual(
+            1, self.metrics.counter("handler.FailingHandler.short_circuited"))
+        self.assertEqual(2, len(self.store.entries()))
+        handler.broken = False
+        self.assertEqual(2, self.store.replay([handler]))
+        self.assertEqual([{"id": 1}, {"id": 2}], handler.events)
+        self.assertEqual([], self.store.entries())
+
+    def test_timeout(self):
+        """
+        Test that a hanging handler times out and isn't called again while
+        the hanging call is still running.
+        """
+        release = threading.Event()
+        handler = FailingHandler()
+        handler.comment_added = lambda event: release.wait(5)
+        guard = HandlerGuard(handler, self.metrics, timeout=0.1,
+                             dead_letters=self.store)
+        try:
+            self.assertFalse(guard.call("comment_added", {"id": 1}))
+            self.assertFalse(guard.call("comment_added", {"id": 2}))
+            self.assertEqual(
+                2, self.metrics.counter("handler.FailingHandler.timeouts"))
+        finally:
+            release.set()
+            # Let the hanging call finish before the interpreter exits.
+            time.sleep(0.1)
+
+    def test_timeout_keeps_other_slots(self):
+        """
+        Test that a hanging call only takes its own slot of a limited
+        handler and that the calls reuse their threads.
+        """
+        release = threading.Event()
+        handler = FailingHandler()
+        handler.broken = False
+        calls = []
+
+        def comment_added(event):
+            calls.append(threading.current_thread().name)
+            if event["id"] == 1:
+                release.wait(5)
+        handler.comment_added = comment_added
+        guard = HandlerGuard(handler, self.metrics, timeout=0.1, limit=2)
+        try:
+            self.assertFalse(guard.call("comment_added", {"id": 1}))
+            for number in range(2, 5):
+                self.assertTrue(guard.call("comment_added", {"id": number}))
+            self.assertEqual(2, len(set(calls)))
+            self.assertEqual(
+                1, self.metrics.counter("handler.FailingHandler.timeouts"))
+        finally:
+            release.set()
+            time.sleep(0.1)
+
+if __name__ == '__main__':
+    unittest.main()
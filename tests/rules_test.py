@@ -0,0 +1,246 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+from gerritevent.metrics import Metrics
+from gerritevent.resilience import DeadLetterStore, HandlerGuard
+from gerritevent.rules import ActionError, Rule, RuleError, RuleHandler
+from gerritevent.rules import RuleIndex, event_values
+import mock
+import os
+import sample_events
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+import StringIO
+if sys.version_info < (3, 0):
+    from ConfigParser import ConfigParser
+else:
+    from configparser import ConfigParser
+
+
+class RecordingAction(object):
+    """
+    Remembers the values it was run with.
+    """
+    def __init__(self):
+        self.runs = []
+
+    def run(self, values):
+        self.runs.append(values)
+
+
+class RuleIndexTest(unittest.TestCase):
+    """
+    This class tests the gerritevent.rules.RuleIndex and Rule classes.
+    """
+    def test_index_keeps_rule_order(self):
+        """
+        Test that only the rules for the event's type and project (or open
+        ones) match, in the order they were given.
+        """
+        rules = [Rule("any", RecordingAction()),
+                 Rule("merged", RecordingAction(), types=["change-merged"]),
+                 Rule("tools", RecordingAction(), projects=["tools"]),
+                 Rule("other", RecordingAction(), projects=["other"]),
+                 Rule("both", RecordingAction(), types=["change-merged"],
+                      projects=["tools", "infra"])]
+        index = RuleIndex(rules)
+        self.assertEqual(["any", "merged", "tools", "both"],
+                         [rule.name for rule in index.match(
+                             sample_events.change_merged(1))])
+        self.assertEqual(["any", "tools"],
+                         [rule.name for rule in index.match(
+                             sample_events.comment_added(1))])
+
+    def test_conditions(self):
+        """
+        Test the branch, approval, subject and comment conditions.
+        """
+        config = ConfigParser()
+        config.readfp(StringIO.StringIO("""[rule approved]
+types: comment-added
+branches: release/* master
+approvals: Code-Review>=2 Verified=1
+subject: #\\d+
+comment: (?i)looks good
+template: $change_number
+"""))
+        rule = Rule.from_config(config, "rule approved")
+        event = sample_events.comment_added(1)
+        self.assertTrue(rule.matches(event))
+        event["approvals"][1]["value"] = "1"
+        self.assertFalse(rule.matches(event))
+        event = sample_events.comment_added(1, branch="stable")
+        self.assertFalse(rule.matches(event))
+        event = sample_events.comment_added(1, comment="Needs work")
+        self.assertFalse(rule.matches(event))
+
+    def test_invalid_rules(self):
+        """
+        Test that invalid rules are refused.
+        """
+        config = ConfigParser()
+        config.readfp(StringIO.StringIO("""[rule approval]
+approvals: Code-Review~2
+template: x
+[rule regex]
+subject: (
+template: x
+[rule action]
+action: mail
+[rule url]
+action: http
+"""))
+        for section in config.sections():
+            self.assertRaises(RuleError, Rule.from_config, config, section,
+                              mock.MagicMock())
+
+    def test_values(self):
+        """
+        Test the values the templates can use.
+        """
+        values = event_values(sample_events.comment_added(7))
+        self.assertEqual("7", values["change_number"])
+        self.assertEqual("tools", values["project"])
+        self.assertEqual("master", values["branch"])
+        self.assertEqual("2", values["approval_Code_Review"])
+        self.assertEqual("bob", values["author_name"])
+        values = event_values(sample_events.ref_updated())
+        self.assertEqual(values["refUpdate_newRev"],
+                         sample_events.ref_updated()["refUpdate"]["newRev"])
+
+
+class RuleHandlerTest(unittest.TestCase):
+    """
+    This class tests the gerritevent.rules.RuleHandler class.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.rules = os.path.join(self.directory, "rules.conf")
+        self.output = os.path.join(self.directory, "out.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_rules(self, text):
+        with open(self.rules, "w") as rules:
+            rules.write(text)
+
+    def handler(self):
+        config = ConfigParser()
+        config.readfp(StringIO.StringIO("""[rules]
+file: %s
+reload_interval: 0
+""" % self.rules))
+        return RuleHandler(config)
+
+    def test_actions(self):
+        """
+        Test that template and HTTP actions run and a failing action
+        doesn't stop the others, but is raised afterwards.
+        """
+        self.write_rules("""[rule notify]
+types: change-merged
+action: http
+url: http://ci/merged/$change_number
+body: {"project": "$project"}
+[rule log]
+types: change-merged
+template: merged $change_number on $branch
+file: %s
+""" % self.output)
+        http = mock.MagicMock()
+        http.request.return_value = (mock.MagicMock(status=500), "")
+        httplib2 = mock.MagicMock()
+        httplib2.Http.return_value = http
+        handler = self.handler()
+        with mock.patch.dict(sys.modules, {"httplib2": httplib2}):
+            self.assertRaises(ActionError, handler.change_merged,
+                              sample_events.change_merged(3))
+        handler.comment_added(sample_events.comment_added(3))
+        http.request.assert_called_once_with(
+            uri="http://ci/merged/3", method="POST",
+            body='{"project": "tools"}',
+            headers={"Content-type": "application/json"})
+        with open(self.output) as out:
+            self.assertEqual("merged 3 on master\n", out.read())
+        self.assertEqual(1, handler.metrics.counter("rules.notify.failures"))
+        self.assertEqual(1, handler.metrics.counter("rules.log.matched"))
+
+    def test_failures_reach_the_guard(self):
+        """
+        Test that a failing action is dead-lettered by the HandlerGuard
+        after the other actions ran.
+        """
+        self.write_rules("""[rule broken]
+types: change-merged
+template: merged $change_number
+file: %s
+[rule log]
+types: change-merged
+template: merged $change_number
+file: %s
+""" % (os.path.join(self.directory, "missing", "out.txt"), self.output))
+        store = DeadLetterStore(os.path.join(self.directory, "dl.json"))
+        metrics = Metrics()
+        guard = HandlerGuard(self.handler(), metrics, dead_letters=store)
+        self.assertFalse(guard.call("change_merged",
+                                    sample_events.change_merged(3)))
+        with open(self.output) as out:
+            self.assertEqual("merged 3\n", out.read())
+        self.assertEqual(1, metrics.counter("handler.RuleHandler.failures"))
+        self.assertEqual(1, len(store.entries()))
+
+    def test_reload(self):
+        """
+        Test that a reload swaps the rules and invalid rules keep the old
+        ones.
+        """
+        self.write_rules("""[rule old]
+template: old
+file: %s
+""" % self.output)
+        handler = self.handler()
+        old = handler.index
+        self.write_rules("""[rule new]
+template: new
+file: %s
+""" % self.output)
+        self.assertTrue(handler.reload())
+        self.assertEqual(["new"], [rule.name for rule in handler.index.rules])
+        self.write_rules("""[rule broken]
+action: mail
+""")
+        self.assertFalse(handler.reload())
+        self.assertEqual(["new"], [rule.name for rule in handler.index.rules])
+        self.assertFalse(old is handler.index)
+        self.assertEqual(1, handler.metrics.counter("rules.reload_failures"))
+
+    def test_watch_file(self):
+        """
+        Test that the rules are reloaded when the file changes.
+        """
+        self.write_rules("[rule first]\ntemplate: first\n")
+        config = ConfigParser()
+        config.readfp(StringIO.StringIO("""[rules]
+file: %s
+reload_interval: 0.05
+""" % self.rules))
+        handler = RuleHandler(config)
+        try:
+            self.write_rules("[rule second]\ntemplate: second\n")
+            os.utime(self.rules, (time.time() + 10, time.time() + 10))
+            for _ in range(100):
+                if handler.index.rules[0].name == "second":
+                    break
+                time.sleep(0.02)
+            self.assertEqual("second", handler.index.rules[0].name)
+        finally:
+            handler.close()
+
+if __name__ == '__main__':
+    unittest.main()
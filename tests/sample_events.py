@@ -0,0 +1,124 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+
+Complete Gerrit events as emitted by "gerrit stream-events", for tests.
+"""
+
+
+def account(name):
+    """
+    Returns an account dictionary for "name".
+    """
+    return {"name": name, "email": name + "@example.com"}
+
+
+def change(number, project="tools", branch="master",
+           subject="Fix crash, see #42"):
+    """
+    Returns a change dictionary.
+    """
+    return {
+        "project": project,
+        "branch": branch,
+        "id": "I%040d" % number,
+        "number": str(number),
+        "subject": subject,
+        "owner": account("alice"),
+        "url": "http://gerritserver/%d" % number
+    }
+
+
+def patchset(number, created_on=1350000000):
+    """
+    Returns a patch set dictionary.
+    """
+    return {
+        "number": str(number),
+        "revision": "%040x" % number,
+        "ref": "refs/changes/42/1042/%d" % number,
+        "uploader": account("alice"),
+        "createdOn": created_on
+    }
+
+
+def patchset_created(number=1042, ps=1, created_on=1350000000, **kwargs):
+    """
+    Returns a "patchset-created" event.
+    """
+    return {
+        "type": "patchset-created",
+        "change": change(number, **kwargs),
+        "patchSet": patchset(ps, created_on),
+        "uploader": account("alice")
+    }
+
+
+def comment_added(number=1042, ps=1, author="bob", comment="Looks good",
+                  approvals=(("VRIF", "1"), ("CRVW", "2")), **kwargs):
+    """
+    Returns a "comment-added" event.
+    """
+    return {
+        "type": "comment-added",
+        "change": change(number, **kwargs),
+        "patchSet": patchset(ps),
+        "author": account(author),
+        "comment": comment,
+        "approvals": [{"type": t, "description": t, "value": v}
+                      for t, v in approvals]
+    }
+
+
+def change_merged(number=1042, ps=1, **kwargs):
+    """
+    Returns a "change-merged" event.
+    """
+    return {
+        "type": "change-merged",
+        "change": change(number, **kwargs),
+        "patchSet": patchset(ps),
+        "submitter": account("carol")
+    }
+
+
+def change_abandoned(number=1042, **kwargs):
+    """
+    Returns a "change-abandoned" event.
+    """
+    return {
+        "type": "change-abandoned",
+        "change": change(number, **kwargs),
+        "abandoner": account("alice"),
+        "reason": "Obsolete"
+    }
+
+
+def change_restored(number=1042, **kwargs):
+    """
+    Returns a "change-restored" event.
+    """
+    return {
+        "type": "change-restored",
+        "change": change(number, **kwargs),
+        "restorer": account("alice"),
+        "reason": "Needed after all"
+    }
+
+
+def ref_updated(project="tools", ref_name="refs/heads/master",
+                old_rev="0" * 40, new_rev="1" * 40):
+    """
+    Returns a "ref-updated" event.
+    """
+    return {
+        "type": "ref-updated",
+        "submitter": account("carol"),
+        "refUpdate": {
+            "oldRev": old_rev,
+            "newRev": new_rev,
+            "refName": ref_name,
+            "project": project
+        }
+    }
@@ -0,0 +1,108 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+from gerritevent.metrics import Metrics
+from gerritevent.scheduling import PriorityEventQueue
+import sample_events
+import sys
+import time
+import unittest
+import StringIO
+if sys.version_info < (3, 0):
+    from ConfigParser import ConfigParser
+else:
+    from configparser import ConfigParser
+
+
+class PriorityEventQueueTest(unittest.TestCase):
+    """
+    This class tests the gerritevent.scheduling.PriorityEventQueue class.
+    """
+    def drain(self, events_queue):
+        items = []
+        while events_queue.qsize():
+            items.append(events_queue.get())
+        return items
+
+    def test_urgent_events_first(self):
+        """
+        Test that urgent classes overtake queued events of other changes,
+        project classes win over type classes and the stop marker is last.
+        """
+        config = ConfigParser()
+        config.readfp(StringIO.StringIO("""[dispatcher]
+priorities: change-merged:0 comment-added:10 comment-added@sandbox:0
+priority_aging: 0
+"""))
+        metrics = Metrics()
+        events_queue = PriorityEventQueue.from_config(config, metrics)
+        stop = object()
+        comment = sample_events.comment_added(1)
+        sandbox = sample_events.comment_added(2)
+        sandbox["change"]["project"] = "sandbox"
+        merged = sample_events.change_merged(3)
+        events_queue.put(comment)
+        events_queue.put(stop)
+        events_queue.put(sandbox)
+        events_queue.put(merged)
+        self.assertEqual([sandbox, merged, comment, stop],
+                         self.drain(events_queue))
+        snapshot = metrics.snapshot()
+        self.assertEqual(1, snapshot["queue_wait.change-merged.count"])
+        self.assertEqual(1, snapshot["queue_wait.comment-added.count"])
+        self.assertEqual(1, snapshot["queue_wait.comment-added@sandbox.count"])
+
+    def test_per_change_order(self):
+        """
+        Test that an urgent event doesn't overtake earlier events of its own
+        change but lifts them instead.
+        """
+        events_queue = PriorityEventQueue({"change-merged": 0,
+                                           "comment-added": 10}, aging=0)
+        first = sample_events.comment_added(1)
+        other = sample_events.comment_added(2)
+        second = sample_events.comment_added(1)
+        merged = sample_events.change_merged(1)
+        for event in (first, other, second, merged):
+            events_queue.put(event)
+        self.assertEqual([first, second, merged, other],
+                         self.drain(events_queue))
+
+    def test_aging(self):
+        """
+        Test that a waiting event eventually beats fresh urgent events.
+        """
+        events_queue = PriorityEventQueue({"change-merged": 0,
+                                           "comment-added": 1}, aging=0.05)
+        comment = sample_events.comment_added(1)
+        events_queue.put(comment)
+        time.sleep(0.1)
+        merged = sample_events.change_merged(2)
+        events_queue.put(merged)
+        self.assertEqual([comment, merged], self.drain(events_queue))
+
+    def test_checkout_holds_lane(self):
+        """
+        Test that a checked out change isn't handed out again before it is
+        released, while other changes are.
+        """
+        events_queue = PriorityEventQueue(aging=0)
+        first = sample_events.comment_added(1)
+        second = sample_events.comment_added(1)
+        other = sample_events.comment_added(2)
+        for event in (first, second, other):
+            events_queue.put(event)
+        item, lane, waited = events_queue.checkout()
+        self.assertEqual(first, item)
+        self.assertTrue(waited >= 0)
+        item, other_lane, _waited = events_queue.checkout()
+        self.assertEqual(other, item)
+        events_queue.release(other_lane)
+        self.assertEqual(1, events_queue.qsize())
+        events_queue.release(lane)
+        self.assertEqual([second], self.drain(events_queue))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,690 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+
+Fake Gerrit and Redmine servers that inject faults, and a soak test that
+runs the real Dispatcher and RedmineHandler against them, e.g.
+    PYTHONPATH=src python tests/soak.py --events 10000 --burst-size 2000 \
+        --burst-every 30 --redmine-latency 0.05 --redmine-errors 0.01 \
+        --gerrit-disconnects 0.0005
+"""
+import json
+import optparse
+import os
+import random
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from gerritevent.metrics import Metrics
+if sys.version_info < (3, 0):
+    import BaseHTTPServer as httpserver
+    import SocketServer as socketserver
+    from ConfigParser import ConfigParser
+    from urlparse import parse_qs, urlparse
+else:
+    import http.server as httpserver
+    import socketserver
+    from configparser import ConfigParser
+    from urllib.parse import parse_qs, urlparse
+
+# Marks the soak events in the comments that reach Redmine.
+_SOAK_ID = re.compile(r"soak-(\d+)")
+
+
+def soak_event(sequence, change=1, issue=1, emitted=None):
+    """
+    Returns the "comment-added" event number "sequence" for change number
+    "change", whose comment refers to Redmine issue "issue".
+    """
+    account = {"name": "soak", "email": "soak@example.com"}
+    return {
+        "type": "comment-added",
+        "change": {
+            "project": "soak",
+            "branch": "master",
+            "id": "I%040d" % change,
+            "number": str(change),
+            "subject": "Soak change %d" % change,
+            "owner": account,
+            "url": "http://gerrit/%d" % change
+        },
+        "patchSet": {
+            "number": "1",
+            "revision": "%040x" % change,
+            "ref": "refs/changes/%02d/%d/1" % (change % 100, change),
+            "uploader": account,
+            "createdOn": int(emitted or time.time())
+        },
+        "author": account,
+        "comment": "Soak #%d soak-%d" % (issue, sequence),
+        "approvals": []
+    }
+
+
+def percentile(values, fraction):
+    """
+    Returns the value below which "fraction" of the sorted "values" lie or
+    None if there are none.
+    """
+    if not values:
+        return None
+    return values[int(fraction * (len(values) - 1))]
+
+
+class FaultPlan(object):
+    """
+    Decides which faults a fake server injects: a delay of "latency" plus up
+    to "jitter" seconds, errors with probability "error_rate" and dropped
+    connections with probability "disconnect_rate". Give a "seed" to
+    repeat a run.
+    """
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0,
+                 disconnect_rate=0.0, seed=None):
+        """
+        Constructs a FaultPlan.
+        """
+        object.__init__(self)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.disconnect_rate = disconnect_rate
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+
+    def delay(self):
+        """
+        Returns the seconds to wait before answering.
+        """
+        if not self.jitter:
+            return self.latency
+        with self.__lock:
+            return self.latency + self.__random.random() * self.jitter
+
+    def error(self):
+        """
+        Returns True if the next answer should be an error.
+        """
+        return self.__roll(self.error_rate)
+
+    def disconnect(self):
+        """
+        Returns True if the connection should be dropped now.
+        """
+        return self.__roll(self.disconnect_rate)
+
+    def __roll(self, rate):
+        """
+        Returns True with probability "rate".
+        """
+        if rate <= 0:
+            return False
+        with self.__lock:
+            return self.__random.random() < rate
+
+
+class FakeGerritServer(object):
+    """
+    An SSH server on "host" that answers "gerrit stream-events" like
+    Gerrit: each line passed to emit() goes to all connected streams and
+    is lost if none is connected. The "faults" cut a stream in
+    the middle of an event (disconnect_rate) or send a malformed line
+    before an event (error_rate). "gerrit query" is answered with no rows.
+    Any user and key are let in. Needs paramiko.
+    """
+    def __init__(self, faults=None, host="127.0.0.1", metrics=None):
+        """
+        Constructs a FakeGerritServer. Call start() to start serving.
+        """
+        object.__init__(self)
+        import paramiko
+        self.__paramiko = paramiko
+        if faults is None:
+            faults = FaultPlan()
+        self.faults = faults
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.__host = host
+        self.address = None
+        self.__host_key = paramiko.RSAKey.generate(2048)
+        self.__lock = threading.Lock()
+        self.__connected = threading.Condition(self.__lock)
+        self.__streams = []
+        self.__transports = []
+        self.__socket = None
+        self.__stopping = threading.Event()
+
+    def start(self):
+        """
+        Binds the socket and accepts connections in a background thread.
+        """
+        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__socket.bind((self.__host, 0))
+        self.__socket.listen(16)
+        self.address = "%s:%d" % self.__socket.getsockname()
+        self.__spawn(self.__accept, "FakeGerritServer")
+
+    def stop(self):
+        """
+        Drops all connections and stops serving.
+        """
+        self.__stopping.set()
+        self.__socket.close()
+        with self.__lock:
+            transports, self.__transports = self.__transports, []
+            self.__streams = []
+        for transport in transports:
+            transport.close()
+
+    def write_client_key(self, path):
+        """
+        Writes a new private key for clients to "path".
+        """
+        self.__paramiko.RSAKey.generate(2048).write_private_key_file(path)
+
+    def wait_for_stream(self, timeout=None):
+        """
+        Waits until a client streams events. Returns True if one does.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.__connected:
+            while not self.__streams:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self.__connected.wait(remaining)
+            return True
+
+    def emit(self, line):
+        """
+        Sends the event "line" to all streams and returns to how many it
+        was sent, including streams that were cut in the middle of it.
+        """
+        if not line.endswith("\n"):
+            line += "\n"
+        with self.__lock:
+            streams = list(self.__streams)
+        sent = 0
+        for channel, transport in streams:
+            try:
+                if self.faults.error():
+                    self.metrics.increment("soak.gerrit.malformed")
+                    channel.sendall("{\"type\": \n")
+                if self.faults.disconnect():
+                    self.metrics.increment("soak.gerrit.disconnects")
+                    sent += 1
+                    channel.sendall(line[:len(line) // 2])
+                    self.__drop(channel, transport)
+                    continue
+                channel.sendall(line)
+                sent += 1
+            except Exception:
+                self.__drop(channel, transport)
+        if not sent:
+            self.metrics.increment("soak.gerrit.missed")
+        return sent
+
+    def execute(self, channel, transport, command):
+        """
+        Answers the "command" a client runs on "channel". Called by the SSH
+        server interface.
+        """
+        if command.strip() == "gerrit stream-events":
+            with self.__connected:
+                self.__streams.append((channel, transport))
+                self.__connected.notify_all()
+            self.metrics.increment("soak.gerrit.streams")
+            return
+        channel.sendall(json.dumps({"type": "stats", "rowCount": 0}) + "\n")
+        channel.send_exit_status(0)
+        channel.close()
+
+    def __accept(self):
+        """
+        Accepts connections until stopped.
+        """
+        while not self.__stopping.is_set():
+            try:
+                connection, _address = self.__socket.accept()
+            except Exception:
+                break
+            self.__spawn(lambda: self.__serve(connection),
+                         "FakeGerritConnection")
+
+    def __serve(self, connection):
+        """
+        Runs the SSH server side of one connection.
+        """
+        paramiko = self.__paramiko
+        transport = paramiko.Transport(connection)
+        transport.add_server_key(self.__host_key)
+        with self.__lock:
+            self.__transports.append(transport)
+        try:
+            transport.start_server(
+                server=_server_interface(paramiko, self, transport))
+            while transport.is_active() and not self.__stopping.is_set():
+                transport.accept(1)
+        except Exception:
+            pass
+        self.__drop(None, transport)
+
+    def __drop(self, channel, transport):
+        """
+        Closes the connection of "transport" and forgets its streams.
+        """
+        with self.__lock:
+            self.__streams = [stream for stream in self.__streams
+                              if stream[1] is not transport]
+            if transport in self.__transports:
+                self.__transports.remove(transport)
+        transport.close()
+
+    @staticmethod
+    def __spawn(target, name):
+        """
+        Runs "target" in a daemon thread.
+        """
+        thread = threading.Thread(target=target, name=name)
+        thread.daemon = True
+        thread.start()
+
+
+def _server_interface(paramiko, server, transport):
+    """
+    Returns the paramiko.ServerInterface that lets everybody in and hands
+    the commands to the FakeGerritServer "server".
+    """
+    class _Interface(paramiko.ServerInterface):
+
+        def get_allowed_auths(self, username):
+            return "publickey,password"
+
+        def check_auth_publickey(self, username, key):
+            return paramiko.AUTH_SUCCESSFUL
+
+        def check_auth_password(self, username, password):
+            return paramiko.AUTH_SUCCESSFUL
+
+        def check_channel_request(self, kind, chanid):
+            if kind == "session":
+                return paramiko.OPEN_SUCCEEDED
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+        def check_channel_exec_request(self, channel, command):
+            if not isinstance(command, str):
+                command = command.decode("utf-8")
+            thread = threading.Thread(
+                target=server.execute, args=(channel, transport, command),
+                name="FakeGerritCommand")
+            thread.daemon = True
+            thread.start()
+            return True
+
+    return _Interface()
+
+
+class _RedmineRequestHandler(httpserver.BaseHTTPRequestHandler):
+    """
+    Hands the requests of the RedmineHandler to the FakeRedmineServer.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_PUT(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.server.redmine.put(self, self.rfile.read(length))
+
+    def do_GET(self):
+        self.server.redmine.get(self)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                           httpserver.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeRedmineServer(object):
+    """
+    An HTTP server on "host" that accepts the comments and issue lookups of
+    the RedmineHandler. Every issue exists. Each request is delayed as the
+    "faults" say and fails with 500 (error_rate) or a dropped connection
+    (disconnect_rate). The soak events of accepted comments are recorded
+    with the time they arrived (see accepted()).
+    """
+    def __init__(self, faults=None, host="127.0.0.1", metrics=None):
+        """
+        Constructs a FakeRedmineServer. Call start() to start serving.
+        """
+        object.__init__(self)
+        if faults is None:
+            faults = FaultPlan()
+        self.faults = faults
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.__host = host
+        self.address = None
+        self.__lock = threading.Lock()
+        self.__accepted = []
+        self.__server = None
+
+    def start(self):
+        """
+        Binds the socket and serves it in a background thread.
+        """
+        self.__server = _ThreadingHTTPServer((self.__host, 0),
+                                             _RedmineRequestHandler)
+        self.__server.redmine = self
+        self.address = "%s:%d" % self.__server.server_address
+        thread = threading.Thread(target=self.__server.serve_forever,
+                                  name="FakeRedmineServer")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """
+        Stops serving.
+        """
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def issue_url(self):
+        """
+        Returns the "issue_url" for the "redmine" config section.
+        """
+        return "http://%s/issues/%%d.json" % self.address
+
+    def accepted(self):
+        """
+        Returns a list of (soak sequence number, arrival time) of all
+        accepted comments, including repeated ones.
+        """
+        with self.__lock:
+            return list(self.__accepted)
+
+    def put(self, request, body):
+        """
+        Answers a comment PUT.
+        """
+        if not self.__fault(request):
+            return
+        now = time.time()
+        with self.__lock:
+            for sequence in _SOAK_ID.findall(body.decode("utf-8")):
+                self.__accepted.append((int(sequence), now))
+        self.metrics.increment("soak.redmine.accepted")
+        self.__reply(request, 200, "")
+
+    def get(self, request):
+        """
+        Answers an issue lookup: all issues exist.
+        """
+        if not self.__fault(request):
+            return
+        query = parse_qs(urlparse(request.path).query)
+        ids = ",".join(query.get("issue_id", [""])).split(",")
+        issues = [{"id": int(issue_id), "project": {"id": 1, "name": "Soak"}}
+                  for issue_id in ids if issue_id.isdigit()]
+        self.__reply(request, 200, json.dumps({"issues": issues}))
+
+    def __fault(self, request):
+        """
+        Injects the faults. Returns False if the request was answered by one.
+        """
+        delay = self.faults.delay()
+        if delay:
+            time.sleep(delay)
+        if self.faults.disconnect():
+            self.metrics.increment("soak.redmine.disconnects")
+            request.close_connection = True
+            return False
+        if self.faults.error():
+            self.metrics.increment("soak.redmine.errors")
+            self.__reply(request, 500, "")
+            return False
+        return True
+
+    @staticmethod
+    def __reply(request, status, body):
+        """
+        Sends the response.
+        """
+        body = body.encode("utf-8")
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+
+class Soak(object):
+    """
+    Runs the real Dispatcher with a RedmineHandler against a
+    FakeGerritServer and a FakeRedmineServer and reports what arrived.
+    "events" comment-added events for "changes" changes are emitted at
+    "rate" per second; every "burst_every" seconds "burst_size" more are
+    emitted at once. The servers inject "gerrit_faults" and
+    "redmine_faults". "config" may hold further sections, e.g. the
+    "dispatcher" workers or "idempotency"; the "gerrit" and "redmine"
+    sections are filled in. After the last event, the run waits until no
+    comment arrived for "settle" seconds.
+    """
+    def __init__(self, events=1000, rate=100.0, burst_size=0,
+                 burst_every=0.0, changes=100, gerrit_faults=None,
+                 redmine_faults=None, config=None, settle=10.0):
+        """
+        Constructs a Soak.
+        """
+        object.__init__(self)
+        self.events = events
+        self.rate = rate
+        self.burst_size = burst_size
+        self.burst_every = burst_every
+        self.changes = changes
+        self.gerrit_faults = gerrit_faults
+        self.redmine_faults = redmine_faults
+        if config is None:
+            config = ConfigParser()
+        self.config = config
+        self.settle = settle
+        self.metrics = Metrics()
+
+    def run(self):
+        """
+        Runs the soak and returns the report (see report()).
+        """
+        import gerritevent
+        directory = tempfile.mkdtemp()
+        gerrit = FakeGerritServer(self.gerrit_faults, metrics=self.metrics)
+        redmine = FakeRedmineServer(self.redmine_faults,
+                                    metrics=self.metrics)
+        gerrit.start()
+        redmine.start()
+        dispatcher = None
+        try:
+            key_file = os.path.join(directory, "id_rsa")
+            gerrit.write_client_key(key_file)
+            self.__configure(gerrit, redmine, key_file)
+            handler = gerritevent.RedmineHandler(self.config, self.metrics)
+            dispatcher = gerritevent.Dispatcher(self.config, [handler],
+                                                endless=True,
+                                                metrics=self.metrics)
+            dispatcher.start()
+            if not gerrit.wait_for_stream(60):
+                raise IOError("the dispatcher didn't connect")
+            emitted = self.__emit(gerrit)
+            self.__settle(redmine)
+            return self.report(emitted, redmine.accepted())
+        finally:
+            if dispatcher is not None:
+                dispatcher.stop(timeout=self.settle)
+            gerrit.stop()
+            redmine.stop()
+            shutil.rmtree(directory)
+
+    def report(self, emitted, accepted):
+        """
+        Returns a dictionary with the numbers of the run, given the emit
+        time of each event that reached a stream ("emitted", by sequence
+        number) and the (sequence number, arrival time) of each accepted
+        comment: "events" emitted, "missed" (no stream was connected),
+        "delivered", "lost" (streamed but never accepted), "duplicates"
+        (accepted more than once), "throughput" (delivered per second),
+        the lag from emit to acceptance ("lag_p50", "lag_p99", "lag_max"
+        in seconds) and the fault counters.
+        """
+        first = {}
+        for sequence, arrived in accepted:
+            if sequence not in first:
+                first[sequence] = arrived
+        lags = sorted(first[sequence] - emitted[sequence]
+                      for sequence in first if sequence in emitted)
+        elapsed = 0.0
+        if first and emitted:
+            elapsed = max(first.values()) - min(emitted.values())
+        throughput = 0.0
+        if elapsed > 0:
+            throughput = len(first) / elapsed
+        snapshot = self.metrics.snapshot()
+        report = {
+            "events": self.events,
+            "missed": self.events - len(emitted),
+            "delivered": len(first),
+            "lost": len([sequence for sequence in emitted
+                         if sequence not in first]),
+            "duplicates": len(accepted) - len(first),
+            "throughput": throughput,
+            "lag_p50": percentile(lags, 0.5),
+            "lag_p99": percentile(lags, 0.99),
+            "lag_max": percentile(lags, 1.0),
+        }
+        for name, value in snapshot.items():
+            if name.startswith("soak."):
+                report[name[len("soak."):]] = value
+        return report
+
+    def __configure(self, gerrit, redmine, key_file):
+        """
+        Points the "gerrit" and "redmine" config sections at the servers.
+        """
+        host, port = gerrit.address.split(":")
+        for section in ("gerrit", "redmine"):
+            if not self.config.has_section(section):
+                self.config.add_section(section)
+        for option, value in (("host", host), ("port", port),
+                              ("user", "soak"), ("ssh_private_key", key_file),
+                              ("passphrase", ""), ("reconnect_delay", "1")):
+            if not self.config.has_option("gerrit", option):
+                self.config.set("gerrit", option, value)
+        self.config.set("redmine", "issue_url", redmine.issue_url())
+        for option, value in (("api_key", "soak"),
+                              ("comment_added_template", "$comment")):
+            if not self.config.has_option("redmine", option):
+                self.config.set("redmine", option, value)
+
+    def __emit(self, gerrit):
+        """
+        Emits the events on schedule. Returns the emit time of each event
+        that reached a stream, by sequence number.
+        """
+        emitted = {}
+        start = time.time()
+        next_burst = start + (self.burst_every or float("inf"))
+        regular = 0
+        sequence = 0
+        while sequence < self.events:
+            now = time.time()
+            count = 1
+            if self.burst_size and now >= next_burst:
+                count = self.burst_size
+                next_burst += self.burst_every
+            else:
+                regular += 1
+            for _ in range(min(count, self.events - sequence)):
+                now = time.time()
+                line = json.dumps(soak_event(sequence,
+                                             sequence % self.changes + 1,
+                                             sequence % 20 + 1, now))
+                if gerrit.emit(line):
+                    emitted[sequence] = now
+                sequence += 1
+            delay = start + regular / float(self.rate) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        return emitted
+
+    def __settle(self, redmine):
+        """
+        Waits until no comment arrived for "settle" seconds.
+        """
+        count = -1
+        while True:
+            accepted = len(redmine.accepted())
+            if accepted == count:
+                return
+            count = accepted
+            time.sleep(self.settle)
+
+
+def main():
+    """
+    Runs the real Dispatcher and RedmineHandler against a fake Gerrit and a
+    fake Redmine that inject faults, and prints throughput, lag and lost and
+    duplicate events. Further config sections (e.g. the [dispatcher] workers
+    or [idempotency]) are read from the file given with --config.
+    """
+    parser = optparse.OptionParser()
+    parser.add_option("--events", type="int", default=1000)
+    parser.add_option("--rate", type="float", default=100.0,
+                      help="events per second")
+    parser.add_option("--burst-size", type="int", default=0)
+    parser.add_option("--burst-every", type="float", default=0.0,
+                      help="seconds between bursts")
+    parser.add_option("--changes", type="int", default=100)
+    parser.add_option("--gerrit-errors", type="float", default=0.0,
+                      help="share of events preceded by a malformed line")
+    parser.add_option("--gerrit-disconnects", type="float", default=0.0,
+                      help="share of events the stream is cut in")
+    parser.add_option("--redmine-latency", type="float", default=0.0)
+    parser.add_option("--redmine-jitter", type="float", default=0.0)
+    parser.add_option("--redmine-errors", type="float", default=0.0,
+                      help="share of requests answered with 500")
+    parser.add_option("--redmine-disconnects", type="float", default=0.0,
+                      help="share of requests whose connection is dropped")
+    parser.add_option("--seed", type="int")
+    parser.add_option("--settle", type="float", default=10.0)
+    parser.add_option("--config")
+    opts, _args = parser.parse_args()
+    config = ConfigParser()
+    if opts.config:
+        config.read(opts.config)
+    soak = Soak(opts.events, opts.rate, opts.burst_size, opts.burst_every,
+                opts.changes,
+                FaultPlan(error_rate=opts.gerrit_errors,
+                          disconnect_rate=opts.gerrit_disconnects,
+                          seed=opts.seed),
+                FaultPlan(opts.redmine_latency, opts.redmine_jitter,
+                          opts.redmine_errors, opts.redmine_disconnects,
+                          seed=opts.seed),
+                config, opts.settle)
+    report = soak.run()
+    for name in sorted(report):
+        print("%-22s %s" % (name + ":", report[name]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+from nose.plugins.skip import SkipTest
+from soak import FakeRedmineServer, FaultPlan, Soak
+from soak import percentile, soak_event
+import json
+import sys
+import unittest
+if sys.version_info < (3, 0):
+    import httplib
+    from ConfigParser import ConfigParser
+else:
+    import http.client as httplib
+    from configparser import ConfigParser
+try:
+    import httplib2
+    import paramiko
+except ImportError:
+    paramiko = None
+
+
+class FaultPlanTest(unittest.TestCase):
+    """
+    This class tests the soak.FaultPlan class.
+    """
+    def test_rates(self):
+        """
+        Test that faults are injected at about their rates and that a seed
+        repeats them.
+        """
+        plan = FaultPlan(latency=0.1, jitter=0.1, error_rate=0.2, seed=7)
+        errors = [plan.error() for _ in range(1000)]
+        self.assertTrue(150 < errors.count(True) < 250)
+        self.assertFalse(plan.disconnect())
+        self.assertTrue(0.1 <= plan.delay() <= 0.2)
+        again = FaultPlan(latency=0.1, jitter=0.1, error_rate=0.2, seed=7)
+        self.assertEqual(errors, [again.error() for _ in range(1000)])
+
+
+class FakeRedmineServerTest(unittest.TestCase):
+    """
+    This class tests the soak.FakeRedmineServer class.
+    """
+    def setUp(self):
+        self.redmine = FakeRedmineServer()
+        self.redmine.start()
+        host, port = self.redmine.address.split(":")
+        self.connection = httplib.HTTPConnection(host, int(port), timeout=5)
+
+    def tearDown(self):
+        self.connection.close()
+        self.redmine.stop()
+
+    def request(self, method, path, body=None):
+        self.connection.request(method, path, body)
+        response = self.connection.getresponse()
+        return response.status, response.read()
+
+    def test_comments_and_lookups(self):
+        """
+        Test that accepted comments are recorded, failing ones aren't and
+        that every issue exists.
+        """
+        body = json.dumps({"issue": {"notes": soak_event(3)["comment"]}})
+        self.assertEqual(200, self.request("PUT", "/issues/1.json", body)[0])
+        self.assertEqual(200, self.request("PUT", "/issues/1.json", body)[0])
+        self.redmine.faults.error_rate = 1.0
+        self.assertEqual(500, self.request("PUT", "/issues/1.json", body)[0])
+        self.redmine.faults.error_rate = 0.0
+        status, content = self.request("GET",
+                                       "/issues.json?issue_id=1,2&limit=100")
+        self.assertEqual(200, status)
+        self.assertEqual([1, 2], [issue["id"] for issue
+                                  in json.loads(content)["issues"]])
+        self.assertEqual([3, 3], [sequence for sequence, _arrived
+                                  in self.redmine.accepted()])
+        self.assertEqual(1, self.redmine.metrics.counter(
+            "soak.redmine.errors"))
+
+
+class SoakReportTest(unittest.TestCase):
+    """
+    This class tests the report of the soak.Soak class.
+    """
+    def test_report(self):
+        """
+        Test that missed, lost and duplicate events and the lag are
+        counted.
+        """
+        soak = Soak(events=5)
+        report = soak.report({0: 10.0, 1: 11.0, 2: 12.0, 3: 13.0},
+                             [(0, 10.5), (1, 12.0), (1, 12.5), (3, 15.0)])
+        self.assertEqual(1, report["missed"])
+        self.assertEqual(3, report["delivered"])
+        self.assertEqual(1, report["lost"])
+        self.assertEqual(1, report["duplicates"])
+        self.assertEqual(1.0, report["lag_p50"])
+        self.assertEqual(2.0, report["lag_max"])
+        self.assertEqual(0.6, report["throughput"])
+        self.assertEqual(None, percentile([], 0.5))
+
+
+class SoakRunTest(unittest.TestCase):
+    """
+    This class runs a short soak of the real Dispatcher and RedmineHandler
+    against the fake servers.
+    """
+    def test_run(self):
+        """
+        Test that every streamed event reaches the fake Redmine once, also
+        if it answers some requests with errors.
+        """
+        if paramiko is None:
+            raise SkipTest("needs paramiko and httplib2")
+        config = ConfigParser()
+        config.add_section("dispatcher")
+        config.set("dispatcher", "max_workers", "4")
+        soak = Soak(events=50, rate=200.0, changes=10,
+                    redmine_faults=FaultPlan(latency=0.01, jitter=0.01),
+                    config=config, settle=1.0)
+        report = soak.run()
+        self.assertEqual(0, report["missed"])
+        self.assertEqual(50, report["delivered"])
+        self.assertEqual(0, report["lost"])
+        self.assertEqual(0, report["duplicates"])
+        self.assertEqual(1, report["gerrit.streams"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+from gerritevent.sshpool import CommandError
+from gerritevent.sshpool import GerritCommandPool
+import json
+import threading
+import time
+import unittest
+import StringIO
+
+
+class FakeChannel(object):
+    """
+    Mimics a paramiko channel; the output is looked up by command.
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def settimeout(self, timeout):
+        pass
+
+    def exec_command(self, command):
+        self.command = command
+        self.client.commands.append(command)
+        with self.client.lock:
+            self.client.running += 1
+            self.client.peak = max(self.client.peak, self.client.running)
+        self.client.release.wait(5)
+
+    def makefile(self, mode):
+        return StringIO.StringIO(self.client.responses.get(self.command, ""))
+
+    def makefile_stderr(self, mode):
+        return StringIO.StringIO("fatal: not found\n")
+
+    def recv_exit_status(self):
+        return 1 if self.command not in self.client.responses else 0
+
+    def close(self):
+        with self.client.lock:
+            self.client.running -= 1
+
+
+class FakeClient(object):
+    """
+    Mimics a connected paramiko.SSHClient.
+    """
+    def __init__(self, responses, release):
+        self.responses = responses
+        self.release = release
+        self.commands = []
+        self.lock = threading.Lock()
+        self.running = 0
+        self.peak = 0
+        self.closed = False
+
+    def get_transport(self):
+        return self
+
+    def is_active(self):
+        return not self.closed
+
+    def open_session(self):
+        return FakeChannel(self)
+
+    def close(self):
+        self.closed = True
+
+
+class GerritCommandPoolTest(unittest.TestCase):
+    """
+    This class tests the gerritevent.sshpool.GerritCommandPool class.
+    """
+    def setUp(self):
+        self.release = threading.Event()
+        self.release.set()
+        query = 'gerrit query --format=JSON --files "change:4711"'
+        self.responses = {
+            query: json.dumps({"number": "4711", "topic": "x"}) + "\n" +
+            json.dumps({"type": "stats", "rowCount": 1}) + "\n",
+            "gerrit version": "gerrit version 2.4\n"}
+        self.connected = []
+        self.pool = GerritCommandPool(self.connect, max_concurrent=2,
+                                      channels_per_transport=1,
+                                      max_transports=1)
+
+    def connect(self):
+        client = FakeClient(self.responses, self.release)
+        self.connected.append(client)
+        return client
+
+    def test_shared_transport_and_results(self):
+        """
+        Test that commands run on the shared connection and that JSON and
+        text output is streamed back.
+        """
+        shared = FakeClient(self.responses, self.release)
+        self.pool.share(shared)
+        self.assertEqual([{"number": "4711", "topic": "x"}],
+                         self.pool.query("change:4711", "--files"))
+        self.assertEqual(["gerrit version 2.4"],
+                         list(self.pool.run_gerrit_command("version")))
+        self.assertEqual(2, len(shared.commands))
+        self.assertEqual([], self.connected)
+
+    def test_failure(self):
+        """
+        Test that a failing command raises a CommandError.
+        """
+        try:
+            list(self.pool.run_gerrit_command("query nothing"))
+            self.fail("CommandError expected")
+        except CommandError, ex:
+            self.assertEqual(1, ex.status)
+            self.assertEqual("fatal: not found\n", ex.stderr)
+
+    def test_concurrency_limit(self):
+        """
+        Test that no more than "max_concurrent" commands run at once and
+        that extra connections are only opened up to "max_transports".
+        """
+        self.release.clear()
+        shared = FakeClient(self.responses, self.release)
+        self.pool.share(shared)
+        threads = []
+        for _ in range(4):
+            thread = threading.Thread(
+                target=lambda: list(self.pool.run_gerrit_command("version")))
+            thread.start()
+            threads.append(thread)
+        time.sleep(0.1)
+        self.assertEqual(1, len(self.connected))
+        self.assertEqual(1, shared.running)
+        self.assertEqual(1, self.connected[0].running)
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+        self.pool.close()
+        self.assertTrue(self.connected[0].closed)
+        self.assertEqual(4, self.pool.metrics.snapshot()[
+            "gerrit_commands.count"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+import os
+import subprocess
+import sys
+import unittest
+
+
+class StartupTest(unittest.TestCase):
+    """
+    This class tests that importing the gerritevent package stays cheap.
+    """
+    def test_package_import_is_lightweight(self):
+        """
+        Test that optional integrations and servers aren't imported with the
+        package but only when they are used.
+        """
+        heavy = ["paramiko", "httplib2", "sqlite3", "SocketServer",
+                 "BaseHTTPServer", "zlib", "gerritevent.fanout",
+                 "gerritevent.webhook", "gerritevent.idempotency"]
+        environment = dict(os.environ)
+        environment["PYTHONPATH"] = os.pathsep.join(sys.path)
+        process = subprocess.Popen(
+            [sys.executable, "-c",
+             "import sys, gerritevent\n"
+             "print(' '.join(m for m in %r if m in sys.modules))" % heavy],
+            stdout=subprocess.PIPE, env=environment)
+        output = process.communicate()[0]
+        self.assertEqual(0, process.returncode)
+        self.assertEqual("", output.strip())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+from gerritevent.cache import LRUCache
+from gerritevent.state import ApprovalIndex
+from gerritevent.state import ChangeView
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+import StringIO
+if sys.version_info < (3, 0):
+    from ConfigParser import ConfigParser
+else:
+    from configparser import ConfigParser
+
+
+def comment_added(number, patchset, email, approvals):
+    """
+    Returns a minimal "comment-added" event.
+    """
+    return {
+        "type": "comment-added",
+        "change": {"number": str(number)},
+        "patchSet": {"number": str(patchset)},
+        "author": {"name": email.split("@")[0], "email": email},
+        "approvals": [{"type": t, "description": t, "value": str(v)}
+                      for t, v in approvals]
+    }
+
+
+class LRUCacheTest(unittest.TestCase):
+    """
+    This class tests the gerritevent.cache.LRUCache class.
+    """
+    def test_evicts_least_recently_used(self):
+        """
+        Test that a get() protects an entry from being evicted.
+        """
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(1, cache.get("a"))
+        cache.put("c", 3)
+        self.assertFalse("b" in cache)
+        self.assertEqual([("a", 1), ("c", 3)], cache.items())
+        self.assertEqual(3, cache.pop("c"))
+        self.assertEqual(1, len(cache))
+
+
+class ApprovalIndexTest(unittest.TestCase):
+    """
+    This class tests the gerritevent.state.ApprovalIndex class.
+    """
+    def setUp(self):
+        config = ConfigParser()
+        config.readfp(StringIO.StringIO("""[approvals]
+max_changes: 2
+"""))
+        self.index = ApprovalIndex(config)
+
+    def test_votes_per_label(self):
+        """
+        Test that short types, label names and custom labels are tracked and
+        that a negative vote wins.
+        """
+        self.index.comment_added(comment_added(
+            1, 1, "ci@example.com", [("VRIF", 1), ("QA-Approved", 1)]))
+        self.index.comment_added(comment_added(
+            1, 1, "bob@example.com", [("Code-Review", 2)]))
+        self.index.comment_added(comment_added(
+            1, 1, "eve@example.com", [("CRVW", -1)]))
+        self.assertEqual(1, self.index.verified(1))
+        self.assertEqual(1, self.index.value("1", "VRIF"))
+        self.assertEqual(-1, self.index.code_review(1))
+        self.assertEqual({"bob@example.com": 2, "eve@example.com": -1},
+                         self.index.votes(1, "Code-Review"))
+        self.assertEqual(1, self.index.value(1, "QA-Approved"))
+
+    def test_new_patchset_starts_without_votes(self):
+        """
+        Test that votes belong to their patch set.
+        """
+        self.index.comment_added(comment_added(
+            1, 1, "ci@example.com", [("Verified", -1)]))
+        self.index.patchset_created({"change": {"number": "1"},
+                                     "patchSet": {"number": "2"}})
+        self.assertEqual(2, self.index.current_patchset(1))
+        self.assertEqual(None, self.index.verified(1))
+        self.assertEqual(-1, self.index.value(1, "Verified", patchset=1))
+
+    def test_bounded(self):
+        """
+        Test that the least recently active change is forgotten.
+        """
+        for number in (1, 2, 3):
+            self.index.comment_added(comment_added(
+                number, 1, "ci@example.com", [("Verified", 1)]))
+        self.assertEqual(None, self.index.current_patchset(1))
+        self.assertEqual(1, self.index.verified(3))
+
+
+class ChangeViewTest(unittest.TestCase):
+    """
+    This class tests the gerritevent.state.ChangeView class.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.config = ConfigParser()
+        self.config.readfp(StringIO.StringIO("""[changes]
+max_changes: 2
+snapshot_file: %s
+""" % os.path.join(self.directory, "changes.json")))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def event(self, number, patchset, subject):
+        """
+        Returns a minimal event for change "number".
+        """
+        return {
+            "change": {"number": str(number), "project": "tools",
+                       "subject": subject,
+                       "owner": {"name": "alice", "email": "a@example.com"}},
+            "patchSet": {"number": str(patchset)}
+        }
+
+    def test_incremental_updates(self):
+        """
+        Test that the view follows the life cycle of a change.
+        """
+        view = ChangeView(self.config)
+        view.patchset_created(self.event(1, 1, "Fix #12"))
+        view.patchset_created(self.event(1, 2, "Fix #12 properly"))
+        view.comment_added(self.event(1, 1, "Fix #12 properly"))
+        self.assertEqual(2, view.get(1)["current_patchset"])
+        self.assertEqual("NEW", view.get(1)["status"])
+        view.change_merged(self.event(1, 2, "Fix #12 properly"))
+        self.assertEqual("MERGED", view.get("1")["status"])
+        self.assertEqual("Fix #12 properly", view.get(1)["subject"])
+        self.assertEqual("alice", view.get(1)["owner"]["name"])
+        view.close()
+
+    def test_snapshot_warm_start(self):
+        """
+        Test that a closed view is restored with the same LRU order.
+        """
+        view = ChangeView(self.config)
+        for number in (1, 2, 3):
+            view.patchset_created(self.event(number, 1, "Change"))
+        view.change_abandoned(self.event(2, 1, "Change"))
+        view.close()
+        restored = ChangeView(self.config)
+        self.assertEqual(None, restored.get(1))
+        self.assertEqual("ABANDONED", restored.get(2)["status"])
+        restored.patchset_created(self.event(4, 1, "Change"))
+        self.assertEqual(None, restored.get(3))
+        restored.close()
+
+    def test_concurrent_snapshots(self):
+        """
+        Test that snapshots written at the same time don't fail and leave a
+        complete file.
+        """
+        view = ChangeView(self.config)
+        view.patchset_created(self.event(1, 1, "Change"))
+        errors = []
+
+        def write():
+            try:
+                for _ in range(50):
+                    view.snapshot()
+            except Exception, ex:
+                errors.append(ex)
+        threads = [threading.Thread(target=write) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        view.close()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual([], errors)
+        restored = ChangeView(self.config)
+        self.assertEqual("Change", restored.get(1)["subject"])
+        restored.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+from gerritevent import tracing
+from gerritevent.tracing import JSONFileExporter, Tracer
+import gerritevent
+import json
+import os
+import sample_events
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+import StringIO
+if sys.version_info < (3, 0):
+    from ConfigParser import ConfigParser
+else:
+    from configparser import ConfigParser
+
+
+class TracingHandler(object):
+    """
+    Makes a traced "outbound call" for each merged change.
+    """
+    def change_merged(self, event):
+        with tracing.span("http.PUT", url="http://redmine/issues/1.json"):
+            pass
+
+
+class OtherTracingHandler(TracingHandler):
+    """
+    A second handler making traced calls, from threads of its own.
+    """
+    max_concurrency = 2
+
+
+class TracerTest(unittest.TestCase):
+    """
+    This class tests the gerritevent.tracing module.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "traces.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def spans(self):
+        with open(self.path) as traces:
+            return [json.loads(line) for line in traces]
+
+    def test_from_config(self):
+        """
+        Test that tracing is off without section or sample rate.
+        """
+        config = ConfigParser()
+        self.assertEqual(None, Tracer.from_config(config))
+        config.readfp(StringIO.StringIO("""[tracing]
+sample_rate: 0
+"""))
+        self.assertEqual(None, Tracer.from_config(config))
+        self.assertEqual(None, Tracer(None, 0.0).start())
+        self.assertEqual(None, tracing.current())
+        with tracing.span("nothing"):
+            pass
+
+    def test_spans_nest(self):
+        """
+        Test that spans are children of the innermost open span and that
+        failures are recorded.
+        """
+        trace = Tracer(JSONFileExporter(self.path)).start()
+        handler = trace.begin("handler")
+        tracing.activate(trace)
+        try:
+            with tracing.span("http.GET", url="http://redmine"):
+                raise IOError("refused")
+        except IOError:
+            pass
+        finally:
+            tracing.activate(None)
+        trace.end(handler)
+        trace.finish(type="comment-added")
+        spans = dict((span["name"], span) for span in self.spans())
+        self.assertEqual(set(["event", "handler", "http.GET"]), set(spans))
+        self.assertEqual(spans["handler"]["span_id"],
+                         spans["http.GET"]["parent_id"])
+        self.assertEqual(spans["event"]["span_id"],
+                         spans["handler"]["parent_id"])
+        self.assertEqual("refused", spans["http.GET"]["error"])
+        self.assertEqual("comment-added",
+                         spans["event"]["attributes"]["type"])
+        self.assertEqual(1, len(set(span["trace_id"]
+                                    for span in spans.values())))
+
+    def test_threads_nest_separately(self):
+        """
+        Test that spans begun by threads at the same time get the parent of
+        their own thread, or the one the thread was activated with.
+        """
+        trace = Tracer(JSONFileExporter(self.path)).start()
+        first_open = threading.Event()
+        second_done = threading.Event()
+
+        def first():
+            tracing.activate(trace)
+            with tracing.span("first"):
+                first_open.set()
+                second_done.wait(5)
+                with tracing.span("first.child"):
+                    pass
+            tracing.activate(None)
+
+        def second(parent):
+            first_open.wait(5)
+            tracing.activate(trace, parent)
+            with tracing.span("second"):
+                pass
+            tracing.activate(None)
+            second_done.set()
+
+        handler = trace.begin("handler")
+        threads = [threading.Thread(target=first),
+                   threading.Thread(target=second, args=(handler,))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        trace.end(handler)
+        trace.finish()
+        spans = dict((span["name"], span) for span in self.spans())
+        self.assertEqual(spans["event"]["span_id"],
+                         spans["first"]["parent_id"])
+        self.assertEqual(spans["first"]["span_id"],
+                         spans["first.child"]["parent_id"])
+        self.assertEqual(spans["handler"]["span_id"],
+                         spans["second"]["parent_id"])
+
+    def test_dispatcher_traces_events(self):
+        """
+        Test that the dispatcher records the whole way of an event.
+        """
+        config = ConfigParser()
+        config.readfp(StringIO.StringIO("""[tracing]
+sample_rate: 1.0
+file: %s
+""" % self.path))
+        dispatcher = gerritevent.Dispatcher(config, [TracingHandler()])
+        dispatcher.start()
+        dispatcher.submit(sample_events.change_merged(1))
+        self.assertTrue(dispatcher.stop(timeout=5))
+        names = [span["name"] for span in self.spans()]
+        self.assertEqual(["read", "filter", "queue_wait", "http.PUT",
+                          "handler.TracingHandler.change_merged", "event"],
+                         names)
+
+    def test_dispatcher_traces_handlers_in_parallel(self):
+        """
+        Test that the calls of each handler are children of its own span,
+        also if they run with a timeout in threads of their own.
+        """
+        config = ConfigParser()
+        config.readfp(StringIO.StringIO("""[tracing]
+sample_rate: 1.0
+file: %s
+
+[dispatcher]
+handler_timeout: 5
+""" % self.path))
+        dispatcher = gerritevent.Dispatcher(
+            config, [TracingHandler(), OtherTracingHandler()])
+        dispatcher.start()
+        for number in range(1, 4):
+            dispatcher.submit(sample_events.change_merged(number))
+        self.assertTrue(dispatcher.stop(timeout=5))
+        spans = self.spans()
+        ids = dict((span["span_id"], span) for span in spans)
+        roots = [span for span in spans if span["name"] == "event"]
+        self.assertEqual(3, len(roots))
+        calls = [span for span in spans if span["name"] == "http.PUT"]
+        self.assertEqual(6, len(calls))
+        for call in calls:
+            handler = ids[call["parent_id"]]
+            self.assertTrue(handler["name"].startswith("handler."))
+            self.assertEqual(handler["trace_id"], call["trace_id"])
+            root = ids[handler["parent_id"]]
+            self.assertEqual("event", root["name"])
+            self.assertEqual(root["trace_id"], call["trace_id"])
+
+if __name__ == '__main__':
+    unittest.main()
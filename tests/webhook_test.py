@@ -0,0 +1,165 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+from gerritevent import webhook
+import gerritevent
+import httplib
+import json
+import mock
+import sample_events
+import sys
+import threading
+import time
+import unittest
+import StringIO
+if sys.version_info < (3, 0):
+    from ConfigParser import ConfigParser
+else:
+    from configparser import ConfigParser
+
+
+class WebhookReceiverTest(unittest.TestCase):
+    """
+    This class tests the gerritevent.webhook.WebhookReceiver class with a
+    local HTTP client.
+    """
+    def setUp(self):
+        self.events = []
+        self.release = threading.Event()
+        self.release.set()
+        self.receiver = webhook.WebhookReceiver(
+            "127.0.0.1:0", self.sink, secret="s3cret", max_pending=2)
+        self.receiver.start()
+
+    def tearDown(self):
+        self.release.set()
+        self.receiver.stop()
+
+    def sink(self, event):
+        self.release.wait(5)
+        self.events.append(event)
+
+    def post(self, body, secret="s3cret"):
+        """
+        Posts "body" signed with "secret" and returns the response status.
+        """
+        host, port = self.receiver.address.split(":")
+        connection = httplib.HTTPConnection(host, int(port), timeout=5)
+        headers = {}
+        if secret is not None:
+            headers[webhook.SIGNATURE_HEADER] = webhook.sign(secret, body)
+        connection.request("POST", "/", body, headers)
+        status = connection.getresponse().status
+        connection.close()
+        return status
+
+    def wait_for_events(self, count):
+        for _ in range(100):
+            if len(self.events) >= count:
+                break
+            time.sleep(0.01)
+
+    def test_batches(self):
+        """
+        Test that single events, arrays and lines of events are accepted.
+        """
+        first = sample_events.comment_added(1)
+        second = sample_events.change_merged(1)
+        self.assertEqual(202, self.post(json.dumps(first)))
+        self.assertEqual(202, self.post(json.dumps([first, second])))
+        self.assertEqual(202, self.post(json.dumps({"event": second})))
+        self.wait_for_events(4)
+        self.assertEqual([first, first, second, second], self.events)
+
+    def test_rejects_invalid_requests(self):
+        """
+        Test that unsigned, wrongly signed and malformed requests are
+        rejected.
+        """
+        body = json.dumps(sample_events.comment_added(1))
+        self.assertEqual(401, self.post(body, secret=None))
+        self.assertEqual(401, self.post(body, secret="wrong"))
+        self.assertEqual(400, self.post("{"))
+        self.assertEqual(400, self.post('{"no": "type"}'))
+        time.sleep(0.05)
+        self.assertEqual([], self.events)
+
+    def test_bounded_intake(self):
+        """
+        Test that requests are refused while the intake queue is full.
+        """
+        self.release.clear()
+        event = sample_events.comment_added(1)
+        self.assertEqual(202, self.post(json.dumps([event, event])))
+        self.assertEqual(503, self.post(json.dumps(event)))
+        self.assertEqual(1, self.receiver.metrics.counter("webhook.overflows"))
+        self.release.set()
+        self.wait_for_events(2)
+        for _ in range(100):
+            if not self.receiver.pending():
+                break
+            time.sleep(0.01)
+        self.assertEqual(202, self.post(json.dumps(event)))
+
+    def test_batch_larger_than_intake(self):
+        """
+        Test that a batch that can never fit is refused as too large rather
+        than as a temporary overflow.
+        """
+        event = sample_events.comment_added(1)
+        self.assertEqual(413, self.post(json.dumps([event] * 3)))
+        self.assertEqual(0, self.receiver.metrics.counter("webhook.overflows"))
+        self.assertEqual(1, self.receiver.metrics.counter("webhook.too_large"))
+
+    def test_without_compare_digest(self):
+        """
+        Test that signatures are checked without hmac.compare_digest(), as
+        on Python before 2.7.7.
+        """
+        compare = webhook._constant_time_compare
+        signature = webhook.sign("secret", "body")
+        self.assertTrue(compare(signature, webhook.sign("secret", "body")))
+        self.assertFalse(compare(signature, webhook.sign("other", "body")))
+        self.assertFalse(compare(signature, signature[:-1]))
+        self.assertFalse(compare(signature, ""))
+        with mock.patch.object(webhook, "_compare_digest", compare):
+            body = json.dumps(sample_events.comment_added(1))
+            self.assertEqual(401, self.post(body, secret="wrong"))
+            self.assertEqual(202, self.post(body))
+
+
+class DispatcherWebhookTest(unittest.TestCase):
+    """
+    This class tests the gerritevent.Dispatcher without SSH stream, fed by
+    webhooks only.
+    """
+    def test_webhook_events_are_dispatched(self):
+        """
+        Test that pushed events reach the handlers and are drained on stop.
+        """
+        config = ConfigParser()
+        config.readfp(StringIO.StringIO("""[webhook]
+address: 127.0.0.1:0
+"""))
+        handler = mock.MagicMock()
+        dispatcher = gerritevent.Dispatcher(config, [handler])
+        dispatcher.start()
+        for _ in range(100):
+            if ":0" not in dispatcher.webhook.address:
+                break
+            time.sleep(0.01)
+        host, port = dispatcher.webhook.address.split(":")
+        connection = httplib.HTTPConnection(host, int(port), timeout=5)
+        connection.request("POST", "/", json.dumps(
+            [sample_events.patchset_created(1),
+             sample_events.change_merged(1)]))
+        self.assertEqual(202, connection.getresponse().status)
+        connection.close()
+        self.assertTrue(dispatcher.stop(timeout=5))
+        self.assertEqual(1, handler.patchset_created.call_count)
+        self.assertEqual(1, handler.change_merged.call_count)
+
+if __name__ == '__main__':
+    unittest.main()
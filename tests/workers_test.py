@@ -0,0 +1,197 @@
+"""
+Copyright (c) 2012 GONICUS GmbH
+License: LGPL
+Author: Konrad Kleine <kleine@gonicus.de>
+"""
+from gerritevent.metrics import Metrics
+from gerritevent.resilience import HandlerGuard
+from gerritevent.scheduling import PriorityEventQueue
+from gerritevent.workers import Autoscaler, WorkerPool
+import gerritevent
+import sample_events
+import sys
+import threading
+import time
+import unittest
+import StringIO
+if sys.version_info < (3, 0):
+    from ConfigParser import ConfigParser
+else:
+    from configparser import ConfigParser
+
+
+class AutoscalerTest(unittest.TestCase):
+    """
+    This class tests the gerritevent.workers.Autoscaler class.
+    """
+    def test_hysteresis(self):
+        """
+        Test that the pool only grows or shrinks after consecutive
+        intervals and stays within its bounds.
+        """
+        autoscaler = Autoscaler(1, 4, scale_up_wait=1.0,
+                                scale_down_wait=0.1, up_after=2,
+                                down_after=3)
+        self.assertEqual(2, autoscaler.decide(2, 2.0, 0.1, 0))
+        self.assertEqual(2, autoscaler.decide(2, 0.5, 0.1, 0))
+        self.assertEqual(2, autoscaler.decide(2, 2.0, 0.1, 0))
+        self.assertEqual(3, autoscaler.decide(2, 0.0, 0.5, 10))
+        self.assertEqual(3, autoscaler.decide(3, 5.0, 0.1, 0))
+        self.assertEqual(4, autoscaler.decide(3, 5.0, 0.1, 0))
+        self.assertEqual(4, autoscaler.decide(4, 5.0, 0.1, 0))
+        self.assertEqual(4, autoscaler.decide(4, 5.0, 0.1, 0))
+        for _ in range(2):
+            self.assertEqual(4, autoscaler.decide(4, 0.0, 0.1, 0))
+        self.assertEqual(3, autoscaler.decide(4, 0.0, 0.1, 0))
+
+    def test_saturated_handler_blocks_growth(self):
+        """
+        Test that the pool doesn't grow while a handler is saturated.
+        """
+        autoscaler = Autoscaler(1, 4, up_after=1)
+        self.assertEqual(1, autoscaler.decide(1, 5.0, 1.0, 10, True))
+        self.assertEqual(2, autoscaler.decide(1, 5.0, 1.0, 10, False))
+
+
+class WorkerPoolTest(unittest.TestCase):
+    """
+    This class tests the gerritevent.workers.WorkerPool class.
+    """
+    def test_scales_and_keeps_change_order(self):
+        """
+        Test that the pool grows under load, shrinks when idle, handles the
+        events of one change in order and drains on stop.
+        """
+        config = ConfigParser()
+        config.readfp(StringIO.StringIO("""[dispatcher]
+max_workers: 4
+scale_interval: 0.05
+scale_up_wait: 0.02
+scale_down_wait: 0.01
+scale_up_after: 1
+scale_down_after: 1
+"""))
+        lock = threading.Lock()
+        handled = []
+        running = []
+
+        def work(event):
+            number = int(event["change"]["number"])
+            with lock:
+                self.assertFalse(number in running)
+                running.append(number)
+            time.sleep(0.02)
+            with lock:
+                running.remove(number)
+                handled.append((number, int(event["patchSet"]["number"])))
+
+        metrics = Metrics()
+        events_queue = PriorityEventQueue(metrics=metrics)
+        pool = WorkerPool.from_config(config, events_queue, work,
+                                      metrics=metrics)
+        pool.start()
+        for patchset in range(1, 11):
+            for number in range(1, 5):
+                events_queue.put(sample_events.patchset_created(number,
+                                                                patchset))
+        for _ in range(100):
+            if pool.size() > 1:
+                break
+            time.sleep(0.02)
+        self.assertTrue(pool.size() > 1)
+        for _ in range(200):
+            if pool.size() == 1:
+                break
+            time.sleep(0.02)
+        self.assertEqual(1, pool.size())
+        pool.stop()
+        self.assertTrue(pool.join(5))
+        self.assertEqual(40, len(handled))
+        for number in range(1, 5):
+            self.assertEqual(range(1, 11), [patchset for n, patchset
+                                            in handled if n == number])
+        self.assertTrue(metrics.counter("workers.scaled_up") > 0)
+        self.assertTrue(metrics.counter("workers.scaled_down") > 0)
+
+    def test_handler_limit(self):
+        """
+        Test that a guard with a limit lets no more calls through and
+        reports saturation while callers wait.
+        """
+        release = threading.Event()
+        calls = []
+
+        class SlowHandler(object):
+            def change_merged(self, event):
+                calls.append(event)
+                release.wait(5)
+
+        metrics = Metrics()
+        guard = HandlerGuard(SlowHandler(), metrics, limit=1)
+        threads = [threading.Thread(target=guard.call,
+                                    args=("change_merged",
+                                          sample_events.change_merged(n)))
+                   for n in range(2)]
+        for thread in threads:
+            thread.start()
+        for _ in range(100):
+            if guard.saturated():
+                break
+            time.sleep(0.01)
+        self.assertTrue(guard.saturated())
+        self.assertEqual(1, len(calls))
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(2, len(calls))
+        self.assertFalse(guard.saturated())
+        self.assertEqual(1, metrics.counter("handler.SlowHandler.saturated"))
+
+
+class HandlerExecutorTest(unittest.TestCase):
+    """
+    This class tests that the gerritevent.Dispatcher runs each handler in
+    its own gerritevent.workers.HandlerExecutor.
+    """
+    def test_slow_handler_doesnt_hold_up_others(self):
+        """
+        Test that a fast handler gets all events while a slow limited one
+        is stuck, and that the slow one still gets them in order.
+        """
+        config = ConfigParser()
+        config.readfp(StringIO.StringIO("""[dispatcher]
+max_workers: 2
+handler_limits: SlowHandler:1
+"""))
+        release = threading.Event()
+        slow_events = []
+        fast_events = []
+
+        class SlowHandler(object):
+            def change_merged(self, event):
+                release.wait(5)
+                slow_events.append(int(event["patchSet"]["number"]))
+
+        class FastHandler(object):
+            def change_merged(self, event):
+                fast_events.append(int(event["patchSet"]["number"]))
+
+        dispatcher = gerritevent.Dispatcher(config,
+                                            [SlowHandler(), FastHandler()])
+        dispatcher.start()
+        try:
+            for patchset in range(1, 6):
+                dispatcher.submit(sample_events.change_merged(1, patchset))
+            for _ in range(100):
+                if len(fast_events) == 5:
+                    break
+                time.sleep(0.01)
+            self.assertEqual([1, 2, 3, 4, 5], fast_events)
+            self.assertEqual([], slow_events)
+        finally:
+            release.set()
+        self.assertTrue(dispatcher.stop(timeout=5))
+        self.assertEqual([1, 2, 3, 4, 5], slow_events)
+
+if __name__ == '__main__':
+    unittest.main()